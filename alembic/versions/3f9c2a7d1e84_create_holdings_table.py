@@ -0,0 +1,46 @@
+"""create holdings table
+
+Revision ID: 3f9c2a7d1e84
+Revises: 55b02c0bf11d
+Create Date: 2026-10-18 09:12:40.118342
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9c2a7d1e84'
+down_revision: Union[str, Sequence[str], None] = '55b02c0bf11d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('holdings',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('wallet_id', sa.Integer(), nullable=False),
+    sa.Column('asset', sa.String(), nullable=False),
+    sa.Column('quantity', sa.Numeric(precision=18, scale=8), server_default=sa.text('0'), nullable=False),
+    sa.Column('updated_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['wallet_id'], ['wallets.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('wallet_id', 'asset', name='uq_holdings_wallet_asset')
+    )
+    #backfill: ricostruiamo le quantità possedute a partire dallo storico delle transazioni esistenti
+    op.execute("""
+        INSERT INTO holdings (wallet_id, asset, quantity)
+        SELECT wallet_id, asset,
+               SUM(CASE WHEN type = 'BUY' THEN amount WHEN type = 'SELL' THEN -amount ELSE 0 END)
+        FROM transactions
+        WHERE type IN ('BUY', 'SELL')
+        GROUP BY wallet_id, asset
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('holdings')
@@ -0,0 +1,38 @@
+"""add fx rates and balance checks
+
+Revision ID: a7d3e9f1b485
+Revises: f3c8a2e5d716
+Create Date: 2026-10-18 16:27:51.304219
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7d3e9f1b485'
+down_revision: Union[str, Sequence[str], None] = 'f3c8a2e5d716'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('fx_rates',
+    sa.Column('currency', sa.String(), nullable=False),
+    sa.Column('rate', sa.Numeric(precision=18, scale=8), nullable=False),
+    sa.Column('updated_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('currency')
+    )
+    #NOT VALID: il vincolo vale per ogni nuova scrittura senza bloccare le tabelle per ricontrollare le righe esistenti
+    op.execute("ALTER TABLE wallets ADD CONSTRAINT ck_wallets_balance_non_negative CHECK (balance >= 0) NOT VALID")
+    op.execute("ALTER TABLE holdings ADD CONSTRAINT ck_holdings_quantity_non_negative CHECK (quantity >= 0) NOT VALID")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('ck_holdings_quantity_non_negative', 'holdings', type_='check')
+    op.drop_constraint('ck_wallets_balance_non_negative', 'wallets', type_='check')
+    op.drop_table('fx_rates')
@@ -0,0 +1,41 @@
+"""add transaction and wallet indexes
+
+Revision ID: a81d4c6e2b57
+Revises: 3f9c2a7d1e84
+Create Date: 2026-10-18 10:03:17.502914
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a81d4c6e2b57'
+down_revision: Union[str, Sequence[str], None] = '3f9c2a7d1e84'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    #CREATE INDEX CONCURRENTLY non può girare dentro una transazione, ma non blocca le scritture sulle tabelle
+    with op.get_context().autocommit_block():
+        op.create_index('ix_wallets_owner_id', 'wallets', ['owner_id'], unique=False,
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_transactions_wallet_asset', 'transactions', ['wallet_id', 'asset'], unique=False,
+                        postgresql_include=['type', 'amount'], postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_transactions_wallet_created_id', 'transactions', ['wallet_id', 'created_at', 'id'], unique=False,
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_transactions_wallet_created_id', table_name='transactions',
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_transactions_wallet_asset', table_name='transactions',
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_wallets_owner_id', table_name='wallets',
+                      postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,28 @@
+"""add wallet version
+
+Revision ID: b5e1c8d4a392
+Revises: a7d3e9f1b485
+Create Date: 2026-10-18 17:12:36.840157
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b5e1c8d4a392'
+down_revision: Union[str, Sequence[str], None] = 'a7d3e9f1b485'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('wallets', sa.Column('version', sa.Integer(), server_default=sa.text('0'), nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('wallets', 'version')
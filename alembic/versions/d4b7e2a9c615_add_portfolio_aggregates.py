@@ -0,0 +1,58 @@
+"""add portfolio aggregates
+
+Revision ID: d4b7e2a9c615
+Revises: c8f2a6e1d397
+Create Date: 2026-10-18 18:31:44.106528
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4b7e2a9c615'
+down_revision: Union[str, Sequence[str], None] = 'c8f2a6e1d397'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('holdings', sa.Column('reserved', sa.Numeric(precision=18, scale=8), server_default=sa.text('0'), nullable=False))
+    op.add_column('holdings', sa.Column('cost_basis', sa.Numeric(precision=18, scale=8), server_default=sa.text('0'), nullable=False))
+    op.add_column('holdings', sa.Column('realized_pnl', sa.Numeric(precision=18, scale=8), server_default=sa.text('0'), nullable=False))
+    #quantità riservata dagli ordini limite SELL già aperti; costo e pnl si ricostruiscono dallo storico
+    #con python -m scripts.revalue_portfolios --rebuild, senza tenere bloccata la tabella durante la migrazione
+    op.execute("""
+        UPDATE holdings SET reserved = aperti.quantita
+        FROM (
+            SELECT wallet_id, asset, SUM(amount - filled) AS quantita
+            FROM orders
+            WHERE kind = 'LIMIT' AND type = 'SELL' AND status = 'OPEN'
+            GROUP BY wallet_id, asset
+        ) AS aperti
+        WHERE holdings.wallet_id = aperti.wallet_id AND holdings.asset = aperti.asset
+    """)
+    op.create_check_constraint('ck_holdings_reserved_non_negative', 'holdings', 'reserved >= 0')
+    op.create_table('portfolio_valuations',
+    sa.Column('wallet_id', sa.Integer(), nullable=False),
+    sa.Column('as_of', sa.TIMESTAMP(timezone=True), nullable=False),
+    sa.Column('currency', sa.String(), nullable=False),
+    sa.Column('market_value', sa.Numeric(precision=18, scale=8), nullable=False),
+    sa.Column('cost_basis', sa.Numeric(precision=18, scale=8), nullable=False),
+    sa.Column('unrealized_pnl', sa.Numeric(precision=18, scale=8), nullable=False),
+    sa.Column('realized_pnl', sa.Numeric(precision=18, scale=8), nullable=False),
+    sa.ForeignKeyConstraint(['wallet_id'], ['wallets.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('wallet_id', 'as_of')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('portfolio_valuations')
+    op.drop_constraint('ck_holdings_reserved_non_negative', 'holdings', type_='check')
+    op.drop_column('holdings', 'realized_pnl')
+    op.drop_column('holdings', 'cost_basis')
+    op.drop_column('holdings', 'reserved')
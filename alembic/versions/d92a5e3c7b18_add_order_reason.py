@@ -0,0 +1,28 @@
+"""add order reason
+
+Revision ID: d92a5e3c7b18
+Revises: c4e7b19f6a20
+Create Date: 2026-10-18 12:08:33.914207
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd92a5e3c7b18'
+down_revision: Union[str, Sequence[str], None] = 'c4e7b19f6a20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('orders', sa.Column('reason', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('orders', 'reason')
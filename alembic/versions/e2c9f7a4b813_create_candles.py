@@ -0,0 +1,54 @@
+"""create candles
+
+Revision ID: e2c9f7a4b813
+Revises: d4b7e2a9c615
+Create Date: 2026-10-18 20:12:05.318274
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2c9f7a4b813'
+down_revision: Union[str, Sequence[str], None] = 'd4b7e2a9c615'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('candles',
+    sa.Column('asset', sa.String(), nullable=False),
+    sa.Column('currency', sa.String(), nullable=False),
+    sa.Column('timeframe', sa.String(length=3), nullable=False),
+    sa.Column('start', sa.TIMESTAMP(timezone=True), nullable=False),
+    sa.Column('open', sa.Numeric(precision=18, scale=8), nullable=False),
+    sa.Column('high', sa.Numeric(precision=18, scale=8), nullable=False),
+    sa.Column('low', sa.Numeric(precision=18, scale=8), nullable=False),
+    sa.Column('close', sa.Numeric(precision=18, scale=8), nullable=False),
+    sa.Column('volume', sa.Numeric(precision=24, scale=8), server_default=sa.text('0'), nullable=False),
+    sa.Column('trades', sa.Integer(), server_default=sa.text('0'), nullable=False),
+    sa.PrimaryKeyConstraint('asset', 'currency', 'timeframe', 'start')
+    )
+    op.create_table('candle_cursors',
+    sa.Column('source', sa.String(), nullable=False),
+    sa.Column('position', sa.BigInteger(), server_default=sa.text('0'), nullable=False),
+    sa.Column('end_position', sa.BigInteger(), nullable=True),
+    sa.PrimaryKeyConstraint('source')
+    )
+    #l'aggregatore parte dalle transazioni nuove, lo storico fino ad oggi lo ricostruisce scripts/backfill_candles.py
+    op.execute("""
+        INSERT INTO candle_cursors (source, position, end_position)
+        SELECT 'transactions', COALESCE(MAX(id), 0), NULL FROM transactions
+        UNION ALL
+        SELECT 'backfill', 0, COALESCE(MAX(id), 0) FROM transactions
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('candle_cursors')
+    op.drop_table('candles')
@@ -0,0 +1,41 @@
+"""add limit orders and order books
+
+Revision ID: e6a4d1f9c3b2
+Revises: d92a5e3c7b18
+Create Date: 2026-10-18 13:41:07.225318
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e6a4d1f9c3b2'
+down_revision: Union[str, Sequence[str], None] = 'd92a5e3c7b18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('orders', sa.Column('kind', sa.String(), server_default=sa.text("'MARKET'"), nullable=False))
+    op.add_column('orders', sa.Column('filled', sa.Numeric(precision=18, scale=8), server_default=sa.text('0'), nullable=False))
+    op.create_table('order_books',
+    sa.Column('asset', sa.String(), nullable=False),
+    sa.Column('last_event_id', sa.String(), server_default=sa.text("'0-0'"), nullable=False),
+    sa.Column('seq', sa.BigInteger(), server_default=sa.text('0'), nullable=False),
+    sa.Column('snapshot', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('snapshot_event_id', sa.String(), nullable=True),
+    sa.Column('updated_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('asset')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('order_books')
+    op.drop_column('orders', 'filled')
+    op.drop_column('orders', 'kind')
@@ -0,0 +1,93 @@
+"""create ledger tables
+
+Revision ID: f3c8a2e5d716
+Revises: e6a4d1f9c3b2
+Create Date: 2026-10-18 15:02:44.518630
+
+"""
+from datetime import date
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3c8a2e5d716'
+down_revision: Union[str, Sequence[str], None] = 'e6a4d1f9c3b2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+#partizioni mensili create insieme alla tabella, le successive le crea scripts/ledger_snapshot.py
+MESI_INIZIALI = 4
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('postings',
+    sa.Column('id', sa.BigInteger(), autoincrement=True, nullable=False),
+    sa.Column('created_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('entry_id', sa.String(), nullable=False),
+    sa.Column('entry_type', sa.String(), nullable=False),
+    sa.Column('account', sa.String(), nullable=False),
+    sa.Column('wallet_id', sa.Integer(), nullable=False),
+    sa.Column('asset', sa.String(), nullable=False),
+    sa.Column('amount', sa.Numeric(precision=18, scale=8), nullable=False),
+    sa.Column('transaction_id', sa.Integer(), nullable=True),
+    sa.Column('order_id', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('id', 'created_at'),
+    postgresql_partition_by='RANGE (created_at)'
+    )
+    op.create_index('ix_postings_account_wallet_asset_created', 'postings', ['account', 'wallet_id', 'asset', 'created_at'], unique=False)
+    op.create_index('ix_postings_entry', 'postings', ['entry_id'], unique=False)
+
+    mese = date.today().replace(day=1)
+    for _ in range(MESI_INIZIALI):
+        successivo = date(mese.year + mese.month // 12, mese.month % 12 + 1, 1)
+        op.execute(f"CREATE TABLE postings_{mese.year}_{mese.month:02d} PARTITION OF postings "
+                   f"FOR VALUES FROM ('{mese.isoformat()}') TO ('{successivo.isoformat()}')")
+        mese = successivo
+    op.execute("CREATE TABLE postings_default PARTITION OF postings DEFAULT")
+
+    op.create_table('ledger_snapshots',
+    sa.Column('account', sa.String(), nullable=False),
+    sa.Column('wallet_id', sa.Integer(), nullable=False),
+    sa.Column('asset', sa.String(), nullable=False),
+    sa.Column('as_of', sa.TIMESTAMP(timezone=True), nullable=False),
+    sa.Column('balance', sa.Numeric(precision=18, scale=8), nullable=False),
+    sa.PrimaryKeyConstraint('account', 'wallet_id', 'asset', 'as_of')
+    )
+
+    #scritture di apertura: i saldi esistenti entrano nel mastro con il mondo esterno (valuta) o il mercato (crypto) come controparte
+    op.execute("""
+        INSERT INTO postings (entry_id, entry_type, account, wallet_id, asset, amount)
+        SELECT md5('opening-' || saldi.conto || '-' || saldi.wallet_id || '-' || saldi.asset), 'OPENING', c.account, c.wallet_id, c.asset, c.amount
+        FROM (
+            SELECT 'WALLET' AS conto, id AS wallet_id, currency AS asset, balance AS importo, 'EXTERNAL' AS controparte FROM wallets
+            UNION ALL
+            SELECT 'WALLET', wallet_id, asset, quantity, 'MARKET' FROM holdings
+            UNION ALL
+            SELECT 'RESERVED', o.wallet_id, w.currency, SUM(ROUND((o.amount - o.filled) * o.price, 8)), 'EXTERNAL'
+            FROM orders o JOIN wallets w ON w.id = o.wallet_id
+            WHERE o.kind = 'LIMIT' AND o.status = 'OPEN' AND o.type = 'BUY'
+            GROUP BY o.wallet_id, w.currency
+            UNION ALL
+            SELECT 'RESERVED', wallet_id, asset, SUM(amount - filled), 'MARKET'
+            FROM orders
+            WHERE kind = 'LIMIT' AND status = 'OPEN' AND type = 'SELL'
+            GROUP BY wallet_id, asset
+        ) saldi
+        CROSS JOIN LATERAL (
+            VALUES (saldi.conto, saldi.wallet_id, saldi.asset, saldi.importo),
+                   (saldi.controparte, 0, saldi.asset, -saldi.importo)
+        ) AS c(account, wallet_id, asset, amount)
+        WHERE saldi.importo != 0
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('ledger_snapshots')
+    op.drop_index('ix_postings_entry', table_name='postings')
+    op.drop_index('ix_postings_account_wallet_asset_created', table_name='postings')
+    op.drop_table('postings')
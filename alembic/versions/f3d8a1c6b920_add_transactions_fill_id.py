@@ -0,0 +1,52 @@
+"""add transactions fill_id
+
+Revision ID: f3d8a1c6b920
+Revises: e2c9f7a4b813
+Create Date: 2026-10-18 23:41:37.502118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3d8a1c6b920'
+down_revision: Union[str, Sequence[str], None] = 'e2c9f7a4b813'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('transactions', sa.Column('fill_id', sa.String(length=32), nullable=True))
+    #gli eseguiti già regolati non hanno un id: il worker scrive le due righe di un eseguito nello stesso insert,
+    #quindi hanno lo stesso created_at (now() della transazione), asset, quantità, prezzo e totale, una BUY e una SELL,
+    #e tutte e due i wallet hanno un ordine limite su quell'asset da quel lato; le coppie si numerano in ordine di id
+    #e ricevono un fill_id derivato dall'id della riga del compratore. Legge tutte le transazioni una volta sola
+    op.execute("""
+        WITH candidate AS (
+            SELECT t.id, t.type, t.created_at, t.asset, t.amount, t.price_at_the_moment, t.total_payed,
+                   row_number() OVER (PARTITION BY t.created_at, t.asset, t.amount, t.price_at_the_moment, t.total_payed, t.type
+                                      ORDER BY t.id) AS n
+            FROM transactions t
+            WHERE t.status = 'COMPLETED' AND t.type IN ('BUY', 'SELL')
+              AND EXISTS (SELECT 1 FROM orders o
+                          WHERE o.kind = 'LIMIT' AND o.wallet_id = t.wallet_id AND o.asset = t.asset AND o.type = t.type)
+        ),
+        coppie AS (
+            SELECT b.id AS compratore, s.id AS venditore
+            FROM candidate b JOIN candidate s
+              ON b.type = 'BUY' AND s.type = 'SELL' AND b.created_at = s.created_at AND b.asset = s.asset AND b.amount = s.amount
+             AND b.price_at_the_moment = s.price_at_the_moment AND b.total_payed = s.total_payed AND b.n = s.n
+        )
+        UPDATE transactions SET fill_id = 'storico' || coppie.compratore
+        FROM coppie
+        WHERE transactions.id IN (coppie.compratore, coppie.venditore)
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('transactions', 'fill_id')
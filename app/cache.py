@@ -0,0 +1,67 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+#cache in memoria del singolo processo, da mettere davanti a redis per i dati letti ad ogni richiesta
+#LRU: quando si supera max_size viene scartata la chiave usata meno di recente
+#TTL: dopo ttl secondi il valore non è più fresco, ma per altri stale_ttl secondi può ancora essere servito
+#mentre in background si recupera quello nuovo (stale-while-revalidate)
+class TTLCache:
+    def __init__(self, max_size: int, ttl: float, stale_ttl: float = 0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._dati: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+
+    #restituisce (valore, fresco) oppure None se la chiave non c'è o è troppo vecchia anche per essere servita
+    def get(self, chiave: Hashable) -> tuple[Any, bool] | None:
+        voce = self._dati.get(chiave)
+        if voce is None:
+            return None
+
+        valore, salvato_il = voce
+        eta = time.monotonic() - salvato_il
+        if eta > self.ttl + self.stale_ttl:
+            del self._dati[chiave]
+            return None
+
+        self._dati.move_to_end(chiave)
+        return valore, eta <= self.ttl
+
+    def set(self, chiave: Hashable, valore: Any):
+        self._dati[chiave] = (valore, time.monotonic())
+        self._dati.move_to_end(chiave)
+        while len(self._dati) > self.max_size:
+            self._dati.popitem(last=False)
+
+    def delete(self, chiave: Hashable):
+        self._dati.pop(chiave, None)
+
+    def clear(self):
+        self._dati.clear()
+
+    def __len__(self):
+        return len(self._dati)
+
+
+#single-flight: se più richieste concorrenti chiedono la stessa chiave, solo la prima esegue la funzione
+#le altre aspettano lo stesso risultato invece di fare ognuna la propria chiamata (thundering herd)
+class SingleFlight:
+    def __init__(self):
+        self._in_volo: dict[Hashable, asyncio.Task] = {}
+
+    def in_volo(self, chiave: Hashable) -> bool:
+        return chiave in self._in_volo
+
+    #restituisce il task condiviso e True se la chiamata è stata accorpata ad una già in corso
+    #il task è indipendente dal chiamante: se una richiesta viene cancellata le altre ricevono comunque il risultato
+    def esegui(self, chiave: Hashable, funzione: Callable[[], Awaitable[Any]]) -> tuple[asyncio.Task, bool]:
+        task = self._in_volo.get(chiave)
+        if task is not None:
+            return task, True
+
+        task = asyncio.ensure_future(funzione())
+        self._in_volo[chiave] = task
+        task.add_done_callback(lambda _: self._in_volo.pop(chiave, None))
+        return task, False
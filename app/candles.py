@@ -0,0 +1,161 @@
+import time
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from .config import settings
+
+#candele OHLCV per asset, valuta di quotazione e timeframe, costruite in memoria e scritte a blocchi nella tabella candles
+#le fonti sono due: i tick del poller dei prezzi (canali prezzo_di_{ticker}, in PRICE_QUOTE_CURRENCY) che muovono solo il prezzo,
+#e le transazioni eseguite, lette dal db in ordine di id, che muovono prezzo e volume nella valuta del wallet che le ha fatte
+#ogni scrittura somma volume e numero di trade a quelli già salvati e aggiorna massimo, minimo e chiusura,
+#quindi una candela può essere scritta più volte mentre è aperta e lo stesso vale per backfill a blocchi
+#l'aggregatore gira nel worker che tiene il lock CANDLE_LOCK_KEY; la posizione nelle transazioni è nella tabella candle_cursors
+#e avanza nella stessa transazione del db che scrive le candele, cosi ogni transazione entra nel volume una volta sola
+TIMEFRAME = {"1m": 60, "5m": 300, "1h": 3600, "1d": 86400}
+CANDLE_LOCK_KEY = "aggregatore_candele"
+CURSORE_LIVE = "transactions"
+CURSORE_BACKFILL = "backfill"
+
+
+#candela di una finestra: open/close sono il primo e l'ultimo prezzo per timestamp, anche se gli eventi arrivano in disordine
+#volume e trades sono solo quelli non ancora scritti nel db
+class Candela:
+    __slots__ = ("open", "high", "low", "close", "volume", "trades", "aperta_il", "chiusa_il", "versione", "modificata")
+
+    def __init__(self, ts: float, prezzo: Decimal):
+        self.open = self.high = self.low = self.close = prezzo
+        self.aperta_il = self.chiusa_il = ts
+        self.volume = Decimal(0)
+        self.trades = 0
+        self.versione = 0
+        self.modificata = False
+
+    def aggiorna(self, ts: float, prezzo: Decimal, quantita: Decimal | None):
+        if ts < self.aperta_il:
+            self.open, self.aperta_il = prezzo, ts
+        if ts >= self.chiusa_il:
+            self.close, self.chiusa_il = prezzo, ts
+        if prezzo > self.high:
+            self.high = prezzo
+        if prezzo < self.low:
+            self.low = prezzo
+        if quantita is not None:
+            self.volume += quantita
+            self.trades += 1
+        self.versione += 1
+        self.modificata = True
+
+
+#candele aperte o non ancora scritte, chiave (asset, valuta, timeframe, inizio della finestra in secondi epoch)
+#funziona anche da iscrizione allo streaming.hub: riceve i tick con pubblica() come i client websocket
+class Aggregatore:
+    def __init__(self, posizione: int = 0):
+        self.candele: dict[tuple[str, str, str, int], Candela] = {}
+        #id dell'ultima transazione aggregata
+        self.posizione = posizione
+
+    def aggiungi(self, asset: str, valuta: str, ts: float, prezzo: Decimal, quantita: Decimal | None = None):
+        for timeframe, secondi in TIMEFRAME.items():
+            chiave = (asset, valuta, timeframe, int(ts // secondi * secondi))
+            candela = self.candele.get(chiave)
+            if candela is None:
+                candela = self.candele[chiave] = Candela(ts, prezzo)
+            candela.aggiorna(ts, prezzo, quantita)
+
+    #chiamata dal task di lettura del pub/sub condiviso: un messaggio non valido non deve fermarlo
+    def pubblica(self, canale: str, messaggio: str):
+        try:
+            prezzo = Decimal(messaggio)
+        except InvalidOperation:
+            print(f"Prezzo non valido sul canale {canale}: {messaggio}")
+            return
+        self.aggiungi(canale.removeprefix("prezzo_di_"), settings.PRICE_QUOTE_CURRENCY, time.time(), prezzo)
+
+    def aggiungi_transazioni(self, transazioni):
+        for transazione in transazioni:
+            self.aggiungi(transazione.asset, transazione.currency, transazione.created_at.timestamp(),
+                          transazione.price_at_the_moment, transazione.amount)
+            self.posizione = max(self.posizione, transazione.id)
+
+    #fotografia delle candele modificate da scrivere: i tick possono arrivare mentre la scrittura è in corso,
+    #quindi le candele vengono azzerate solo dopo il commit con scritte()
+    def da_scrivere(self) -> list[tuple]:
+        return [(chiave, candela.versione, candela.open, candela.high, candela.low, candela.close, candela.volume, candela.trades)
+                for chiave, candela in self.candele.items() if candela.modificata]
+
+    #dopo il commit: toglie volume e trade scritti e libera le finestre chiuse da più di margine secondi
+    def scritte(self, righe: list[tuple], margine: float = 0):
+        for chiave, versione, _, _, _, _, volume, trades in righe:
+            candela = self.candele.get(chiave)
+            if candela is None:
+                continue
+            candela.volume -= volume
+            candela.trades -= trades
+            if candela.versione == versione:
+                candela.modificata = False
+        adesso = time.time()
+        for chiave in [chiave for chiave, candela in self.candele.items()
+                       if not candela.modificata and chiave[3] + TIMEFRAME[chiave[2]] + margine < adesso]:
+            del self.candele[chiave]
+
+
+#trade eseguiti dopo un id, con la valuta del wallet in cui sono quotati, in ordine di id (usa la chiave primaria)
+#depositi e prelievi non sono scambi (asset = valuta del wallet, prezzo 1) e restano fuori; un eseguito del matching
+#ha due righe con lo stesso fill_id (BUY del compratore e SELL del venditore) e si conta solo con quella del compratore
+#fino_a limita la lettura (backfill), ritardo esclude quelle iniziate da meno di ritardo secondi: gli id sono assegnati
+#all'insert ma le transazioni diventano visibili al commit, quindi leggendo solo quelle un po' vecchie non se ne salta nessuna
+#finchè un trade non resta aperto più di ritardo secondi
+async def leggi_transazioni(conn: AsyncConnection, dopo_id: int, limite: int, fino_a: int | None = None, ritardo: float = 0):
+    limite_id = "AND t.id <= :fino_a" if fino_a is not None else ""
+    result = await conn.execute(text(f"""
+        SELECT t.id, t.asset, w.currency, t.amount, t.price_at_the_moment, t.created_at
+        FROM transactions t JOIN wallets w ON w.id = t.wallet_id
+        WHERE t.id > :dopo_id {limite_id} AND t.status = 'COMPLETED' AND t.type IN ('BUY', 'SELL')
+          AND (t.fill_id IS NULL OR t.type = 'BUY')
+          AND t.created_at < now() - make_interval(secs => :ritardo)
+        ORDER BY t.id
+        LIMIT :limite
+    """), {"dopo_id": dopo_id, "fino_a": fino_a, "ritardo": ritardo, "limite": limite})
+    return result.all()
+
+#scrive le candele con un solo upsert e sposta il cursore nella stessa transazione
+#il cursore avanza solo se è ancora dove l'avevamo lasciato: come last_event_id dei book, impedisce a un ex leader di scrivere
+#due volte le stesse transazioni; restituisce False se il cursore era già stato spostato da un altro processo
+async def scrivi_candele(conn: AsyncConnection, righe: list[tuple], cursore: str, precedente: int, posizione: int) -> bool:
+    result = await conn.execute(text("""
+        UPDATE candle_cursors SET position = :posizione WHERE source = :cursore AND position = :precedente
+    """), {"cursore": cursore, "precedente": precedente, "posizione": posizione})
+    if result.rowcount != 1:
+        return False
+    if not righe:
+        return True
+
+    await conn.execute(text("""
+        INSERT INTO candles (asset, currency, timeframe, start, open, high, low, close, volume, trades)
+        SELECT * FROM unnest(CAST(:assets AS varchar[]), CAST(:valute AS varchar[]), CAST(:timeframe AS varchar[]),
+                             CAST(:inizi AS timestamptz[]), CAST(:aperture AS numeric[]), CAST(:massimi AS numeric[]),
+                             CAST(:minimi AS numeric[]), CAST(:chiusure AS numeric[]), CAST(:volumi AS numeric[]), CAST(:trades AS integer[]))
+        ON CONFLICT (asset, currency, timeframe, start) DO UPDATE SET
+            high = GREATEST(candles.high, excluded.high),
+            low = LEAST(candles.low, excluded.low),
+            close = excluded.close,
+            volume = candles.volume + excluded.volume,
+            trades = candles.trades + excluded.trades
+    """), {
+        "assets": [chiave[0] for chiave, *_ in righe],
+        "valute": [chiave[1] for chiave, *_ in righe],
+        "timeframe": [chiave[2] for chiave, *_ in righe],
+        "inizi": [datetime.fromtimestamp(chiave[3], timezone.utc) for chiave, *_ in righe],
+        "aperture": [riga[2] for riga in righe],
+        "massimi": [riga[3] for riga in righe],
+        "minimi": [riga[4] for riga in righe],
+        "chiusure": [riga[5] for riga in righe],
+        "volumi": [riga[6] for riga in righe],
+        "trades": [riga[7] for riga in righe],
+    })
+    return True
+
+async def leggi_cursore(conn: AsyncConnection, cursore: str):
+    result = await conn.execute(text("SELECT position, end_position FROM candle_cursors WHERE source = :cursore"), {"cursore": cursore})
+    return result.one()
@@ -1,3 +1,4 @@
+from typing import Literal, Optional
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
@@ -10,6 +11,146 @@ class Settings(BaseSettings):
     ALGORITHM: str
     ACCESS_TOKEN_EXPIRE_MINUTES: str
 
+    #replica in sola lettura (stesse credenziali del primario), se manca tutte le letture vanno sul primario
+    DATABASE_REPLICA_HOSTNAME: Optional[str] = None
+    DATABASE_REPLICA_PORT: Optional[str] = None
+    #oltre questi secondi di ritardo la replica non viene usata, il ritardo viene misurato ogni REPLICA_LAG_CHECK_INTERVAL secondi
+    REPLICA_MAX_LAG: float = 2.0
+    REPLICA_LAG_CHECK_INTERVAL: float = 1.0
+    #dopo un proprio commit un utente legge dal primario per questi secondi, cosi vede sempre le sue scritture
+    READ_YOUR_WRITES_WINDOW: float = 5.0
+
+    #engine del database: stampa delle query (solo per debug, rallenta ogni richiesta) e pool di connessioni
+    #ogni processo apre al massimo POOL_SIZE + MAX_OVERFLOW connessioni: moltiplicato per il numero di processi
+    #uvicorn e worker deve restare sotto il max_connections di postgres
+    DB_ECHO: bool = False
+    #profilo usato dai processi api, il worker usa il profilo "worker" (vedi database.usa_profilo)
+    DB_PROFILE: str = "api"
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 10
+    #secondi di attesa di una connessione libera prima dell'errore
+    DB_POOL_TIMEOUT: float = 30.0
+    #controlla la connessione prima di usarla, per non fallire su connessioni chiuse da postgres o da un proxy
+    DB_POOL_PRE_PING: bool = True
+    #secondi dopo cui una connessione viene ricreata, -1 per non ricrearla mai
+    DB_POOL_RECYCLE: int = 1800
+    #cache dei prepared statement di asyncpg per connessione, 0 per disattivarla (necessario con pgbouncer in transaction mode)
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    #pool del worker: poche connessioni, lavora a batch con una transazione alla volta per ogni loop
+    WORKER_DB_POOL_SIZE: int = 4
+    WORKER_DB_MAX_OVERFLOW: int = 2
+
+    #cache degli utenti autenticati: in-process (secondi e numero massimo di utenti) e opzionalmente anche su redis
+    PRINCIPAL_CACHE_TTL: float = 60.0
+    PRINCIPAL_CACHE_MAX_SIZE: int = 10000
+    PRINCIPAL_CACHE_REDIS: bool = True
+    PRINCIPAL_REDIS_TTL: int = 300
+
+    #concorrenza sui saldi di depositi e prelievi: "pessimistic" blocca il wallet con SELECT ... FOR UPDATE,
+    #"optimistic" lo legge senza lock e l'UPDATE controlla la colonna version, riprovando fino a OPTIMISTIC_MAX_RETRIES volte
+    #con un'attesa casuale crescente (OPTIMISTIC_BACKOFF secondi al primo tentativo) se un'altra richiesta l'ha modificato
+    BALANCE_CONCURRENCY: Literal["pessimistic", "optimistic"] = "pessimistic"
+    OPTIMISTIC_MAX_RETRIES: int = 5
+    OPTIMISTIC_BACKOFF: float = 0.005
+
+    #chiavi di idempotenza (header Idempotency-Key) di depositi, prelievi e trade: secondi in cui la risposta resta su redis,
+    #durata massima del segnaposto della richiesta in corso, quanto aspetta una copia concorrente e ogni quanto ricontrolla,
+    #giorni dopo cui scripts/purge_idempotency_keys.py cancella le chiavi dal db
+    IDEMPOTENCY_TTL: int = 86400
+    IDEMPOTENCY_LOCK_TTL: float = 30.0
+    IDEMPOTENCY_WAIT: float = 10.0
+    IDEMPOTENCY_POLL_INTERVAL: float = 0.05
+    IDEMPOTENCY_DB_RETENTION_DAYS: int = 7
+
+    #osservabilità (app/instrumentation.py): istogrammi di latenza per rotta, porta delle metriche del worker (0 = spente),
+    #span opentelemetry (serve opentelemetry-api, l'esportazione si configura con opentelemetry-instrument e le variabili OTEL_*)
+    #e lunghezza massima del testo sql salvato negli span delle query
+    HTTP_METRICS_ENABLED: bool = True
+    WORKER_METRICS_PORT: int = 9101
+    TRACING_ENABLED: bool = False
+    TRACING_MAX_STATEMENT: int = 500
+
+    #rate limiting (app/ratelimit.py): per ogni client, utente del token o ip, e rotta "METODO /percorso" un token bucket
+    #[capacità, token al secondo]; le rotte non elencate usano RATE_LIMIT_DEFAULT, quelle in RATE_LIMITS_GLOBAL hanno anche
+    #un bucket condiviso da tutti i client. Con RATE_LIMIT_TRUST_PROXY l'ip è il primo di X-Forwarded-For
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMITS: dict[str, list[float]] = {
+        "POST /trade": [20, 10],
+        "POST /trade/async": [50, 25],
+        "POST /deposit": [10, 2],
+        "POST /withdrawal": [10, 2],
+        "POST /orders/limit": [50, 25],
+        "POST /login": [10, 0.5],
+        "POST /user": [5, 0.1],
+        "GET /transactions/export": [3, 0.05],
+    }
+    RATE_LIMIT_DEFAULT: list[float] = [200, 100]
+    RATE_LIMITS_GLOBAL: dict[str, list[float]] = {
+        "POST /login": [200, 100],
+        "POST /user": [100, 20],
+    }
+    RATE_LIMIT_TRUST_PROXY: bool = False
+    #bucket in memoria usati quando redis non risponde, e per quanti secondi dopo un errore non si riprova redis
+    RATE_LIMIT_LOCAL_MAX_SIZE: int = 100000
+    RATE_LIMIT_REDIS_RETRY: float = 5.0
+
+    #costo di bcrypt, thread dedicati all'hashing e numero massimo di richieste in attesa prima di rispondere 503
+    BCRYPT_ROUNDS: int = 12
+    BCRYPT_WORKERS: int = 4
+    BCRYPT_MAX_QUEUE: int = 64
+
+    #cache dei prezzi in-process davanti a redis (secondi di validità, secondi in cui il prezzo scaduto
+    #può ancora essere servito mentre si aggiorna, numero massimo di ticker in memoria)
+    PRICE_CACHE_TTL: float = 1.0
+    PRICE_CACHE_STALE_TTL: float = 4.0
+    PRICE_CACHE_MAX_SIZE: int = 1024
+    #secondi di validità del prezzo salvato su redis
+    PRICE_REDIS_TTL: int = 5
+
+    #binance: url base (sostituibile con un server stub in locale), ticker supportati e client http condiviso
+    BINANCE_BASE_URL: str = "https://api.binance.com"
+    SUPPORTED_TICKERS: list[str] = ["BTC", "ETH"]
+    HTTP_TIMEOUT: float = 5.0
+    HTTP_MAX_CONNECTIONS: int = 20
+    #poller in background che aggiorna tutti i prezzi con una sola chiamata ogni PRICE_POLL_INTERVAL secondi
+    PRICE_POLLER_ENABLED: bool = True
+    PRICE_POLL_INTERVAL: float = 1.0
+
+    #valute dei wallet: i prezzi di binance sono in PRICE_QUOTE_CURRENCY e vengono convertiti nella valuta del wallet
+    #con i cambi delle coppie {valuta}USDT, letti ogni FX_POLL_INTERVAL secondi e salvati su redis e nella tabella fx_rates
+    PRICE_QUOTE_CURRENCY: str = "USDT"
+    SUPPORTED_CURRENCIES: list[str] = ["EUR", "USDT"]
+    DEFAULT_CURRENCY: str = "EUR"
+    FX_POLL_INTERVAL: float = 30.0
+    #secondi di validità del cambio nella cache in-process e su redis
+    FX_CACHE_TTL: float = 30.0
+    FX_REDIS_TTL: int = 120
+    #un cambio più vecchio di cosi non viene usato e i trade in quella valuta rispondono 503
+    FX_MAX_AGE: float = 600.0
+    #valuta in cui sono quotati i book degli ordini limite, solo i wallet in questa valuta possono inviarne
+    LIMIT_ORDER_CURRENCY: str = "EUR"
+
+    #livelli per lato salvati nella fotografia del book di ogni asset (GET /book/{asset} e primo messaggio del websocket)
+    BOOK_DEPTH: int = 50
+
+    #candele OHLCV (app/candles.py): l'aggregatore nel worker scrive ogni CANDLE_FLUSH_INTERVAL secondi, legge al massimo
+    #CANDLE_TX_BATCH transazioni per giro e solo quelle iniziate da più di CANDLE_TX_DELAY secondi (già committate);
+    #GET /candles tiene in cache per CANDLE_HOT_TTL secondi le ultime CANDLE_HOT_WINDOW candele di ogni serie
+    CANDLE_ENABLED: bool = True
+    CANDLE_FLUSH_INTERVAL: float = 2.0
+    CANDLE_TX_BATCH: int = 5000
+    CANDLE_TX_DELAY: float = 5.0
+    CANDLE_HOT_WINDOW: int = 500
+    CANDLE_HOT_TTL: float = 1.0
+    CANDLE_MAX_LIMIT: int = 1000
+
+    #estratto conto (GET /transactions/export): righe lette dal cursore lato server e inviate al client per blocco,
+    #compressione dei row group parquet (snappy, zstd, gzip, none) e esportazioni contemporanee per processo,
+    #ognuna con una connessione del pool: va tenuto ben sotto DB_POOL_SIZE + DB_MAX_OVERFLOW
+    EXPORT_CHUNK_SIZE: int = 5000
+    EXPORT_MAX_CONCURRENT: int = 2
+    EXPORT_PARQUET_COMPRESSION: str = "zstd"
+
     class Config:
         env_file = ".env"
         #
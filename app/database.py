@@ -1,4 +1,12 @@
+import asyncio
+import time
+from contextvars import ContextVar
+from sqlalchemy import event, exc, text
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from . import metrics, utils
+from .instrumentation import traccia_query
 from sqlalchemy.ext.declarative import declarative_base
 from .config import settings
 
@@ -7,12 +15,191 @@ from .config import settings
 DB_URL = f'postgresql+asyncpg://{settings.DATABASE_USERNAME}:{settings.DATABASE_PASSWORD
             }@{settings.DATABASE_HOSTNAME}:{settings.DATABASE_PORT}/{settings.DATABASE_NAME}'
 
+#replica in sola lettura, con le stesse credenziali e lo stesso nome del db del primario
+REPLICA_URL = None
+if settings.DATABASE_REPLICA_HOSTNAME:
+    REPLICA_URL = DB_URL.replace(f"@{settings.DATABASE_HOSTNAME}:{settings.DATABASE_PORT}/",
+                                 f"@{settings.DATABASE_REPLICA_HOSTNAME}:{settings.DATABASE_REPLICA_PORT or settings.DATABASE_PORT}/")
+
+#pool di connessioni che misura l'attesa di ogni checkout, per dimensionare il pool guardando le metriche
+#il profilo è un attributo di classe (vedi classe_pool) cosi resta anche nel pool ricreato da engine.dispose()
+class PoolMisurato(AsyncAdaptedQueuePool):
+    profilo = "api"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.attesa = metrics.DB_POOL_WAIT.labels(self.profilo)
+        self.timeout_scaduti = metrics.DB_POOL_TIMEOUTS.labels(self.profilo)
+        metrics.DB_POOL_CHECKED_OUT.labels(self.profilo).set_function(self.checkedout)
+        metrics.DB_POOL_OVERFLOW.labels(self.profilo).set_function(self.overflow)
+
+    def _do_get(self):
+        inizio = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeout_scaduti.inc()
+            raise
+        finally:
+            self.attesa.observe(time.perf_counter() - inizio)
+
+def classe_pool(profilo: str) -> type[PoolMisurato]:
+    return type(f"PoolMisurato_{profilo}", (PoolMisurato,), {"profilo": profilo})
+
+#parametri del pool per profilo: api e worker condividono timeout, pre-ping e recycle ma non le dimensioni
+def impostazioni_pool(profilo: str) -> dict:
+    if profilo == "worker":
+        dimensioni = {"pool_size": settings.WORKER_DB_POOL_SIZE, "max_overflow": settings.WORKER_DB_MAX_OVERFLOW}
+    else:
+        dimensioni = {"pool_size": settings.DB_POOL_SIZE, "max_overflow": settings.DB_MAX_OVERFLOW}
+    return {
+        **dimensioni,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+    }
+
 #un engine(motore) è ciò che contiene le connessioni al db
-engine = create_async_engine(DB_URL, echo=True) #echo serve per stampare tutte le query a terminale
+#con TRACING_ENABLED ogni query dell'engine ha il suo span (vedi instrumentation.traccia_query)
+def crea_engine(profilo: str, url: str = DB_URL):
+    engine = create_async_engine(
+        url,
+        echo=settings.DB_ECHO, #echo serve per stampare tutte le query a terminale
+        poolclass=classe_pool(profilo),
+        connect_args={
+            #cache dei prepared statement di asyncpg, sia quella del driver che quella dell'adattatore di sqlalchemy
+            "statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+            "prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+        },
+        **impostazioni_pool(profilo),
+    )
+    traccia_query(engine)
+    return engine
+
+engine = crea_engine(settings.DB_PROFILE)
 
 #mentre l'engine è la connessione fisica al db, la session è l'area di lavoro temporanea
 SessionLocal = async_sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession)
 
+#da chiamare all'avvio di un processo che non è un'api (es. il worker), prima di aprire qualsiasi sessione
+def usa_profilo(profilo: str):
+    global engine
+    engine = crea_engine(profilo)
+    SessionLocal.configure(bind=engine)
+
+#LETTURE SULLA REPLICA
+#gli endpoint di sola lettura usano get_read_db: la sessione sceglie replica o primario alla prima query
+#(non alla creazione, perchè l'utente è noto solo dopo get_current_user) e poi resta su quella scelta
+#va sul primario se la replica non è configurata, se è in ritardo di più di REPLICA_MAX_LAG o non risponde,
+#o se l'utente ha fatto un commit negli ultimi READ_YOUR_WRITES_WINDOW secondi (read-your-writes)
+replica_engine = crea_engine(f"{settings.DB_PROFILE}_replica", REPLICA_URL) if REPLICA_URL else None
+
+#utente della richiesta in corso, impostato da oauth2.get_current_user
+utente_corrente: ContextVar[int | None] = ContextVar("utente_corrente", default=None)
+
+#ultimo ritardo misurato della replica in secondi (None = non raggiungibile) e quando è stato misurato
+ritardo_replica: float | None = None
+ultima_misura_replica = 0.0
+
+#utenti con un commit recente -> istante (monotonic) fino a cui leggono dal primario
+#è una struttura in memoria di ogni processo, tenuta allineata tra i processi con il canale pub/sub SCRITTURE_CHANNEL
+scritture_recenti: dict[int, float] = {}
+SCRITTURE_CHANNEL = "scritture_recenti"
+
+#sceglie dove leggere, restituisce (destinazione, motivo)
+def scegli_lettura(user_id: int | None) -> tuple[str, str]:
+    if replica_engine is None:
+        return "primary", "no_replica"
+    adesso = time.monotonic()
+    if user_id is not None and scritture_recenti.get(user_id, 0) > adesso:
+        return "primary", "read_your_writes"
+    #una misura troppo vecchia vuol dire che il controllo del ritardo non sta funzionando: non ci fidiamo della replica
+    if ritardo_replica is None or ritardo_replica > settings.REPLICA_MAX_LAG or adesso - ultima_misura_replica > 3 * settings.REPLICA_LAG_CHECK_INTERVAL:
+        return "primary", "replica_lag"
+    return "replica", "ok"
+
+#sessione di sola lettura: get_bind viene chiamato da sqlalchemy prima di ogni query, la scelta avviene alla prima
+class SessioneLettura(Session):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        bind = self.info.get("bind")
+        if bind is None:
+            destinazione, motivo = scegli_lettura(utente_corrente.get())
+            metrics.DB_READ_ROUTING.labels(destinazione, motivo).inc()
+            bind = self.info["bind"] = (replica_engine if destinazione == "replica" else engine).sync_engine
+        return bind
+
+ReadSessionLocal = async_sessionmaker(autocommit=False, autoflush=False, sync_session_class=SessioneLettura, class_=AsyncSession)
+
+#task in background avviato nel lifespan delle api: misura il ritardo della replica ad intervalli fissi
+#su un server che non è in recovery (es. un secondo postgres usato come stand-in) il ritardo è 0
+async def controlla_ritardo_replica():
+    global ritardo_replica, ultima_misura_replica
+    query = text("""
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END
+    """)
+    while True:
+        try:
+            async with replica_engine.connect() as conn:
+                ritardo_replica = float((await conn.execute(query)).scalar())
+        except Exception as e:
+            print(f"Errore nel controllo del ritardo della replica: {e}")
+            ritardo_replica = None
+        ultima_misura_replica = time.monotonic()
+        await asyncio.sleep(settings.REPLICA_LAG_CHECK_INTERVAL)
+
+#segna l'utente come "scrittore recente" in questo processo e lo comunica agli altri processi
+def segna_scrittura(user_id: int):
+    if replica_engine is None:
+        return
+    scritture_recenti[user_id] = time.monotonic() + settings.READ_YOUR_WRITES_WINDOW
+    if utils.redis_client:
+        try:
+            asyncio.get_running_loop().create_task(pubblica_scrittura(user_id))
+        except RuntimeError:
+            pass
+
+async def pubblica_scrittura(user_id: int):
+    try:
+        await utils.redis_client.publish(SCRITTURE_CHANNEL, str(user_id))
+    except Exception as e:
+        print(f"Errore Redis nella pubblicazione di una scrittura: {e}")
+
+#iscrizione al canale delle scritture degli altri processi (vedi streaming.RedisFanout), registrata nel lifespan
+class ScrittureRecenti:
+    def pubblica(self, canale: str, messaggio: str):
+        scritture_recenti[int(messaggio)] = time.monotonic() + settings.READ_YOUR_WRITES_WINDOW
+        #pulizia delle voci scadute, cosi il dizionario non cresce con il numero di utenti
+        if len(scritture_recenti) > 10_000:
+            adesso = time.monotonic()
+            for user_id in [user_id for user_id, scadenza in scritture_recenti.items() if scadenza <= adesso]:
+                del scritture_recenti[user_id]
+
+#una sessione ha scritto se ha fatto un flush dell'ORM o un insert/update/delete esplicito
+#dopo il commit l'utente della richiesta diventa "scrittore recente"; le sessioni del worker non hanno un utente corrente
+@event.listens_for(Session, "after_flush")
+def segna_flush(session, flush_context):
+    session.info["ha_scritto"] = True
+
+@event.listens_for(Session, "do_orm_execute")
+def segna_dml(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["ha_scritto"] = True
+
+@event.listens_for(Session, "after_commit")
+def dopo_commit(session):
+    if session.info.pop("ha_scritto", False):
+        user_id = utente_corrente.get()
+        if user_id is not None:
+            segna_scrittura(user_id)
+
+@event.listens_for(Session, "after_rollback")
+def dopo_rollback(session):
+    session.info.pop("ha_scritto", None)
+
 #declarative_base è una funzione che restituisce una classe base, tutte le tabelle erediteranno da questa classe
 Base = declarative_base()
 
@@ -21,3 +208,8 @@ async def get_db():
     async with SessionLocal() as session: #crea una nuova sessione e la apre
         yield session #consegna la sessione alla funzione che la richiede e mette in pausa fino alla chiusura quando la richiesta finisce
 
+
+#sessione per gli endpoint di sola lettura, sulla replica quando possibile
+async def get_read_db():
+    async with ReadSessionLocal() as session:
+        yield session
@@ -0,0 +1,122 @@
+import asyncio
+import csv
+import io
+from typing import AsyncIterator
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+from fastapi.responses import StreamingResponse
+from .config import settings
+
+#formati dell'estratto conto (GET /transactions/export): ogni blocco di righe letto dal cursore lato server
+#viene serializzato e inviato subito, quindi in memoria c'è sempre al massimo un blocco, qualunque sia la lunghezza dello storico
+#gli importi restano numeric esatti: stringhe in csv e ndjson, decimal(18, 8) in parquet
+
+COLONNE = ("id", "created_at", "type", "asset", "amount", "price_at_the_moment", "total_payed", "status", "currency")
+
+MEDIA_TYPE = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+#ogni esportazione tiene una connessione del pool delle api per tutta la sua durata (anche minuti):
+#al massimo EXPORT_MAX_CONCURRENT per processo, cosi le esportazioni non tolgono connessioni ai trade
+esportazioni = asyncio.Semaphore(settings.EXPORT_MAX_CONCURRENT)
+
+#risposta di un'esportazione: il posto nel semaforo lo prende l'handler e lo libera la chiusura del corpo, ma se il client
+#si disconnette prima degli header starlette non fa partire il corpo (e non esegue nemmeno un BackgroundTask),
+#quindi lo liberiamo anche alla fine dell'invio; rilascia deve essere idempotente
+class RispostaEsportazione(StreamingResponse):
+    def __init__(self, *args, rilascia, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rilascia = rilascia
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.rilascia()
+
+#notazione decimale anche per gli importi piccoli (str(Decimal("0.00000001")) è "1E-8")
+def numero(valore) -> str:
+    return format(valore, "f")
+
+async def esporta_csv(blocchi: AsyncIterator[list], valuta: str) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    scrittore = csv.writer(buffer, lineterminator="\n")
+    scrittore.writerow(COLONNE)
+    async for righe in blocchi:
+        for riga in righe:
+            scrittore.writerow((riga.id, riga.created_at.isoformat(), riga.type, riga.asset, numero(riga.amount),
+                                numero(riga.price_at_the_moment), numero(riga.total_payed), riga.status, valuta))
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    #storico vuoto: solo l'intestazione
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+async def esporta_ndjson(blocchi: AsyncIterator[list], valuta: str) -> AsyncIterator[bytes]:
+    async for righe in blocchi:
+        yield b"".join(orjson.dumps({
+            "id": riga.id,
+            "created_at": riga.created_at,
+            "type": riga.type,
+            "asset": riga.asset,
+            "amount": numero(riga.amount),
+            "price_at_the_moment": numero(riga.price_at_the_moment),
+            "total_payed": numero(riga.total_payed),
+            "status": riga.status,
+            "currency": valuta,
+        }, option=orjson.OPT_APPEND_NEWLINE) for riga in righe)
+
+
+#file di destinazione per il ParquetWriter: tiene i byte scritti fino al prossimo invio e la posizione nel file,
+#che parquet usa per gli offset dei row group nel footer
+class UscitaParquet(io.RawIOBase):
+    def __init__(self):
+        self.parti: list[bytes] = []
+        self.posizione = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, dati) -> int:
+        self.parti.append(bytes(dati))
+        self.posizione += len(dati)
+        return len(dati)
+
+    def tell(self) -> int:
+        return self.posizione
+
+    def svuota(self) -> bytes:
+        dati = b"".join(self.parti)
+        self.parti.clear()
+        return dati
+
+#un row group per blocco; il footer con lo schema e gli offset arriva alla chiusura, quindi il file è valido solo se completo
+async def esporta_parquet(blocchi: AsyncIterator[list], valuta: str) -> AsyncIterator[bytes]:
+    schema = pa.schema([
+        ("id", pa.int64()),
+        ("created_at", pa.timestamp("us", tz="UTC")),
+        ("type", pa.string()),
+        ("asset", pa.string()),
+        ("amount", pa.decimal128(18, 8)),
+        ("price_at_the_moment", pa.decimal128(18, 8)),
+        ("total_payed", pa.decimal128(18, 8)),
+        ("status", pa.string()),
+        ("currency", pa.string()),
+    ])
+    uscita = UscitaParquet()
+    scrittore = pq.ParquetWriter(uscita, schema, compression=settings.EXPORT_PARQUET_COMPRESSION)
+    async for righe in blocchi:
+        colonne = {colonna: [getattr(riga, colonna) for riga in righe] for colonna in COLONNE[:-1]}
+        colonne["currency"] = [valuta] * len(righe)
+        scrittore.write_table(pa.table(colonne, schema=schema))
+        yield uscita.svuota()
+    scrittore.close()
+    yield uscita.svuota()
+
+ESPORTATORI = {"csv": esporta_csv, "ndjson": esporta_ndjson, "parquet": esporta_parquet}
@@ -0,0 +1,108 @@
+import asyncio
+from datetime import timedelta
+from decimal import Decimal
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from . import database, ledger, metrics, models, utils
+from .cache import SingleFlight, TTLCache
+from .config import settings
+
+#cambi tra la valuta dei prezzi (PRICE_QUOTE_CURRENCY, gli USDT di binance) e le valute dei wallet
+#un cambio è quante unità della valuta vale 1 USDT, quindi prezzo nel wallet = prezzo binance * cambio
+#il poller dei cambi li legge da binance (coppie {valuta}USDT), li salva su redis e nella tabella fx_rates;
+#le api li leggono da una cache in-process, poi da redis e solo se manca anche quello dal db
+FX_KEY = "cambio:{}"
+POLLER_LOCK_KEY = "poller_cambi"
+
+cache_cambi = TTLCache(max_size=len(settings.SUPPORTED_CURRENCIES) + 1, ttl=settings.FX_CACHE_TTL)
+letture_cambi = SingleFlight()
+
+#cambio della valuta, None se non è disponibile o se l'ultimo valore noto è più vecchio di FX_MAX_AGE
+async def get_cambio(valuta: str) -> Decimal | None:
+    if valuta == settings.PRICE_QUOTE_CURRENCY:
+        return Decimal(1)
+    voce = cache_cambi.get(valuta)
+    if voce:
+        metrics.CACHE_REQUESTS.labels("fx", "hit").inc()
+        return voce[0]
+    task, _ = letture_cambi.esegui(valuta, lambda: carica_cambio(valuta))
+    return await asyncio.shield(task)
+
+async def carica_cambio(valuta: str) -> Decimal | None:
+    if utils.redis_client:
+        try:
+            salvato = await utils.redis_client.get(FX_KEY.format(valuta))
+            if salvato:
+                cambio = Decimal(salvato)
+                cache_cambi.set(valuta, cambio)
+                metrics.CACHE_REQUESTS.labels("fx", "redis").inc()
+                return cambio
+        except Exception as e:
+            print(f"Errore Redis nella lettura del cambio {valuta}: {e}")
+
+    metrics.CACHE_REQUESTS.labels("fx", "db").inc()
+    async with database.SessionLocal() as db:
+        result = await db.execute(select(models.FxRate.rate).where(
+            models.FxRate.currency == valuta,
+            models.FxRate.updated_at >= func.now() - timedelta(seconds=settings.FX_MAX_AGE)
+        ))
+        cambio = result.scalar_one_or_none()
+    if cambio is not None:
+        cache_cambi.set(valuta, cambio)
+    return cambio
+
+#prezzo di un asset nella valuta di un wallet, arrotondato a 8 decimali come i saldi
+async def prezzo_in_valuta(ticker: str, valuta: str) -> Decimal | None:
+    prezzo = await utils.get_real_price(ticker)
+    if prezzo is None:
+        return None
+    cambio = await get_cambio(valuta)
+    if cambio is None:
+        return None
+    return ledger.arrotonda(prezzo * cambio)
+
+
+#task in background avviato nel lifespan, come il poller dei prezzi ma molto meno frequente
+#con più processi solo quello che ottiene il lock chiama binance, gli altri trovano i cambi su redis quando la loro cache scade
+async def aggiorna_cambi_periodicamente():
+    valute = [valuta for valuta in settings.SUPPORTED_CURRENCIES if valuta != settings.PRICE_QUOTE_CURRENCY]
+    while valute:
+        try:
+            await aggiorna_cambi(valute)
+        except Exception as e:
+            print(f"Errore nel poller dei cambi: {e}")
+        await asyncio.sleep(settings.FX_POLL_INTERVAL)
+
+async def aggiorna_cambi(valute: list[str]):
+    if utils.redis_client:
+        try:
+            if not await utils.redis_client.set(POLLER_LOCK_KEY, "1", nx=True, px=int(settings.FX_POLL_INTERVAL * 900)):
+                return
+        except Exception as e:
+            print(f"Errore Redis nel poller dei cambi: {e}")
+
+    #binance quota la valuta in USDT (EURUSDT = USDT per 1 EUR), a noi serve l'inverso
+    prezzi = await utils.get_binance_prices(valute)
+    cambi = {valuta: ledger.arrotonda(1 / prezzo) for valuta, prezzo in prezzi.items() if prezzo}
+    if not cambi:
+        return
+
+    for valuta, cambio in cambi.items():
+        cache_cambi.set(valuta, cambio)
+    if utils.redis_client:
+        try:
+            async with utils.redis_client.pipeline(transaction=False) as pipe:
+                for valuta, cambio in cambi.items():
+                    pipe.setex(name=FX_KEY.format(valuta), time=settings.FX_REDIS_TTL, value=str(cambio))
+                await pipe.execute()
+        except Exception as e:
+            print(f"Errore Redis nel salvataggio dei cambi: {e}")
+
+    async with database.SessionLocal() as db:
+        query = insert(models.FxRate).values([{"currency": valuta, "rate": cambio} for valuta, cambio in cambi.items()])
+        query = query.on_conflict_do_update(
+            index_elements=[models.FxRate.currency],
+            set_={"rate": query.excluded.rate, "updated_at": func.now()}
+        )
+        await db.execute(query)
+        await db.commit()
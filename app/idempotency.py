@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import time
+import orjson
+from fastapi import HTTPException, Response, status
+from pydantic import BaseModel
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import metrics, models, utils
+from .config import settings
+
+#chiavi di idempotenza per gli endpoint che muovono soldi (deposit, withdrawal, trade)
+#il client manda l'header Idempotency-Key: la prima richiesta con quella chiave viene eseguita e la sua risposta salvata
+#nella tabella idempotency_keys, nella stessa transazione del movimento, e dopo il commit su redis (idempotenza:{utente}:{chiave})
+#una richiesta ripetuta riceve la risposta salvata: da redis senza toccare postgres, dal db se redis non la ha più
+#mentre la prima è in corso su redis c'è un segnaposto e le copie concorrenti aspettano il suo esito invece di eseguire;
+#senza redis le copie concorrenti si fermano sull'insert della stessa chiave finchè la prima non fa commit, poi leggono la sua risposta
+#si salvano solo le risposte riuscite: se il movimento fallisce (es. saldo insufficiente) la chiave si può riusare
+IDEMPOTENCY_KEY = "idempotenza:{}:{}"
+MAX_LUNGHEZZA_CHIAVE = 255
+
+
+#una richiesta con Idempotency-Key: chi la fa, con quale chiave e l'impronta di endpoint e corpo
+class RichiestaIdempotente:
+    __slots__ = ("user_id", "chiave", "endpoint", "impronta", "segnaposto", "risposta")
+
+    def __init__(self, user_id: int, chiave: str, endpoint: str, impronta: str):
+        self.user_id = user_id
+        self.chiave = chiave
+        self.endpoint = endpoint
+        self.impronta = impronta
+        #True se il segnaposto su redis è nostro e va tolto se il movimento fallisce
+        self.segnaposto = False
+        #risposta serializzata, pronta dopo salva()
+        self.risposta: str | None = None
+
+    @property
+    def chiave_redis(self) -> str:
+        return IDEMPOTENCY_KEY.format(self.user_id, self.chiave)
+
+
+#None se la richiesta non ha l'header, cosi gli endpoint chiamano esegui() e salva() sempre allo stesso modo
+def richiesta(user_id: int, chiave: str | None, endpoint: str, corpo: BaseModel) -> RichiestaIdempotente | None:
+    if chiave is None:
+        return None
+    if not chiave or len(chiave) > MAX_LUNGHEZZA_CHIAVE:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Idempotency-Key deve avere tra 1 e {MAX_LUNGHEZZA_CHIAVE} caratteri")
+    dati = orjson.dumps({"endpoint": endpoint, "corpo": corpo.model_dump(mode="json")}, option=orjson.OPT_SORT_KEYS)
+    return RichiestaIdempotente(user_id, chiave, endpoint, hashlib.sha256(dati).hexdigest())
+
+
+#su redis il valore è "{impronta}:{risposta}", con la risposta vuota finchè la prima richiesta è in corso
+def codifica(impronta: str, risposta: str = "") -> str:
+    return f"{impronta}:{risposta}"
+
+def controlla_impronta(richiesta: RichiestaIdempotente, impronta: str):
+    if impronta != richiesta.impronta:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Idempotency-Key già usata per una richiesta diversa")
+
+#tutti gli endpoint idempotenti rispondono 202, la risposta salvata viene restituita senza riserializzarla
+def risposta_salvata(richiesta: RichiestaIdempotente, risposta: str, origine: str) -> Response:
+    metrics.IDEMPOTENCY_REPLAYS.labels(endpoint=richiesta.endpoint, source=origine).inc()
+    return Response(content=risposta, status_code=status.HTTP_202_ACCEPTED, media_type="application/json",
+                    headers={"Idempotent-Replayed": "true"})
+
+
+#prova a mettere il segnaposto su redis; se la chiave c'è già restituisce la risposta salvata oppure aspetta
+#che la richiesta in corso finisca: se riesce ne restituisce la risposta, se fallisce il segnaposto sparisce e si riprova a prenderlo
+#restituisce None quando tocca a noi eseguire, anche se redis non è disponibile
+async def prenota(richiesta: RichiestaIdempotente) -> str | None:
+    if not utils.redis_client:
+        return None
+    scadenza = time.monotonic() + settings.IDEMPOTENCY_WAIT
+    while True:
+        try:
+            if await utils.redis_client.set(richiesta.chiave_redis, codifica(richiesta.impronta), nx=True,
+                                            px=int(settings.IDEMPOTENCY_LOCK_TTL * 1000)):
+                richiesta.segnaposto = True
+                return None
+            valore = await utils.redis_client.get(richiesta.chiave_redis)
+        except Exception as e:
+            print(f"Errore Redis nella prenotazione della chiave di idempotenza: {e}")
+            return None
+
+        if valore is not None:
+            impronta, _, risposta = valore.partition(":")
+            controlla_impronta(richiesta, impronta)
+            if risposta:
+                return risposta
+        if time.monotonic() >= scadenza:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail="Una richiesta con la stessa Idempotency-Key è ancora in corso",
+                                headers={"Retry-After": "1"})
+        await asyncio.sleep(settings.IDEMPOTENCY_POLL_INTERVAL)
+
+async def leggi_dal_db(db: AsyncSession, richiesta: RichiestaIdempotente) -> str | None:
+    result = await db.execute(select(models.IdempotencyKey.fingerprint, models.IdempotencyKey.response).where(
+        models.IdempotencyKey.user_id == richiesta.user_id,
+        models.IdempotencyKey.key == richiesta.chiave
+    ))
+    riga = result.one_or_none()
+    if not riga:
+        return None
+    controlla_impronta(richiesta, riga.fingerprint)
+    return riga.response
+
+async def salva_su_redis(richiesta: RichiestaIdempotente, risposta: str):
+    if not utils.redis_client:
+        return
+    try:
+        await utils.redis_client.setex(name=richiesta.chiave_redis, time=settings.IDEMPOTENCY_TTL,
+                                       value=codifica(richiesta.impronta, risposta))
+    except Exception as e:
+        print(f"Errore Redis nel salvataggio della risposta idempotente: {e}")
+
+async def libera(richiesta: RichiestaIdempotente):
+    if not richiesta.segnaposto:
+        return
+    try:
+        await utils.redis_client.delete(richiesta.chiave_redis)
+    except Exception as e:
+        print(f"Errore Redis nel rilascio della chiave di idempotenza: {e}")
+
+
+#da chiamare nel movimento prima del commit: la chiave e la risposta entrano nella stessa transazione del movimento
+async def salva(db: AsyncSession, richiesta: RichiestaIdempotente | None, risposta: BaseModel):
+    if richiesta is None:
+        return
+    richiesta.risposta = risposta.model_dump_json()
+    db.add(models.IdempotencyKey(
+        user_id = richiesta.user_id,
+        key = richiesta.chiave,
+        endpoint = richiesta.endpoint,
+        fingerprint = richiesta.impronta,
+        response = richiesta.risposta,
+    ))
+    await db.flush()
+
+#solo la violazione della chiave primaria di idempotency_keys vuol dire che un'altra esecuzione ha salvato la stessa chiave;
+#gli altri errori di integrità (foreign key, check) sono del movimento e vanno restituiti cosi come sono
+#sqlstate arriva dall'adattatore asyncpg di sqlalchemy, il nome del vincolo dall'eccezione originale di asyncpg
+VINCOLO_CHIAVE = "idempotency_keys_pkey"
+
+def chiave_duplicata(errore: IntegrityError) -> bool:
+    return getattr(errore.orig, "sqlstate", None) == "23505" and \
+        getattr(errore.orig.__cause__, "constraint_name", None) == VINCOLO_CHIAVE
+
+#esegue il movimento una volta sola per chiave; senza header lo esegue e basta
+async def esegui(db: AsyncSession, richiesta: RichiestaIdempotente | None, movimento):
+    if richiesta is None:
+        return await movimento()
+
+    salvata = await prenota(richiesta)
+    if salvata is not None:
+        return risposta_salvata(richiesta, salvata, "redis")
+    if not richiesta.segnaposto:
+        #redis non disponibile: prima di eseguire guardiamo se la chiave è già nel db
+        salvata = await leggi_dal_db(db, richiesta)
+        if salvata is not None:
+            return risposta_salvata(richiesta, salvata, "db")
+
+    try:
+        risultato = await movimento()
+    except IntegrityError as errore:
+        if not chiave_duplicata(errore):
+            await libera(richiesta)
+            raise
+        #un'altra esecuzione con la stessa chiave ha fatto commit prima di noi (segnaposto scaduto, redis non disponibile
+        #o risposta già sparita da redis): la nostra è stata annullata e restituiamo la sua risposta
+        await db.rollback()
+        salvata = await leggi_dal_db(db, richiesta)
+        if salvata is None:
+            await libera(richiesta)
+            raise
+        await salva_su_redis(richiesta, salvata)
+        return risposta_salvata(richiesta, salvata, "db")
+    except BaseException:
+        await libera(richiesta)
+        raise
+
+    if richiesta.risposta is None:
+        await libera(richiesta)
+    else:
+        await salva_su_redis(richiesta, richiesta.risposta)
+    return risultato
@@ -0,0 +1,86 @@
+import functools
+import time
+from sqlalchemy import event
+from . import metrics
+from .config import settings
+
+#strumentazione del percorso caldo: istogrammi di latenza per rotta e span opentelemetry opzionali
+#pensata per restare accesa in produzione: per richiesta costa due perf_counter e un observe (qualche microsecondo),
+#gli span si attivano solo con TRACING_ENABLED e il pacchetto opentelemetry-api installato, altrimenti non costano nulla
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+tracer = trace.get_tracer("exchange") if trace is not None and settings.TRACING_ENABLED else None
+
+
+#middleware ASGI che misura la durata di ogni richiesta http per metodo, rotta e status
+#la rotta è il template (es. /orders/{order_id}) messo nello scope da fastapi dopo il routing, cosi le etichette restano poche;
+#le richieste che non corrispondono a nessuna rotta finiscono tutte sotto "unmatched"
+#per le rotte in streaming (/prices/stream) la durata è quella della connessione
+class RouteMetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.HTTP_METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        codice = 500
+        async def send_con_status(messaggio):
+            nonlocal codice
+            if messaggio["type"] == "http.response.start":
+                codice = messaggio["status"]
+            await send(messaggio)
+
+        inizio = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_con_status)
+        finally:
+            rotta = getattr(scope.get("route"), "path", "unmatched")
+            metrics.HTTP_REQUEST_DURATION.labels(scope["method"], rotta, str(codice)).observe(time.perf_counter() - inizio)
+
+
+#decoratore per le funzioni async del percorso caldo (get_real_price, get_current_user):
+#senza tracing restituisce la funzione cosi com'è. functools.wraps mantiene la firma, che serve a fastapi per le dipendenze
+def traccia(nome: str):
+    def decoratore(funzione):
+        if tracer is None:
+            return funzione
+
+        @functools.wraps(funzione)
+        async def tracciata(*args, **kwargs):
+            with tracer.start_as_current_span(nome):
+                return await funzione(*args, **kwargs)
+        return tracciata
+    return decoratore
+
+#uno span per ogni query eseguita dall'engine (ORM o sql diretto), figlio dello span della richiesta
+#lo span vive sul contesto di esecuzione di sqlalchemy tra before_cursor_execute e after_cursor_execute/handle_error
+def traccia_query(engine):
+    if tracer is None:
+        return
+
+    def inizio_query(conn, cursor, statement, parameters, context, executemany):
+        span = tracer.start_span(f"db {statement.split(None, 1)[0].upper()}" if statement else "db")
+        span.set_attribute("db.system", "postgresql")
+        span.set_attribute("db.statement", statement[:settings.TRACING_MAX_STATEMENT])
+        context._span_query = span
+
+    def fine_query(conn, cursor, statement, parameters, context, executemany):
+        span = getattr(context, "_span_query", None)
+        if span is not None:
+            span.end()
+
+    def errore_query(contesto_eccezione):
+        span = getattr(contesto_eccezione.execution_context, "_span_query", None)
+        if span is not None:
+            span.record_exception(contesto_eccezione.original_exception)
+            span.set_status(trace.Status(trace.StatusCode.ERROR))
+            span.end()
+
+    event.listen(engine.sync_engine, "before_cursor_execute", inizio_query)
+    event.listen(engine.sync_engine, "after_cursor_execute", fine_query)
+    event.listen(engine.sync_engine, "handle_error", errore_query)
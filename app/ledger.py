@@ -0,0 +1,141 @@
+import uuid
+from datetime import date, datetime
+from decimal import ROUND_HALF_UP, Decimal
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from . import models
+
+#libro mastro in partita doppia: ogni movimento di fondi è una scrittura con almeno due righe (postings)
+#che per ogni asset sommano a zero, le righe non vengono mai modificate nè cancellate
+#il saldo di un conto è la somma delle sue righe; l'importo è positivo quando il conto aumenta e negativo quando diminuisce
+#le righe vanno scritte nella stessa transazione del db che modifica wallets.balance e holdings
+
+#conti: WALLET è il saldo disponibile del wallet (valuta e crypto), RESERVED i fondi bloccati dagli ordini limite aperti,
+#EXTERNAL il mondo esterno (la banca da cui arrivano depositi e verso cui vanno i prelievi),
+#MARKET la controparte dei trade eseguiti al prezzo di mercato
+WALLET = "WALLET"
+RESERVED = "RESERVED"
+EXTERNAL = "EXTERNAL"
+MARKET = "MARKET"
+#wallet_id dei conti di sistema (EXTERNAL e MARKET), che non appartengono a nessun utente
+SISTEMA = 0
+#valuta dei wallet che non esistono più (stesso default di models.Wallet.currency)
+VALUTA_PREDEFINITA = "EUR"
+
+OTTO_DECIMALI = Decimal("0.00000001")
+
+#gli importi vengono arrotondati qui, prima di scriverli sia nel mastro che nei saldi,
+#cosi il db non arrotonda per conto suo e i due restano identici
+def arrotonda(valore) -> Decimal:
+    return Decimal(valore).quantize(OTTO_DECIMALI, rounding=ROUND_HALF_UP)
+
+#crea le righe di una scrittura, gambe = (conto, wallet_id, asset, importo); le gambe a zero vengono saltate
+def scrittura(tipo: str, gambe: list[tuple[str, int, str, Decimal]], transaction_id: int | None = None, order_id: str | None = None) -> list[dict]:
+    entry_id = uuid.uuid4().hex
+    righe = []
+    totali = {}
+    for conto, wallet_id, asset, importo in gambe:
+        importo = arrotonda(importo)
+        if not importo:
+            continue
+        totali[asset] = totali.get(asset, 0) + importo
+        righe.append({"entry_id": entry_id, "entry_type": tipo, "account": conto, "wallet_id": wallet_id, "asset": asset,
+                      "amount": importo, "transaction_id": transaction_id, "order_id": order_id})
+    if any(totali.values()):
+        raise ValueError(f"Scrittura {tipo} non bilanciata: {totali}")
+    return righe
+
+def deposito(wallet_id: int, valuta: str, importo: Decimal, transaction_id: int) -> list[dict]:
+    return scrittura("DEPOSIT", [(WALLET, wallet_id, valuta, importo), (EXTERNAL, SISTEMA, valuta, -importo)], transaction_id)
+
+def prelievo(wallet_id: int, valuta: str, importo: Decimal, transaction_id: int) -> list[dict]:
+    return scrittura("WITHDRAWAL", [(WALLET, wallet_id, valuta, -importo), (EXTERNAL, SISTEMA, valuta, importo)], transaction_id)
+
+#trade al prezzo di mercato: una gamba in valuta e una nell'asset, entrambe con il mercato come controparte
+def scambio(tipo: str, wallet_id: int, valuta: str, asset: str, quantita: Decimal, totale: Decimal,
+            transaction_id: int | None = None, order_id: str | None = None) -> list[dict]:
+    segno = 1 if tipo == "BUY" else -1
+    return scrittura(tipo, [
+        (WALLET, wallet_id, valuta, -segno * totale),
+        (MARKET, SISTEMA, valuta, segno * totale),
+        (WALLET, wallet_id, asset, segno * quantita),
+        (MARKET, SISTEMA, asset, -segno * quantita),
+    ], transaction_id, order_id)
+
+#sposta fondi tra saldo disponibile e riservato di un wallet (importo negativo = restituzione)
+def riserva(wallet_id: int, asset: str, importo: Decimal, order_id: str) -> list[dict]:
+    return scrittura("RESERVE" if importo > 0 else "RELEASE", [(WALLET, wallet_id, asset, -importo), (RESERVED, wallet_id, asset, importo)], order_id=order_id)
+
+async def registra(db: AsyncSession, righe: list[dict]):
+    if righe:
+        await db.execute(insert(models.Posting), righe)
+
+
+#saldi di un conto per asset in un istante qualsiasi (ora se al è None):
+#ultimo snapshot non successivo ad al più le righe tra lo snapshot e al, quindi il costo dipende solo dalle righe dopo lo snapshot
+async def saldi_al(db: AsyncSession, wallet_id: int, al: datetime | None = None, conto: str = WALLET) -> dict[str, Decimal]:
+    result = await db.execute(text("""
+        WITH istante AS (SELECT COALESCE(CAST(:al AS timestamptz), now()) AS al),
+        ultimi AS (
+            SELECT DISTINCT ON (asset) asset, as_of, balance
+            FROM ledger_snapshots, istante
+            WHERE account = :conto AND wallet_id = :wallet_id AND as_of <= istante.al
+            ORDER BY asset, as_of DESC
+        )
+        SELECT asset, SUM(importo) AS saldo FROM (
+            SELECT asset, balance AS importo FROM ultimi
+            UNION ALL
+            SELECT p.asset, p.amount
+            FROM postings p CROSS JOIN istante LEFT JOIN ultimi u ON u.asset = p.asset
+            WHERE p.account = :conto AND p.wallet_id = :wallet_id AND p.created_at <= istante.al
+              AND (u.as_of IS NULL OR p.created_at > u.as_of)
+        ) movimenti
+        GROUP BY asset
+    """), {"conto": conto, "wallet_id": wallet_id, "al": al})
+    return {riga.asset: riga.saldo for riga in result.all()}
+
+
+#PARTIZIONI MENSILI
+#postings è partizionata per mese su created_at: gli insert toccano solo la partizione corrente e il vacuum
+#lavora su tabelle piccole; le partizioni vanno create in anticipo (scripts/ledger_snapshot.py),
+#la partizione di default raccoglie le righe che non trovano un mese
+def nome_partizione(mese: date) -> str:
+    return f"postings_{mese.year}_{mese.month:02d}"
+
+def mese_successivo(mese: date) -> date:
+    return date(mese.year + mese.month // 12, mese.month % 12 + 1, 1)
+
+async def crea_partizioni(conn: AsyncConnection, da: date, mesi: int) -> list[str]:
+    create = []
+    mese = date(da.year, da.month, 1)
+    for _ in range(mesi):
+        successivo = mese_successivo(mese)
+        await conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {nome_partizione(mese)} PARTITION OF postings "
+            f"FOR VALUES FROM ('{mese.isoformat()}') TO ('{successivo.isoformat()}')"
+        ))
+        create.append(nome_partizione(mese))
+        mese = successivo
+    return create
+
+#nuovo snapshot dei saldi all'istante as_of per ogni conto che si è mosso dopo il suo ultimo snapshot
+#as_of deve essere abbastanza nel passato da non avere più transazioni aperte con righe precedenti (vedi lo script)
+async def crea_snapshot(conn: AsyncConnection, as_of: datetime) -> int:
+    result = await conn.execute(text("""
+        WITH ultimi AS (
+            SELECT DISTINCT ON (account, wallet_id, asset) account, wallet_id, asset, as_of, balance
+            FROM ledger_snapshots
+            ORDER BY account, wallet_id, asset, as_of DESC
+        ),
+        delta AS (
+            SELECT p.account, p.wallet_id, p.asset, SUM(p.amount) AS amount
+            FROM postings p LEFT JOIN ultimi u USING (account, wallet_id, asset)
+            WHERE p.created_at <= :as_of AND (u.as_of IS NULL OR p.created_at > u.as_of)
+            GROUP BY p.account, p.wallet_id, p.asset
+        )
+        INSERT INTO ledger_snapshots (account, wallet_id, asset, as_of, balance)
+        SELECT d.account, d.wallet_id, d.asset, :as_of, COALESCE(u.balance, 0) + d.amount
+        FROM delta d LEFT JOIN ultimi u USING (account, wallet_id, asset)
+        ON CONFLICT DO NOTHING
+    """), {"as_of": as_of})
+    return result.rowcount
@@ -1,10 +1,13 @@
-from contextlib import asynccontextmanager
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.routers import transactions, users, auth
-from .database import engine
-from . import models
+from app.routers import transactions, users, auth, metrics, prices, orders, book, candles, ledger, portfolio
+from .config import settings
+from . import database, fx, models, utils, streaming, oauth2
+from .instrumentation import RouteMetricsMiddleware
+from .ratelimit import RateLimitMiddleware
 from fastapi.responses import ORJSONResponse
 
 #definiamo la logica che deve essere eseguita prima dell'avvio dell'applicazione
@@ -15,14 +18,54 @@ async def lifespan(app: FastAPI):
     #qui avvio l'engine, e creo le tabelle del database se non esistono già, prima di integrare alembic
     #async with engine.begin() as conn:
     #     await conn.run_sync(models.Base.metadata.create_all)
+
+    #ogni processo ascolta le invalidazioni della cache degli utenti autenticati fatte dagli altri processi
+    invalidazioni = oauth2.InvalidazionePrincipal()
+    if streaming.hub.disponibile:
+        try:
+            await streaming.hub.iscrivi(invalidazioni, [oauth2.PRINCIPAL_INVALIDATION_CHANNEL])
+        except Exception as e:
+            print(f"Impossibile iscriversi alle invalidazioni della cache utenti: {e}")
+
+    #letture sulla replica: misura del ritardo e scritture recenti degli utenti fatte sugli altri processi
+    controllo_replica = None
+    if database.replica_engine is not None:
+        controllo_replica = asyncio.create_task(database.controlla_ritardo_replica())
+        if streaming.hub.disponibile:
+            try:
+                await streaming.hub.iscrivi(database.ScrittureRecenti(), [database.SCRITTURE_CHANNEL])
+            except Exception as e:
+                print(f"Impossibile iscriversi alle scritture recenti: {e}")
+
+    #client http condiviso per binance e poller dei prezzi in background
+    utils.http_client = utils.crea_http_client()
+    poller = None
+    poller_cambi = None
+    if settings.PRICE_POLLER_ENABLED:
+        poller = asyncio.create_task(utils.aggiorna_prezzi_periodicamente())
+        poller_cambi = asyncio.create_task(fx.aggiorna_cambi_periodicamente())
     yield
     #istruzioni da eseguire dopo l'arresto
-    #spegniamo l'engine
-    engine.dispose()
+    #fermiamo il poller e il fan-out dei canali redis, chiudiamo il client http e spegniamo l'engine
+    await streaming.hub.chiudi()
+    for task in (poller, poller_cambi, controllo_replica):
+        if task:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+    await utils.http_client.aclose()
+    utils.http_client = None
+    utils.pool_password.shutdown(wait=False)
+    await database.engine.dispose()
+    if database.replica_engine is not None:
+        await database.replica_engine.dispose()
 
 
 app = FastAPI(lifespan= lifespan, default_response_class=ORJSONResponse)
 
+#rate limiting prima di routing, autenticazione e db; aggiunto prima del CORS cosi anche le risposte 429 hanno gli header CORS
+app.add_middleware(RateLimitMiddleware)
+
 #cors(condivisione delle risorse tra origini)
 origins = ["*"]#url che possono fare richieste a questa app
 
@@ -34,10 +77,20 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+#latenza per rotta, aggiunto per ultimo cosi è il più esterno e misura anche CORS e rate limiting
+app.add_middleware(RouteMetricsMiddleware)
+
 #impostiamo i routers
 app.include_router(users.router)
 app.include_router(auth.router)
 app.include_router(transactions.router)
+app.include_router(metrics.router)
+app.include_router(prices.router)
+app.include_router(orders.router)
+app.include_router(book.router)
+app.include_router(candles.router)
+app.include_router(ledger.router)
+app.include_router(portfolio.router)
 
 #api home
 app.get("/home")
@@ -0,0 +1,231 @@
+from bisect import bisect_left, insort
+from collections import deque
+from decimal import Decimal
+
+#motore di matching in memoria, un OrderBook per ogni asset
+#priorità prezzo-tempo: vince il prezzo migliore e, a parità di prezzo, l'ordine arrivato prima
+#il motore non fa I/O: riceve gli eventi (nuovo ordine, cancellazione) dal worker e restituisce gli eseguiti,
+#che il worker salva poi a batch nel db (vedi worker.py)
+
+#prezzi e quantità sono interi in unità da 1e-8 (la stessa precisione di Numeric(18, 8) nel db)
+#le operazioni sugli interi sono molto più veloci di quelle sui Decimal e non hanno errori di arrotondamento
+SCALA = 10 ** 8
+
+def a_unita(valore) -> int:
+    return int(Decimal(str(valore)) * SCALA)
+
+def da_unita(valore: int) -> Decimal:
+    return Decimal(valore) / SCALA
+
+#controvalore in unità di quantità * prezzo, arrotondato a 1e-8 (mezzo in su come ledger.arrotonda)
+#lo usano sia l'api per riservare i fondi di un BUY che il motore per sbloccarli, cosi le due somme coincidono
+def importo_unita(quantita: int, prezzo: int) -> int:
+    return (quantita * prezzo + SCALA // 2) // SCALA
+
+#per quanti eventi si ricorda una cancellazione arrivata prima del suo ordine (vedi OrderBook.cancella)
+ANNULLATI_PER_EVENTI = 100_000
+
+
+#ordine limite nel book, __slots__ per occupare poca memoria e rendere veloce l'accesso agli attributi
+class OrdineLimite:
+    __slots__ = ("id", "owner_id", "wallet_id", "lato", "prezzo", "quantita", "iniziale", "riservato")
+
+    def __init__(self, id: str, owner_id: int, wallet_id: int, lato: str, prezzo: int, quantita: int, iniziale: int | None = None,
+                 riservato: int | None = None):
+        self.id = id
+        self.owner_id = owner_id
+        self.wallet_id = wallet_id
+        #"BUY" o "SELL"
+        self.lato = lato
+        self.prezzo = prezzo
+        #quantità ancora da eseguire, 0 quando l'ordine è eseguito o cancellato
+        self.quantita = quantita
+        self.iniziale = quantita if iniziale is None else iniziale
+        #fondi ancora riservati dall'api per questo ordine: valuta per un BUY, quantità dell'asset per un SELL
+        if riservato is None:
+            riservato = importo_unita(quantita, prezzo) if lato == "BUY" else quantita
+        self.riservato = riservato
+
+    def come_lista(self) -> list:
+        return [self.id, self.owner_id, self.wallet_id, self.lato, self.prezzo, self.quantita, self.iniziale, self.riservato]
+
+
+#esecuzione tra un ordine già nel book (maker) e quello appena arrivato (taker), al prezzo del maker
+#sbloccato è la parte della riserva del compratore consumata, importo quello che va al venditore:
+#la differenza torna disponibile al compratore (aveva riservato al suo prezzo limite)
+class Eseguito:
+    __slots__ = ("maker", "taker", "prezzo", "quantita", "sbloccato", "importo")
+
+    def __init__(self, maker: OrdineLimite, taker: OrdineLimite, prezzo: int, quantita: int, sbloccato: int, importo: int):
+        self.maker = maker
+        self.taker = taker
+        self.prezzo = prezzo
+        self.quantita = quantita
+        self.sbloccato = sbloccato
+        self.importo = importo
+
+
+class OrderBook:
+    def __init__(self, asset: str):
+        self.asset = asset
+        #numero di eventi applicati, serve per snapshot/replay e per numerare gli aggiornamenti del book
+        self.seq = 0
+        #ordini ancora attivi nel book, per la cancellazione in O(1)
+        self.ordini: dict[str, OrdineLimite] = {}
+        #per ogni lato: prezzo -> coda FIFO degli ordini e prezzo -> quantità totale del livello
+        self.livelli = {"BUY": {}, "SELL": {}}
+        self.volumi = {"BUY": {}, "SELL": {}}
+        #prezzi dei livelli ordinati dal migliore: gli ask crescenti, i bid salvati negativi cosi sono crescenti anche loro
+        self.prezzi_ask: list[int] = []
+        self.prezzi_bid: list[int] = []
+        #livelli cambiati dall'ultimo estrai_diff, per pubblicare solo le differenze del book
+        self.modificati = {"BUY": set(), "SELL": set()}
+        #cancellazioni di ordini che non sono nel book -> seq a cui sono arrivate, in ordine di arrivo
+        self.annullati: dict[str, int] = {}
+
+    #inserisce un nuovo ordine: prima lo esegue contro il lato opposto finché il prezzo lo permette,
+    #poi l'eventuale residuo resta nel book
+    def aggiungi(self, ordine: OrdineLimite) -> list[Eseguito]:
+        self.seq += 1
+        if ordine.id in self.ordini or ordine.quantita <= 0:
+            return []
+        #la cancellazione è arrivata prima: l'ordine non entra e i fondi li ha già restituiti il worker
+        if self.annullati.pop(ordine.id, None) is not None:
+            return []
+
+        eseguiti = []
+        if ordine.lato == "BUY":
+            opposti, livelli, volumi, segno = self.prezzi_ask, self.livelli["SELL"], self.volumi["SELL"], 1
+        else:
+            opposti, livelli, volumi, segno = self.prezzi_bid, self.livelli["BUY"], self.volumi["BUY"], -1
+
+        modificati = self.modificati["SELL" if ordine.lato == "BUY" else "BUY"]
+        limite = ordine.prezzo * segno
+        while ordine.quantita and opposti and opposti[0] <= limite:
+            prezzo = opposti[0] * segno
+            coda = livelli[prezzo]
+            modificati.add(prezzo)
+            while ordine.quantita and coda:
+                maker = coda[0]
+                #gli ordini cancellati restano nella coda con quantità 0 e vengono scartati qui
+                if not maker.quantita:
+                    coda.popleft()
+                    continue
+                quantita = min(maker.quantita, ordine.quantita)
+                maker.quantita -= quantita
+                ordine.quantita -= quantita
+                volumi[prezzo] -= quantita
+                compratore, venditore = (ordine, maker) if segno == 1 else (maker, ordine)
+                #l'ultima esecuzione del compratore consuma tutta la riserva rimasta, cosi gli arrotondamenti non lasciano resti
+                sbloccato = min(importo_unita(quantita, compratore.prezzo), compratore.riservato) if compratore.quantita else compratore.riservato
+                importo = min(importo_unita(quantita, prezzo), sbloccato)
+                compratore.riservato -= sbloccato
+                venditore.riservato -= quantita
+                eseguiti.append(Eseguito(maker, ordine, prezzo, quantita, sbloccato, importo))
+                if not maker.quantita:
+                    coda.popleft()
+                    del self.ordini[maker.id]
+            if not volumi[prezzo]:
+                del livelli[prezzo]
+                del volumi[prezzo]
+                del opposti[0]
+
+        if ordine.quantita:
+            self._riposa(ordine)
+        return eseguiti
+
+    #applica un evento dello stream (vedi utils.manda_evento_matching): NEW per un nuovo ordine, CANCEL per una cancellazione
+    #restituisce gli eseguiti e l'eventuale ordine cancellato con il suo residuo
+    def applica(self, evento: dict) -> tuple[list[Eseguito], tuple[OrdineLimite, int] | None]:
+        if evento["tipo"] == "NEW":
+            ordine = OrdineLimite(evento["order_id"], evento["owner_id"], evento["wallet_id"], evento["type"],
+                                  a_unita(evento["price"]), a_unita(evento["amount"]))
+            return self.aggiungi(ordine), None
+        return [], self.cancella(evento["order_id"])
+
+    #cancella un ordine attivo e lo restituisce insieme alla quantità non eseguita, None se non è nel book
+    #la riserva ancora in ordine.riservato va restituita al proprietario
+    #la rimozione dalla coda è pigra: l'ordine resta con quantità 0 e viene scartato al prossimo matching
+    #un ordine che non è nel book può essere già chiuso oppure non ancora arrivato (l'api manda la cancellazione quando
+    #non sa se il NEW è entrato nello stream): la cancellazione viene ricordata per ANNULLATI_PER_EVENTI eventi
+    #e un NEW con lo stesso id arrivato dopo viene ignorato
+    def cancella(self, order_id: str) -> tuple[OrdineLimite, int] | None:
+        self.seq += 1
+        ordine = self.ordini.pop(order_id, None)
+        if ordine is None:
+            self.annullati[order_id] = self.seq
+            #il più vecchio è il primo del dizionario; quello appena aggiunto ferma sempre il ciclo
+            while (vecchio := next(iter(self.annullati))) and self.annullati[vecchio] <= self.seq - ANNULLATI_PER_EVENTI:
+                del self.annullati[vecchio]
+            return None
+
+        residuo = ordine.quantita
+        ordine.quantita = 0
+        self.modificati[ordine.lato].add(ordine.prezzo)
+        volumi = self.volumi[ordine.lato]
+        volumi[ordine.prezzo] -= residuo
+        if not volumi[ordine.prezzo]:
+            del volumi[ordine.prezzo]
+            del self.livelli[ordine.lato][ordine.prezzo]
+            prezzi, chiave = (self.prezzi_bid, -ordine.prezzo) if ordine.lato == "BUY" else (self.prezzi_ask, ordine.prezzo)
+            del prezzi[bisect_left(prezzi, chiave)]
+        return ordine, residuo
+
+    #aggiunge l'ordine in fondo alla coda del suo livello di prezzo, creando il livello se non esiste
+    def _riposa(self, ordine: OrdineLimite):
+        livelli = self.livelli[ordine.lato]
+        volumi = self.volumi[ordine.lato]
+        coda = livelli.get(ordine.prezzo)
+        if coda is None:
+            coda = livelli[ordine.prezzo] = deque()
+            volumi[ordine.prezzo] = 0
+            if ordine.lato == "BUY":
+                insort(self.prezzi_bid, -ordine.prezzo)
+            else:
+                insort(self.prezzi_ask, ordine.prezzo)
+        coda.append(ordine)
+        volumi[ordine.prezzo] += ordine.quantita
+        self.modificati[ordine.lato].add(ordine.prezzo)
+        self.ordini[ordine.id] = ordine
+
+    def miglior_bid(self) -> int | None:
+        return -self.prezzi_bid[0] if self.prezzi_bid else None
+
+    def miglior_ask(self) -> int | None:
+        return self.prezzi_ask[0] if self.prezzi_ask else None
+
+    #primi n livelli per lato come liste [prezzo, quantità totale], dal prezzo migliore
+    def profondita(self, n: int = 20) -> dict[str, list[list[int]]]:
+        return {
+            "bids": [[-prezzo, self.volumi["BUY"][-prezzo]] for prezzo in self.prezzi_bid[:n]],
+            "asks": [[prezzo, self.volumi["SELL"][prezzo]] for prezzo in self.prezzi_ask[:n]],
+        }
+
+    #livelli cambiati dall'ultima chiamata con la quantità attuale (0 = livello sparito), dal prezzo migliore
+    #le quantità per livello sono già aggregate in volumi, quindi il costo dipende solo dai livelli toccati
+    def estrai_diff(self) -> dict[str, list[list[int]]]:
+        diff = {
+            "bids": [[prezzo, self.volumi["BUY"].get(prezzo, 0)] for prezzo in sorted(self.modificati["BUY"], reverse=True)],
+            "asks": [[prezzo, self.volumi["SELL"].get(prezzo, 0)] for prezzo in sorted(self.modificati["SELL"])],
+        }
+        self.modificati["BUY"].clear()
+        self.modificati["SELL"].clear()
+        return diff
+
+    #fotografia completa del book, serializzabile in json: gli ordini attivi in ordine di priorità per ogni livello
+    #ricaricandola con da_snapshot e riapplicando gli eventi successivi si ricostruisce esattamente lo stesso book
+    def snapshot(self) -> dict:
+        ordini = []
+        for prezzi, lato, segno in ((self.prezzi_bid, "BUY", -1), (self.prezzi_ask, "SELL", 1)):
+            for prezzo in prezzi:
+                ordini += [ordine.come_lista() for ordine in self.livelli[lato][prezzo * segno] if ordine.quantita]
+        return {"asset": self.asset, "seq": self.seq, "ordini": ordini, "annullati": list(self.annullati.items())}
+
+    @classmethod
+    def da_snapshot(cls, dati: dict) -> "OrderBook":
+        book = cls(dati["asset"])
+        for campi in dati["ordini"]:
+            book._riposa(OrdineLimite(*campi))
+        book.seq = dati["seq"]
+        book.annullati = dict(dati.get("annullati", []))
+        return book
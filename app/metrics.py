@@ -0,0 +1,119 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+#metriche prometheus del processo, esposte in formato testo su GET /metrics (il worker le espone su WORKER_METRICS_PORT)
+
+#richieste di prezzo alla cache in-process davanti a redis
+#hit = valore fresco, stale = valore scaduto servito mentre si aggiorna, miss = valore assente,
+#coalesced = miss che ha aspettato una chiamata già in corso per lo stesso ticker invece di farne una nuova
+PRICE_CACHE_REQUESTS = Counter(
+    "price_cache_requests_total",
+    "Richieste di prezzo alla cache in-process",
+    ["result"]
+)
+
+#pool di connessioni al database, per profilo (api o worker)
+#wait = tempo per ottenere una connessione dal pool: se cresce il pool è troppo piccolo per il carico
+DB_POOL_WAIT = Histogram(
+    "db_pool_wait_seconds",
+    "Attesa per ottenere una connessione dal pool",
+    ["profile"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+DB_POOL_TIMEOUTS = Counter(
+    "db_pool_timeouts_total",
+    "Richieste di connessione fallite per DB_POOL_TIMEOUT",
+    ["profile"]
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out",
+    "Connessioni in uso",
+    ["profile"]
+)
+DB_POOL_OVERFLOW = Gauge(
+    "db_pool_overflow",
+    "Connessioni aperte oltre DB_POOL_SIZE (negativo finché il pool non è pieno)",
+    ["profile"]
+)
+
+#letture delle dipendenze get_read_db, per destinazione e motivo (replica, ritardo della replica, scrittura recente dell'utente)
+DB_READ_ROUTING = Counter(
+    "db_read_routing_total",
+    "Sessioni di sola lettura per destinazione",
+    ["target", "reason"]
+)
+
+#conflitti di versione sul wallet nella modalità ottimistica, per endpoint
+#retried = tentativo ripetuto, exhausted = richiesta fallita con 409 dopo OPTIMISTIC_MAX_RETRIES tentativi
+WALLET_VERSION_CONFLICTS = Counter(
+    "wallet_version_conflicts_total",
+    "Conflitti di versione sugli aggiornamenti dei saldi",
+    ["endpoint", "outcome"]
+)
+
+#richieste con Idempotency-Key già vista a cui è stata restituita la risposta salvata, per endpoint e origine (redis o db)
+IDEMPOTENCY_REPLAYS = Counter(
+    "idempotency_replays_total",
+    "Risposte restituite da una chiave di idempotenza già usata",
+    ["endpoint", "source"]
+)
+
+#richieste respinte con 429 dal rate limiting, per rotta (quelle senza budget dedicato sono "default") e tipo di client
+RATE_LIMITED = Counter(
+    "rate_limited_requests_total",
+    "Richieste respinte dal rate limiting",
+    ["route", "client"]
+)
+
+#durata delle richieste http per metodo, rotta (template) e status, misurata da instrumentation.RouteMetricsMiddleware
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Durata delle richieste http",
+    ["method", "route", "status"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+#tempo in cui i wallet restano bloccati, dal lock (FOR UPDATE o UPDATE condizionato) al commit, per percorso
+#deposit e withdrawal solo in modalità pessimistica; worker_orders e worker_matching bloccano tutti i wallet del batch
+WALLET_LOCK_HOLD = Histogram(
+    "wallet_lock_hold_seconds",
+    "Tempo in cui i wallet restano bloccati fino al commit",
+    ["path"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+#latenza delle chiamate verso servizi esterni: redis per comando (il worker misura anche le letture bloccanti degli stream)
+#e binance per endpoint
+EXTERNAL_CALL_DURATION = Histogram(
+    "external_call_duration_seconds",
+    "Latenza delle chiamate a redis e binance",
+    ["service", "operation"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+#richieste alle cache in-process di utenti autenticati e cambi, per livello che ha risposto
+#hit = memoria del processo, redis = cache condivisa, db = nessuna cache aveva il valore
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Letture dalle cache di utenti e cambi per livello",
+    ["cache", "result"]
+)
+
+#worker: ordini in coda sullo stream (waiting = non ancora letti dal gruppo, pending = letti e non ancora confermati),
+#dimensione dei batch e durata del commit per tipo (orders = trade asincroni, matching = ordini limite)
+WORKER_QUEUE_DEPTH = Gauge(
+    "worker_queue_depth",
+    "Ordini sullo stream in attesa o non ancora confermati",
+    ["state"]
+)
+WORKER_BATCH_SIZE = Histogram(
+    "worker_batch_size",
+    "Messaggi per batch del worker",
+    ["kind"],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+WORKER_COMMIT_DURATION = Histogram(
+    "worker_commit_seconds",
+    "Durata del commit dei batch del worker",
+    ["kind"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
@@ -1,5 +1,6 @@
 from .database import Base
-from sqlalchemy import TIMESTAMP, Column, Integer, ForeignKey, Numeric, String, Boolean, text
+from sqlalchemy import TIMESTAMP, BigInteger, CheckConstraint, Column, Integer, ForeignKey, Index, Numeric, String, Boolean, Text, UniqueConstraint, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 
 #L'ORM(Object Relational Mapping) è una tecnica di programmazione che crea un ponte tra la progemmazione O.O.
@@ -22,20 +23,41 @@ class User(Base):
 
 class Wallet(Base):
     __tablename__ = "wallets"
+    __table_args__ = (
+        #ogni richiesta autenticata cerca il wallet tramite il proprietario
+        Index("ix_wallets_owner_id", "owner_id"),
+        #ultima difesa: i trade scalano il saldo con un UPDATE condizionato, il db rifiuta comunque un saldo negativo
+        CheckConstraint("balance >= 0", name="ck_wallets_balance_non_negative"),
+    )
 
     id = Column(Integer, primary_key=True, nullable=False)
     owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     currency = Column(String, nullable=False, server_default=text("'EUR'"))
     balance = Column(Numeric(18, 8), nullable=False, server_default=text("0"))
+    #incrementata ad ogni modifica del saldo: l'ORM la controlla e la incrementa da solo (version_id_col),
+    #gli UPDATE scritti in sql devono fare version = version + 1
+    version = Column(Integer, nullable=False, server_default=text("0"))
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
 
+    #ogni UPDATE dell'ORM ha WHERE version = <versione letta>: se un'altra transazione ha modificato il wallet
+    #dopo la nostra lettura il flush solleva StaleDataError invece di sovrascriverne la modifica
+    __mapper_args__ = {"version_id_col": version}
+
     #ogni wallet ha un proprietario nella tabella User
     owner = relationship("User", back_populates="wallets", lazy="selectin")
     #ogni wallet è collegato a piu transazioni della tabella Transaction
-    transactions = relationship("Transaction", back_populates="wallet", lazy="selectin")
+    #noload: lo storico non viene mai caricato insieme al wallet (costerebbe O(storico) ad ogni richiesta)
+    #per leggerlo si usa l'endpoint paginato GET /transactions
+    transactions = relationship("Transaction", back_populates="wallet", lazy="noload")
 
 class Transaction(Base):
     __tablename__ = "transactions"
+    __table_args__ = (
+        #somme per wallet/asset: type e amount sono inclusi nell'indice cosi basta un index-only scan
+        Index("ix_transactions_wallet_asset", "wallet_id", "asset", postgresql_include=["type", "amount"]),
+        #paginazione keyset dello storico su (created_at, id) per wallet
+        Index("ix_transactions_wallet_created_id", "wallet_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, nullable=False)
     wallet_id = Column(Integer, ForeignKey("wallets.id", ondelete="CASCADE"), nullable=False)
@@ -46,8 +68,178 @@ class Transaction(Base):
     total_payed = Column(Numeric(18, 8), nullable=False)
     status = Column(String, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+    #eseguito del matching a cui appartiene la transazione: le due righe di un eseguito (BUY del compratore e SELL del venditore)
+    #hanno lo stesso fill_id, cosi chi conta gli scambi di mercato (candele) può contarlo una volta sola; NULL per gli altri movimenti
+    fill_id = Column(String(32), nullable=True)
 
     #ogni transazione è collegata al suo wallet della tabella Wallet
-    wallet = relationship("Wallet", back_populates="transactions", lazy="selectin")
+    #anche qui noload, altrimenti ogni pagina di storico riscaricherebbe wallet e proprietario
+    wallet = relationship("Wallet", back_populates="transactions", lazy="noload")
+
+#tabella materializzata con la quantità posseduta di ogni asset per wallet
+#viene aggiornata nella stessa transazione del db di ogni BUY/SELL, cosi per vendere basta leggere una sola riga
+#invece di sommare tutto lo storico delle transazioni
+class Holding(Base):
+    __tablename__ = "holdings"
+    #un solo record per ogni coppia wallet/asset, serve anche per l'upsert con ON CONFLICT
+    __table_args__ = (
+        UniqueConstraint("wallet_id", "asset", name="uq_holdings_wallet_asset"),
+        CheckConstraint("quantity >= 0", name="ck_holdings_quantity_non_negative"),
+        CheckConstraint("reserved >= 0", name="ck_holdings_reserved_non_negative"),
+    )
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    wallet_id = Column(Integer, ForeignKey("wallets.id", ondelete="CASCADE"), nullable=False)
+    asset = Column(String, nullable=False)
+    quantity = Column(Numeric(18, 8), nullable=False, server_default=text("0"))
+    #quantità riservata dagli ordini limite SELL aperti: è già stata tolta da quantity ma è ancora posseduta
+    reserved = Column(Numeric(18, 8), nullable=False, server_default=text("0"))
+    #aggregati del portafoglio, aggiornati ad ogni BUY/SELL nella valuta del wallet con il metodo del costo medio:
+    #cost_basis è il costo di quantity + reserved, un BUY lo aumenta del totale pagato, un SELL lo riduce in proporzione
+    #alla quantità venduta e realized_pnl accumula incasso meno costo della quantità venduta
+    cost_basis = Column(Numeric(18, 8), nullable=False, server_default=text("0"))
+    realized_pnl = Column(Numeric(18, 8), nullable=False, server_default=text("0"))
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'), onupdate=text('now()'))
+
+#ordini inviati in modalità asincrona (POST /trade/async): vengono eseguiti a batch dal worker
+#lo stato passa da QUEUED a EXECUTED oppure REJECTED, e il client può controllarlo in qualsiasi momento
+class Order(Base):
+    __tablename__ = "orders"
+    __table_args__ = (Index("ix_orders_owner_created", "owner_id", "created_at"),)
+
+    #uuid generato dall'api, fa anche da chiave di idempotenza per il worker
+    id = Column(String, primary_key=True, nullable=False)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    wallet_id = Column(Integer, ForeignKey("wallets.id", ondelete="CASCADE"), nullable=False)
+    type = Column(String, nullable=False)
+    asset = Column(String, nullable=False)
+    amount = Column(Numeric(18, 8), nullable=False)
+    #prezzo letto al momento dell'invio, lo stesso che il trade sincrono userebbe
+    #per gli ordini limite è il prezzo limite
+    price = Column(Numeric(18, 8), nullable=False)
+    #MARKET: eseguito dal worker al prezzo di binance, LIMIT: eseguito dal motore di matching contro gli altri utenti
+    kind = Column(String, nullable=False, server_default=text("'MARKET'"))
+    #quantità già eseguita, per gli ordini limite che possono essere eseguiti in più volte
+    filled = Column(Numeric(18, 8), nullable=False, server_default=text("0"))
+    #ordini market: QUEUED -> EXECUTED/REJECTED, ordini limite: OPEN -> FILLED/CANCELLED
+    status = Column(String, nullable=False, server_default=text("'QUEUED'"))
+    #motivo del rifiuto, valorizzato solo per gli ordini REJECTED
+    reason = Column(String, nullable=True)
+    #transazione creata dall'esecuzione, vuota finché l'ordine non è eseguito
+    transaction_id = Column(Integer, ForeignKey("transactions.id", ondelete="SET NULL"), nullable=True)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'), onupdate=text('now()'))
+
+#stato persistente del motore di matching di ogni asset (vedi app/matching.py)
+#last_event_id è l'ultimo evento dello stream già regolato nel db, aggiornato nella stessa transazione degli eseguiti
+#snapshot è la fotografia del book all'evento snapshot_event_id: al riavvio si ricarica e si riapplicano gli eventi successivi
+class OrderBookState(Base):
+    __tablename__ = "order_books"
+
+    asset = Column(String, primary_key=True, nullable=False)
+    last_event_id = Column(String, nullable=False, server_default=text("'0-0'"))
+    seq = Column(BigInteger, nullable=False, server_default=text("0"))
+    snapshot = Column(JSONB, nullable=True)
+    snapshot_event_id = Column(String, nullable=True)
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'), onupdate=text('now()'))
+
+#righe del libro mastro in partita doppia (vedi app/ledger.py): solo insert, mai update o delete
+#la tabella è partizionata per mese su created_at, per questo created_at fa parte della chiave primaria
+#niente foreign key verso wallets: il mastro deve restare anche se un wallet viene cancellato
+class Posting(Base):
+    __tablename__ = "postings"
+    __table_args__ = (
+        #saldo di un conto ad una data: righe del conto in ordine di tempo
+        Index("ix_postings_account_wallet_asset_created", "account", "wallet_id", "asset", "created_at"),
+        Index("ix_postings_entry", "entry_id"),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    created_at = Column(TIMESTAMP(timezone=True), primary_key=True, nullable=False, server_default=text('now()'))
+    #righe della stessa scrittura, che per ogni asset sommano a zero
+    entry_id = Column(String, nullable=False)
+    entry_type = Column(String, nullable=False)
+    #WALLET, RESERVED, EXTERNAL o MARKET; wallet_id è 0 per i conti di sistema
+    account = Column(String, nullable=False)
+    wallet_id = Column(Integer, nullable=False)
+    asset = Column(String, nullable=False)
+    #positivo quando il conto aumenta, negativo quando diminuisce
+    amount = Column(Numeric(18, 8), nullable=False)
+    transaction_id = Column(Integer, nullable=True)
+    order_id = Column(String, nullable=True)
+
+#saldo di ogni conto ad un istante, calcolato periodicamente da scripts/ledger_snapshot.py
+#il saldo ad una data qualsiasi è l'ultimo snapshot più le righe successive
+class LedgerSnapshot(Base):
+    __tablename__ = "ledger_snapshots"
+
+    account = Column(String, primary_key=True, nullable=False)
+    wallet_id = Column(Integer, primary_key=True, nullable=False)
+    asset = Column(String, primary_key=True, nullable=False)
+    as_of = Column(TIMESTAMP(timezone=True), primary_key=True, nullable=False)
+    balance = Column(Numeric(18, 8), nullable=False)
+
+#ultimo cambio noto di ogni valuta dei wallet rispetto alla valuta dei prezzi (vedi app/fx.py)
+#rate = unità della valuta per 1 PRICE_QUOTE_CURRENCY, scritto dal poller dei cambi e letto quando redis non ha il cambio
+class FxRate(Base):
+    __tablename__ = "fx_rates"
+
+    currency = Column(String, primary_key=True, nullable=False)
+    rate = Column(Numeric(18, 8), nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+
+#chiavi di idempotenza degli endpoint che muovono soldi (vedi app/idempotency.py), scritte nella stessa transazione del movimento
+#la chiave primaria (utente, chiave) fa da ultima difesa: una seconda esecuzione con la stessa chiave non può fare commit
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        #pulizia periodica delle chiavi vecchie
+        Index("ix_idempotency_keys_created_at", "created_at"),
+    )
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True, nullable=False)
+    key = Column(String(255), primary_key=True, nullable=False)
+    endpoint = Column(String, nullable=False)
+    #sha256 di endpoint e corpo della richiesta, per rifiutare la stessa chiave usata per una richiesta diversa
+    fingerprint = Column(String(64), nullable=False)
+    #risposta serializzata in json, restituita cosi com'è alle richieste ripetute
+    response = Column(Text, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+
+#valutazione periodica del portafoglio di ogni wallet ai prezzi di mercato, scritta da scripts/revalue_portfolios.py
+class PortfolioValuation(Base):
+    __tablename__ = "portfolio_valuations"
+
+    wallet_id = Column(Integer, ForeignKey("wallets.id", ondelete="CASCADE"), primary_key=True, nullable=False)
+    as_of = Column(TIMESTAMP(timezone=True), primary_key=True, nullable=False)
+    currency = Column(String, nullable=False)
+    market_value = Column(Numeric(18, 8), nullable=False)
+    cost_basis = Column(Numeric(18, 8), nullable=False)
+    unrealized_pnl = Column(Numeric(18, 8), nullable=False)
+    realized_pnl = Column(Numeric(18, 8), nullable=False)
+
+#candele OHLCV per asset, valuta di quotazione e timeframe (1m, 5m, 1h, 1d), scritte a blocchi dall'aggregatore del worker
+#la chiave primaria serve anche le letture per intervallo di GET /candles/{asset}
+class Candle(Base):
+    __tablename__ = "candles"
+
+    asset = Column(String, primary_key=True, nullable=False)
+    currency = Column(String, primary_key=True, nullable=False)
+    timeframe = Column(String(3), primary_key=True, nullable=False)
+    start = Column(TIMESTAMP(timezone=True), primary_key=True, nullable=False)
+    open = Column(Numeric(18, 8), nullable=False)
+    high = Column(Numeric(18, 8), nullable=False)
+    low = Column(Numeric(18, 8), nullable=False)
+    close = Column(Numeric(18, 8), nullable=False)
+    volume = Column(Numeric(24, 8), nullable=False, server_default=text("0"))
+    trades = Column(Integer, nullable=False, server_default=text("0"))
 
+#posizione dell'aggregatore delle candele nella tabella transactions (ultimo id aggregato)
+#"transactions" è quella dell'aggregatore del worker, "backfill" quella di scripts/backfill_candles.py, che si ferma a end_position
+class CandleCursor(Base):
+    __tablename__ = "candle_cursors"
 
+    source = Column(String, primary_key=True, nullable=False)
+    position = Column(BigInteger, nullable=False, server_default=text("0"))
+    end_position = Column(BigInteger, nullable=True)
@@ -1,10 +1,15 @@
+import asyncio
 from jose import jwt, JWTError
 from datetime import datetime, timedelta, timezone
 from fastapi import Depends, status, HTTPException
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import event, inspect
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from . import schemas, models, database
+from sqlalchemy.orm import Session, object_session
+from . import schemas, models, database, metrics, utils
+from .cache import TTLCache
+from .instrumentation import traccia
 from .config import settings
 
 #definiamo lo schema di autenticazione indicando qual'è l'url del login
@@ -43,20 +48,129 @@ def verifica_token_di_accesso(token: str, credentials_exceptions):
     
     return token_data
 
+#cache degli utenti autenticati, cosi le richieste autenticate non fanno una query al db solo per sapere chi è il chiamante
+#livello 1: in memoria del processo, livello 2 (opzionale): redis, condiviso tra i processi
+cache_principal = TTLCache(max_size=settings.PRINCIPAL_CACHE_MAX_SIZE, ttl=settings.PRINCIPAL_CACHE_TTL)
+PRINCIPAL_KEY = "principal:{}"
+#canale su cui si avvisano gli altri processi di scartare un utente dalla loro cache in memoria
+PRINCIPAL_INVALIDATION_CHANNEL = "invalida_principal"
+
+async def carica_principal(user_id: int, db: AsyncSession) -> schemas.Principal | None:
+    voce = cache_principal.get(user_id)
+    if voce:
+        metrics.CACHE_REQUESTS.labels("principal", "hit").inc()
+        return voce[0]
+
+    redis_client = utils.redis_client if settings.PRINCIPAL_CACHE_REDIS else None
+    if redis_client:
+        try:
+            salvato = await redis_client.get(PRINCIPAL_KEY.format(user_id))
+            if salvato:
+                principal = schemas.Principal.model_validate_json(salvato)
+                cache_principal.set(user_id, principal)
+                metrics.CACHE_REQUESTS.labels("principal", "redis").inc()
+                return principal
+        except Exception as e:
+            print(f"Errore Redis nella lettura del principal: {e}")
+
+    metrics.CACHE_REQUESTS.labels("principal", "db").inc()
+    #leggiamo solo le colonne che servono, senza caricare l'utente con le sue relazioni
+    query = select(models.User.id, models.User.email, models.Wallet.id.label("wallet_id"), models.Wallet.currency).outerjoin(
+        models.Wallet, models.Wallet.owner_id == models.User.id
+    ).where(models.User.id == user_id).order_by(models.Wallet.id).limit(1)
+    result = await db.execute(query)
+    riga = result.one_or_none()
+    if not riga:
+        return None
+
+    principal = schemas.Principal(id=riga.id, email=riga.email, wallet_id=riga.wallet_id, wallet_currency=riga.currency)
+    cache_principal.set(user_id, principal)
+    if redis_client:
+        try:
+            await redis_client.setex(PRINCIPAL_KEY.format(user_id), settings.PRINCIPAL_REDIS_TTL, principal.model_dump_json())
+        except Exception as e:
+            print(f"Errore Redis nel salvataggio del principal: {e}")
+    return principal
+
 #funzione asincrona per ottenere l'utente corrente tramite il token estratto usando lo schema oauth2
-async def get_current_user(token: str = Depends(schema_oauth2), db: AsyncSession = Depends(database.get_db)):
+#restituisce un Principal (id, email, wallet_id, wallet_currency) preso dalla cache, il db viene interrogato solo se manca
+@traccia("get_current_user")
+async def get_current_user(token: str = Depends(schema_oauth2), db: AsyncSession = Depends(database.get_read_db)):
 
     credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                                           detail="Credenziali non valide",
                                           headers={"WWW-Authenticate": "Bearer"})
     
     token_data = verifica_token_di_accesso(token, credentials_exception)
+    #da qui in poi le sessioni della richiesta sanno chi è l'utente (letture sulla replica e read-your-writes)
+    database.utente_corrente.set(token_data.id)
 
-    #facciamo una query per ottenere l'utente tramite l'id che abbiamo ottenuto
-    query = select(models.User).where(models.User.id == token_data.id)
-    result = await db.execute(query)
-    user = result.scalar_one_or_none()
+    user = await carica_principal(token_data.id, db)
+    #un utente appena registrato potrebbe non essere ancora arrivato sulla replica
+    if not user and database.replica_engine is not None:
+        async with database.SessionLocal() as primario:
+            user = await carica_principal(token_data.id, primario)
 
     if not user:
         raise credentials_exception
     return user 
+
+
+#hook di invalidazione: da chiamare quando cambiano i dati di un utente o dei suoi wallet
+#rimuove l'utente dalla cache locale e da redis, e avvisa gli altri processi
+async def invalida_principal(*user_ids: int):
+    for user_id in user_ids:
+        cache_principal.delete(user_id)
+    if utils.redis_client and user_ids:
+        try:
+            async with utils.redis_client.pipeline(transaction=False) as pipe:
+                for user_id in user_ids:
+                    pipe.delete(PRINCIPAL_KEY.format(user_id))
+                    pipe.publish(PRINCIPAL_INVALIDATION_CHANNEL, str(user_id))
+                await pipe.execute()
+        except Exception as e:
+            print(f"Errore Redis nell'invalidazione del principal: {e}")
+
+#iscrizione al canale di invalidazione (vedi streaming.RedisFanout), registrata nel lifespan di ogni processo api
+class InvalidazionePrincipal:
+    def pubblica(self, canale: str, messaggio: str):
+        cache_principal.delete(int(messaggio))
+
+#invalidazione automatica: ogni modifica ORM a utenti o wallet segna l'utente nella sessione
+#e dopo il commit (non prima, altrimenti un'altra richiesta potrebbe rimettere in cache i dati vecchi) lo invalidiamo
+#negli update guardiamo solo le colonne che finiscono nel Principal: depositi e prelievi cambiano il saldo
+#del wallet ad ogni richiesta e non devono svuotare la cache
+def segna_utente_modificato(mapper, connection, target):
+    if isinstance(target, models.User):
+        user_ids = {target.id}
+    else:
+        storia = inspect(target).attrs.owner_id.history
+        user_ids = {target.owner_id, *storia.deleted} - {None}
+    object_session(target).info.setdefault("principal_da_invalidare", set()).update(user_ids)
+
+def segna_se_cambiato(mapper, connection, target):
+    colonne = ("email",) if isinstance(target, models.User) else ("id", "owner_id", "currency")
+    stato = inspect(target)
+    if any(stato.attrs[colonna].history.has_changes() for colonna in colonne):
+        segna_utente_modificato(mapper, connection, target)
+
+for modello in (models.User, models.Wallet):
+    event.listen(modello, "after_insert", segna_utente_modificato)
+    event.listen(modello, "after_delete", segna_utente_modificato)
+    event.listen(modello, "after_update", segna_se_cambiato)
+
+@event.listens_for(Session, "after_commit")
+def invalida_dopo_commit(session):
+    user_ids = session.info.pop("principal_da_invalidare", None)
+    if user_ids:
+        for user_id in user_ids:
+            cache_principal.delete(user_id)
+        #redis va aggiornato in modo asincrono: fuori da un event loop (es. script sincroni) basta la cache locale
+        try:
+            asyncio.get_running_loop().create_task(invalida_principal(*user_ids))
+        except RuntimeError:
+            pass
+
+@event.listens_for(Session, "after_rollback")
+def scarta_dopo_rollback(session):
+    session.info.pop("principal_da_invalidare", None)
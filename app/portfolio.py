@@ -0,0 +1,51 @@
+from decimal import Decimal
+from . import ledger
+
+#aggregati di portafoglio di un holding con il metodo del costo medio, nella valuta del wallet
+#quantity è la quantità disponibile, reserved quella bloccata dagli ordini limite SELL aperti: tutte e due sono possedute,
+#quindi il costo medio è cost_basis / (quantity + reserved) e riservare o restituire quantità non lo cambia
+#un BUY aggiunge al costo il totale pagato; un SELL toglie dal costo la sua quota (arrotondata come nel mastro)
+#e aggiunge a realized_pnl la differenza tra incasso e quota; quando si vende tutto il costo torna esattamente a zero
+#stesse regole delle istruzioni sql di /trade (TRADE_BUY, TRADE_SELL), usate dal worker e da scripts/revalue_portfolios.py
+class Posizione:
+    __slots__ = ("quantity", "reserved", "cost_basis", "realized_pnl")
+
+    def __init__(self, quantity=0, reserved=0, cost_basis=0, realized_pnl=0):
+        self.quantity = Decimal(quantity)
+        self.reserved = Decimal(reserved)
+        self.cost_basis = Decimal(cost_basis)
+        self.realized_pnl = Decimal(realized_pnl)
+
+    @property
+    def posseduta(self) -> Decimal:
+        return self.quantity + self.reserved
+
+    @property
+    def costo_medio(self) -> Decimal | None:
+        return ledger.arrotonda(self.cost_basis / self.posseduta) if self.posseduta else None
+
+    def compra(self, quantita: Decimal, importo: Decimal):
+        self.quantity += quantita
+        self.cost_basis += importo
+
+    #riservata=True per gli eseguiti degli ordini limite, che vendono la quantità già bloccata
+    def vendi(self, quantita: Decimal, importo: Decimal, riservata: bool = False):
+        costo = ledger.arrotonda(self.cost_basis * quantita / self.posseduta) if self.posseduta else Decimal(0)
+        if riservata:
+            self.reserved -= quantita
+        else:
+            self.quantity -= quantita
+        self.cost_basis -= costo
+        self.realized_pnl += importo - costo
+
+    #segno=1 blocca quantità per un ordine SELL, segno=-1 la restituisce (ordine cancellato)
+    def riserva(self, quantita: Decimal, segno: int = 1):
+        self.quantity -= quantita * segno
+        self.reserved += quantita * segno
+
+    #valore di mercato e pnl non realizzato a un prezzo nella valuta del wallet, None se il prezzo non c'è
+    def valuta(self, prezzo: Decimal | None) -> tuple[Decimal | None, Decimal | None]:
+        if prezzo is None:
+            return None, None
+        valore = ledger.arrotonda(self.posseduta * prezzo)
+        return valore, valore - self.cost_basis
@@ -0,0 +1,170 @@
+import math
+import time
+from collections import OrderedDict
+from fastapi import status
+from fastapi.responses import ORJSONResponse
+from jose import jwt, JWTError
+from starlette.routing import Match
+from . import metrics, utils
+from .config import settings
+
+#rate limiting con token bucket come middleware ASGI, prima di routing, autenticazione e db
+#ogni client ha un bucket per rotta ("METODO /template", es. "GET /orders/{order_id}", budget in RATE_LIMITS,
+#altrimenti RATE_LIMIT_DEFAULT); i percorsi che non corrispondono a nessuna rotta condividono il bucket "unmatched":
+#il bucket contiene al massimo capacità token, se ne ricaricano token_al_secondo ogni secondo e ogni richiesta ne consuma uno
+#il client è l'utente del JWT se c'è un token valido, altrimenti l'ip (login, registrazione)
+#alcune rotte hanno anche un bucket globale condiviso da tutti i client (RATE_LIMITS_GLOBAL), es. il login che consuma CPU in bcrypt
+#i bucket stanno su redis e si aggiornano con uno script lua, atomico anche con più processi;
+#se redis non risponde si usano bucket in memoria del processo, quindi con N processi il limite effettivo diventa N volte più alto
+RATE_LIMIT_KEY = "rate_limit:{}:{}"
+ROTTA_SCONOSCIUTA = "unmatched"
+
+#KEYS: i bucket da controllare, ARGV: capacità e token al secondo di ogni bucket
+#la richiesta passa solo se c'è un token in tutti i bucket, e solo allora viene scalato da tutti
+#restituisce {1, 0} se passa oppure {0, millisecondi da aspettare}
+#l'ora è quella di redis, cosi processi con orologi diversi vedono lo stesso bucket
+TOKEN_BUCKET_LUA = """
+local ora = redis.call('TIME')
+local adesso = tonumber(ora[1]) + tonumber(ora[2]) / 1000000
+local token = {}
+local attesa = 0
+for i, chiave in ipairs(KEYS) do
+    local capacita = tonumber(ARGV[i * 2 - 1])
+    local ricarica = tonumber(ARGV[i * 2])
+    local stato = redis.call('HMGET', chiave, 'token', 'ts')
+    local disponibili = tonumber(stato[1]) or capacita
+    local ultimo = tonumber(stato[2]) or adesso
+    disponibili = math.min(capacita, disponibili + math.max(0, adesso - ultimo) * ricarica)
+    token[i] = disponibili
+    if disponibili < 1 then
+        attesa = math.max(attesa, (1 - disponibili) / ricarica)
+    end
+end
+for i, chiave in ipairs(KEYS) do
+    local capacita = tonumber(ARGV[i * 2 - 1])
+    local ricarica = tonumber(ARGV[i * 2])
+    if attesa == 0 then
+        token[i] = token[i] - 1
+    end
+    redis.call('HSET', chiave, 'token', tostring(token[i]), 'ts', tostring(adesso))
+    redis.call('PEXPIRE', chiave, math.ceil(capacita / ricarica * 1000) + 1000)
+end
+if attesa == 0 then
+    return {1, 0}
+end
+return {0, math.ceil(attesa * 1000)}
+"""
+
+
+#gli stessi bucket in memoria del processo, usati quando redis non è disponibile
+#LRU come TTLCache: oltre max_size si scarta il bucket usato meno di recente (un bucket scartato riparte pieno)
+class BucketLocali:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._bucket: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    #stessa logica dello script lua, restituisce i secondi da aspettare (0 se la richiesta passa)
+    def consuma(self, bucket: list[tuple[str, float, float]]) -> float:
+        adesso = time.monotonic()
+        token = []
+        attesa = 0.0
+        for chiave, capacita, ricarica in bucket:
+            disponibili, ultimo = self._bucket.get(chiave, (capacita, adesso))
+            disponibili = min(capacita, disponibili + (adesso - ultimo) * ricarica)
+            token.append(disponibili)
+            if disponibili < 1:
+                attesa = max(attesa, (1 - disponibili) / ricarica)
+        for (chiave, _, _), disponibili in zip(bucket, token):
+            self._bucket[chiave] = (disponibili - 1 if not attesa else disponibili, adesso)
+            self._bucket.move_to_end(chiave)
+        while len(self._bucket) > self.max_size:
+            self._bucket.popitem(last=False)
+        return attesa
+
+
+#id dell'utente dal token, senza db: la firma basta per sapere chi è, la validità la ricontrolla get_current_user
+def utente_dal_token(headers: dict[bytes, bytes]) -> str | None:
+    autorizzazione = headers.get(b"authorization", b"").decode("latin-1")
+    schema, _, token = autorizzazione.partition(" ")
+    if schema.lower() != "bearer" or not token:
+        return None
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+    except JWTError:
+        return None
+    user_id = payload.get("user_id")
+    return str(user_id) if user_id else None
+
+def ip_del_client(scope, headers: dict[bytes, bytes]) -> str:
+    #dietro un proxy fidato l'ip vero è il primo di X-Forwarded-For
+    if settings.RATE_LIMIT_TRUST_PROXY and b"x-forwarded-for" in headers:
+        return headers[b"x-forwarded-for"].decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "sconosciuto"
+
+
+#il template della rotta e non il percorso: con il percorso ogni id avrebbe un bucket suo, cambiando l'id si aggirerebbe
+#il limite e su redis resterebbe una chiave per ogni percorso diverso. Il middleware gira prima del routing,
+#quindi confronta la richiesta con le rotte dell'app come farà il router (scope["app"] è l'app FastAPI);
+#una corrispondenza solo di percorso (metodo sbagliato, 405) usa comunque il template
+def rotta_della_richiesta(scope) -> str:
+    app = scope.get("app")
+    parziale = None
+    for route in (app.router.routes if app is not None else ()):
+        corrispondenza, _ = route.matches(scope)
+        if corrispondenza == Match.FULL:
+            return f"{scope['method']} {route.path}"
+        if corrispondenza == Match.PARTIAL and parziale is None:
+            parziale = route.path
+    return f"{scope['method']} {parziale}" if parziale else ROTTA_SCONOSCIUTA
+
+
+class RateLimitMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.locali = BucketLocali(max_size=settings.RATE_LIMIT_LOCAL_MAX_SIZE)
+        self.script = None
+        #dopo un errore di redis si usano i bucket locali per RATE_LIMIT_REDIS_RETRY secondi, senza riprovare ad ogni richiesta
+        self.redis_sospeso_fino = 0.0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.RATE_LIMIT_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        rotta = rotta_della_richiesta(scope)
+        headers = dict(scope["headers"])
+        utente = utente_dal_token(headers)
+        client = f"utente:{utente}" if utente else f"ip:{ip_del_client(scope, headers)}"
+
+        capacita, ricarica = settings.RATE_LIMITS.get(rotta, settings.RATE_LIMIT_DEFAULT)
+        bucket = [(RATE_LIMIT_KEY.format(client, rotta), capacita, ricarica)]
+        globale = settings.RATE_LIMITS_GLOBAL.get(rotta)
+        if globale:
+            bucket.append((RATE_LIMIT_KEY.format("globale", rotta), *globale))
+
+        attesa = await self.consuma(bucket)
+        if attesa:
+            metrics.RATE_LIMITED.labels(route=rotta if rotta in settings.RATE_LIMITS else "default",
+                                        client="user" if utente else "ip").inc()
+            risposta = ORJSONResponse(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                content={"detail": "Troppe richieste, riprova più tardi"},
+                headers={"Retry-After": str(max(1, math.ceil(attesa)))}
+            )
+            await risposta(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+    async def consuma(self, bucket: list[tuple[str, float, float]]) -> float:
+        if utils.redis_client and time.monotonic() >= self.redis_sospeso_fino:
+            try:
+                if self.script is None:
+                    self.script = utils.redis_client.register_script(TOKEN_BUCKET_LUA)
+                argomenti = [valore for _, capacita, ricarica in bucket for valore in (capacita, ricarica)]
+                _, attesa_ms = await self.script(keys=[chiave for chiave, _, _ in bucket], args=argomenti)
+                return int(attesa_ms) / 1000
+            except Exception as e:
+                print(f"Errore Redis nel rate limiting, uso i bucket in memoria per {settings.RATE_LIMIT_REDIS_RETRY}s: {e}")
+                self.redis_sospeso_fino = time.monotonic() + settings.RATE_LIMIT_REDIS_RETRY
+        return self.locali.consuma(bucket)
@@ -22,11 +22,18 @@ async def login(credenziali: OAuth2PasswordRequestForm = Depends(), db: AsyncSes
                             detail="Credenziali errate")
     
     #se la password non è corretta lanciamo un eccezione
-    if not utils.verify(credenziali.password, user.password):
+    #la verifica gira nel pool dedicato a bcrypt, senza bloccare l'event loop
+    password_corretta, nuovo_hash = await utils.verify_and_update_async(credenziali.password, user.password)
+    if not password_corretta:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail="Credenziali errate")
     
     #se invece è corretta creo il token e lo restituisco
     access_token = oauth2.crea_token_di_accesso(data= {"user_id": user.id})
 
+    #se il costo di bcrypt è cambiato salviamo l'hash ricalcolato, l'utente non se ne accorge
+    if nuovo_hash:
+        user.password = nuovo_hash
+        await db.commit()
+
     return {"access_token": access_token, "token_type": "bearer"}
@@ -0,0 +1,112 @@
+import anyio
+import orjson
+from fastapi import APIRouter, HTTPException, Query, Response, WebSocket, WebSocketDisconnect, status
+from .. import utils
+from ..config import settings
+from ..streaming import CodaMessaggi, hub
+
+router = APIRouter(
+    tags = ['Market']
+)
+
+#messaggi in attesa per ogni client websocket: se il client è troppo lento si perdono le differenze più vecchie
+#e il buco nella sequenza fa ripartire il client da una nuova fotografia
+CODA_BOOK = 1000
+
+def controlla_asset(asset: str) -> str:
+    asset = asset.upper()
+    if asset not in settings.SUPPORTED_TICKERS:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Asset non supportato: {asset}")
+    return asset
+
+#fotografia già serializzata dal worker (vedi worker.pubblica_book), un book vuoto se il worker non l'ha ancora pubblicata
+async def leggi_fotografia(asset: str) -> str:
+    fotografia = await utils.redis_client.get(utils.BOOK_KEY.format(asset))
+    if fotografia is None:
+        return orjson.dumps({"type": "snapshot", "asset": asset, "seq": 0, "bids": [], "asks": []}).decode()
+    return fotografia
+
+
+#primi depth livelli per lato del book di un asset, con la quantità totale di ogni livello
+@router.get("/book/{asset}")
+async def get_book(asset: str, depth: int = Query(20, ge=1, le=settings.BOOK_DEPTH)):
+    asset = controlla_asset(asset)
+    if not utils.redis_client:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Book non disponibile")
+
+    fotografia = await leggi_fotografia(asset)
+    #alla profondità massima rispondiamo con i byte salvati dal worker, senza deserializzare
+    if depth == settings.BOOK_DEPTH:
+        return Response(content=fotografia, media_type="application/json")
+    dati = orjson.loads(fotografia)
+    dati["bids"] = dati["bids"][:depth]
+    dati["asks"] = dati["asks"][:depth]
+    return dati
+
+
+#websocket con il book in tempo reale: ws://host/ws/book/BTC
+#il client riceve prima una fotografia ("snapshot"), poi le differenze numerate dei livelli cambiati ("diff", quantità "0" = livello rimosso)
+#e gli eseguiti ("trades"); ogni diff ha prev_seq uguale al seq del messaggio di book precedente
+@router.websocket("/ws/book/{asset}")
+async def ws_book(websocket: WebSocket, asset: str):
+    try:
+        asset = controlla_asset(asset)
+    except HTTPException as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+        return
+    if not hub.disponibile:
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR, reason="Book non disponibile")
+        return
+
+    await websocket.accept()
+    canali = [utils.BOOK_CHANNEL.format(asset), utils.TRADES_CHANNEL.format(asset)]
+    coda = CodaMessaggi(max_size=CODA_BOOK)
+
+    async def invia_fotografia() -> int:
+        fotografia = await leggi_fotografia(asset)
+        await websocket.send_text(fotografia)
+        return orjson.loads(fotografia)["seq"]
+
+    #se l'invio fallisce la connessione è chiusa: fermiamo anche la lettura
+    async def invia(task_group):
+        try:
+            ultimo_seq = await invia_fotografia()
+            while True:
+                messaggio = await coda.prossimo()
+                #gli eseguiti sono json puro, le differenze hanno l'intestazione "prev_seq seq "
+                if messaggio.startswith("{"):
+                    await websocket.send_text(messaggio)
+                    continue
+                precedente, seq, corpo = messaggio.split(" ", 2)
+                if int(seq) <= ultimo_seq:
+                    #già contenuta nella fotografia inviata
+                    continue
+                if int(precedente) != ultimo_seq:
+                    #abbiamo perso delle differenze: la fotografia in redis è sempre aggiornata almeno a questa differenza
+                    ultimo_seq = await invia_fotografia()
+                    continue
+                await websocket.send_text(corpo)
+                ultimo_seq = int(seq)
+        except (WebSocketDisconnect, RuntimeError):
+            task_group.cancel_scope.cancel()
+
+    #il client non manda nulla, ma leggere serve ad accorgersi subito della disconnessione
+    async def ricevi(task_group):
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            task_group.cancel_scope.cancel()
+
+    try:
+        #prima l'iscrizione e poi la fotografia (in invia), cosi nessuna differenza successiva alla fotografia va persa
+        await hub.iscrivi(coda, canali)
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(invia, task_group)
+            task_group.start_soon(ricevi, task_group)
+    finally:
+        #shield: la pulizia deve avvenire anche se il task della connessione è stato cancellato
+        with anyio.CancelScope(shield=True):
+            await hub.disiscrivi(coda, canali)
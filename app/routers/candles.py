@@ -0,0 +1,97 @@
+import asyncio
+from datetime import datetime, timezone
+from typing import List, Literal, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from .. import database, metrics, models, schemas
+from ..cache import SingleFlight, TTLCache
+from ..candles import TIMEFRAME
+from ..config import settings
+from ..database import get_read_db
+from .book import controlla_asset
+
+router = APIRouter(
+    tags = ['Market']
+)
+
+#finestra calda: le ultime CANDLE_HOT_WINDOW candele di ogni serie (asset, valuta, timeframe) restano in memoria
+#per CANDLE_HOT_TTL secondi e le richieste che cadono dentro la finestra (grafici in tempo reale, ultime N candele)
+#vengono servite tagliando la lista, con una sola lettura dal db per serie anche con molti client concorrenti
+#le richieste su intervalli più vecchi leggono dal db con la chiave primaria (asset, currency, timeframe, start)
+cache_recenti = TTLCache(max_size=len(settings.SUPPORTED_TICKERS) * (len(settings.SUPPORTED_CURRENCIES) + 1) * len(TIMEFRAME),
+                         ttl=settings.CANDLE_HOT_TTL)
+letture_recenti = SingleFlight()
+
+COLONNE = (models.Candle.start, models.Candle.open, models.Candle.high, models.Candle.low, models.Candle.close,
+           models.Candle.volume, models.Candle.trades)
+
+
+async def leggi_candele(db: AsyncSession, asset: str, valuta: str, timeframe: str, da: datetime | None, a: datetime | None, limite: int) -> list:
+    query = select(*COLONNE).where(
+        models.Candle.asset == asset,
+        models.Candle.currency == valuta,
+        models.Candle.timeframe == timeframe
+    )
+    if da is not None:
+        query = query.where(models.Candle.start >= da)
+    if a is not None:
+        query = query.where(models.Candle.start < a)
+    #le più recenti dell'intervallo, restituite dalla più vecchia
+    result = await db.execute(query.order_by(models.Candle.start.desc()).limit(limite))
+    return result.all()[::-1]
+
+async def carica_recenti(serie: tuple[str, str, str]) -> list:
+    async with database.ReadSessionLocal() as db:
+        candele = await leggi_candele(db, *serie, None, None, settings.CANDLE_HOT_WINDOW)
+    cache_recenti.set(serie, candele)
+    return candele
+
+#la parte della finestra calda che risponde alla richiesta, None se la richiesta va oltre la finestra
+#una finestra non piena contiene tutta la serie, una piena solo le candele dalla sua prima in poi
+def dalla_finestra(candele: list, da: datetime | None, a: datetime | None, limite: int) -> list | None:
+    inizio_finestra = candele[0].start if len(candele) >= settings.CANDLE_HOT_WINDOW else None
+    if a is not None:
+        candele = [candela for candela in candele if candela.start < a]
+    if da is not None:
+        if inizio_finestra is not None and da < inizio_finestra:
+            return None
+        candele = [candela for candela in candele if candela.start >= da]
+    elif inizio_finestra is not None and len(candele) < limite:
+        return None
+    return candele[-limite:]
+
+
+#candele OHLCV di un asset per timeframe, quotate in una valuta (di default quella dei prezzi di binance)
+#from/to limitano l'inizio delle candele (from incluso, to escluso), limit restituisce le più recenti dell'intervallo
+#la candela in corso è aggiornata ogni CANDLE_FLUSH_INTERVAL secondi dal worker
+@router.get("/candles/{asset}", response_model=List[schemas.Candle])
+async def get_candles(asset: str, timeframe: Literal["1m", "5m", "1h", "1d"] = "1m", currency: Optional[str] = None,
+                      from_date: Optional[datetime] = Query(None, alias="from"), to_date: Optional[datetime] = Query(None, alias="to"),
+                      limit: int = Query(200, ge=1, le=settings.CANDLE_MAX_LIMIT), db: AsyncSession = Depends(get_read_db)):
+    asset = controlla_asset(asset)
+    valuta = (currency or settings.PRICE_QUOTE_CURRENCY).upper()
+    if valuta not in settings.SUPPORTED_CURRENCIES and valuta != settings.PRICE_QUOTE_CURRENCY:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Valuta non supportata: {valuta}")
+    #le date senza fuso orario sono in UTC, come gli inizi delle candele
+    da, a = (data.replace(tzinfo=timezone.utc) if data and data.tzinfo is None else data for data in (from_date, to_date))
+    if da is not None and a is not None and da >= a:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="from deve essere precedente a to")
+
+    serie = (asset, valuta, timeframe)
+    if limit <= settings.CANDLE_HOT_WINDOW:
+        voce = cache_recenti.get(serie)
+        if voce:
+            candele = voce[0]
+        else:
+            task, _ = letture_recenti.esegui(serie, lambda: carica_recenti(serie))
+            candele = await asyncio.shield(task)
+        risposta = dalla_finestra(candele, da, a, limit)
+        if risposta is not None:
+            metrics.CACHE_REQUESTS.labels("candles", "hit" if voce else "miss").inc()
+            return risposta
+
+    metrics.CACHE_REQUESTS.labels("candles", "db").inc()
+    return await leggi_candele(db, asset, valuta, timeframe, da, a, limit)
@@ -0,0 +1,27 @@
+from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from .. import ledger, schemas, oauth2
+from ..database import get_read_db
+
+router = APIRouter(
+    tags = ['Ledger']
+)
+
+#saldi del wallet dell'utente ricostruiti dal libro mastro, ad oggi o ad un istante passato (at)
+#il costo dipende solo dalle righe successive all'ultimo snapshot, non da tutto lo storico
+@router.get("/ledger/balances", response_model=schemas.LedgerBalances)
+async def get_ledger_balances(at: Optional[datetime] = None, db: AsyncSession = Depends(get_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_user)):
+
+    if not current_user.wallet_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Errore: wallet dell'utente: {current_user.email} non trovato")
+    disponibili = await ledger.saldi_al(db, current_user.wallet_id, at, ledger.WALLET)
+    riservati = await ledger.saldi_al(db, current_user.wallet_id, at, ledger.RESERVED)
+    return {
+        "wallet_id": current_user.wallet_id,
+        "at": at,
+        "available": {asset: saldo for asset, saldo in disponibili.items() if saldo},
+        "reserved": {asset: saldo for asset, saldo in riservati.items() if saldo},
+    }
@@ -0,0 +1,182 @@
+import uuid
+from decimal import Decimal
+import anyio
+from fastapi import APIRouter, Depends, HTTPException, Query, WebSocket, WebSocketDisconnect, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from .. import ledger, models, schemas, oauth2, utils
+from ..config import settings
+from ..database import get_db, get_read_db
+from ..matching import a_unita, da_unita, importo_unita
+from ..streaming import CodaMessaggi, hub
+
+router = APIRouter(
+    tags = ['Orders']
+)
+
+#endpoint per controllare lo stato di un ordine inviato con POST /trade/async
+@router.get("/orders/{order_id}", response_model=schemas.OrderResponse)
+async def get_order(order_id: str, db: AsyncSession = Depends(get_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_user)):
+
+    #filtriamo anche per proprietario, un utente non deve poter leggere gli ordini degli altri
+    query = select(models.Order).where(models.Order.id == order_id, models.Order.owner_id == current_user.id)
+    result = await db.execute(query)
+    ordine = result.scalar_one_or_none()
+    if not ordine:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Ordine {order_id} non trovato")
+    return ordine
+
+#riserva dei fondi di un ordine limite: un BUY blocca amount * price dal saldo, un SELL sposta amount da quantity a reserved
+#negli holdings (la quantità resta posseduta, quindi il costo medio non cambia)
+#cosi quando il motore di matching esegue l'ordine i fondi ci sono sempre, senza ricontrollare nulla
+#la riserva la restituisce solo il worker, alla cancellazione o all'ultimo eseguito
+#ogni movimento passa anche dal mastro, dal conto WALLET al conto RESERVED del wallet
+async def riserva_fondi(db: AsyncSession, wallet_id: int, order_id: str, ordine: schemas.LimitOrderCreate):
+    query = select(models.Wallet).where(models.Wallet.id == wallet_id).with_for_update()
+    result = await db.execute(query)
+    wallet = result.scalar_one_or_none()
+    if not wallet:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Impossibile trovare il wallet associato al tuo account, contatta l'assistenza")
+
+    if ordine.type == "BUY":
+        #stesso arrotondamento del motore di matching, che sblocca la riserva man mano che l'ordine viene eseguito
+        totale_da_pagare = da_unita(importo_unita(a_unita(ordine.amount), a_unita(ordine.price)))
+        if totale_da_pagare > wallet.balance:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                                detail=f"Hai un saldo troppo basso: {wallet.balance}")
+        wallet.balance -= totale_da_pagare
+        await ledger.registra(db, ledger.riserva(wallet_id, wallet.currency, totale_da_pagare, order_id))
+        return
+
+    query = select(models.Holding).where(
+        models.Holding.wallet_id == wallet_id,
+        models.Holding.asset == ordine.asset
+    ).with_for_update()
+    result = await db.execute(query)
+    holding = result.scalar_one_or_none()
+    totale = holding.quantity if holding else Decimal(0)
+    if ordine.amount > totale:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail=f"non hai crypto sufficienti da vendere, hai aquistato: {totale}")
+    holding.quantity -= ordine.amount
+    holding.reserved += ordine.amount
+    await ledger.registra(db, ledger.riserva(wallet_id, ordine.asset, ordine.amount, order_id))
+
+#endpoint per l'invio di un ordine limite al motore di matching dell'asset
+#i fondi vengono riservati subito, l'ordine resta OPEN nel book finché non viene eseguito o cancellato
+@router.post("/orders/limit", status_code=status.HTTP_202_ACCEPTED, response_model=schemas.OrderQueued)
+async def create_limit_order(ordine: schemas.LimitOrderCreate, db: AsyncSession = Depends(get_db), current_user: schemas.Principal = Depends(oauth2.get_current_user)):
+
+    if ordine.asset not in settings.SUPPORTED_TICKERS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Asset non supportato: {ordine.asset}")
+    if not utils.redis_client or not current_user.wallet_id:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Ordini limite non disponibili")
+    #il book di ogni asset ha una sola valuta di quotazione: compratore e venditore devono regolare nella stessa valuta
+    if (current_user.wallet_currency or settings.DEFAULT_CURRENCY) != settings.LIMIT_ORDER_CURRENCY:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Gli ordini limite sono disponibili solo per i wallet in {settings.LIMIT_ORDER_CURRENCY}")
+
+    order_id = uuid.uuid4().hex
+    await riserva_fondi(db, current_user.wallet_id, order_id, ordine)
+    db.add(models.Order(
+        id = order_id,
+        owner_id = current_user.id,
+        wallet_id = current_user.wallet_id,
+        kind = "LIMIT",
+        status = "OPEN",
+        **ordine.model_dump()
+    ))
+    evento = {"tipo": "NEW", "order_id": order_id, "owner_id": current_user.id, "wallet_id": current_user.wallet_id, **ordine.model_dump()}
+    #salviamo ordine e riserva prima di mandare l'evento, cosi il worker trova sempre l'ordine nel db
+    await db.commit()
+
+    try:
+        await utils.manda_evento_matching(ordine.asset, evento)
+    except Exception as e:
+        print(f"Errore nell'invio al matching dell'ordine {order_id}: {e}")
+        #dopo un timeout o una connessione interrotta redis può aver ricevuto il NEW lo stesso: i fondi non si possono
+        #restituire qui, perchè l'ordine potrebbe essere già nel book. Chiediamo la cancellazione al motore, che la regola
+        #sia se l'ordine è nel book sia se il NEW non è mai arrivato (vedi worker.regola_matching);
+        #se non parte neanche questa l'ordine resta OPEN e il cliente può cancellarlo con DELETE /orders/{id}
+        try:
+            await utils.manda_evento_matching(ordine.asset, {"tipo": "CANCEL", "order_id": order_id, "owner_id": current_user.id})
+        except Exception as e:
+            print(f"Errore nell'invio della cancellazione dell'ordine {order_id}: {e}")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=f"Impossibile confermare l'ordine {order_id}, è stata chiesta la cancellazione: riprova più tardi")
+
+    return {"order_id": order_id, "status": "OPEN"}
+
+#endpoint per cancellare un ordine limite ancora aperto
+#la cancellazione passa dal motore di matching come gli altri eventi: i fondi non eseguiti vengono restituiti dal worker
+@router.delete("/orders/{order_id}", status_code=status.HTTP_202_ACCEPTED, response_model=schemas.OrderQueued)
+async def cancel_order(order_id: str, db: AsyncSession = Depends(get_db), current_user: schemas.Principal = Depends(oauth2.get_current_user)):
+
+    query = select(models.Order.asset, models.Order.status, models.Order.kind).where(models.Order.id == order_id, models.Order.owner_id == current_user.id)
+    result = await db.execute(query)
+    ordine = result.one_or_none()
+    if not ordine or ordine.kind != "LIMIT":
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Ordine limite {order_id} non trovato")
+    if ordine.status != "OPEN":
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f"L'ordine è già {ordine.status}")
+    if not utils.redis_client:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Ordini limite non disponibili")
+
+    try:
+        await utils.manda_evento_matching(ordine.asset, {"tipo": "CANCEL", "order_id": order_id, "owner_id": current_user.id})
+    except Exception as e:
+        print(f"Errore nell'invio della cancellazione dell'ordine {order_id}: {e}")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Impossibile inviare la cancellazione, riprova più tardi")
+    return {"order_id": order_id, "status": "CANCEL_REQUESTED"}
+
+#websocket che inoltra al client l'esito dei suoi ordini appena il worker li esegue: ws://host/ws/orders?token=...
+#il token passa come parametro perchè i browser non permettono header personalizzati sui websocket
+@router.websocket("/ws/orders")
+async def ws_orders(websocket: WebSocket, token: str = Query(...)):
+    credentials_exception = WebSocketDisconnect(code=status.WS_1008_POLICY_VIOLATION, reason="Credenziali non valide")
+    try:
+        token_data = oauth2.verifica_token_di_accesso(token, credentials_exception)
+    except WebSocketDisconnect as e:
+        await websocket.close(code=e.code, reason=e.reason)
+        return
+    if not hub.disponibile:
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR, reason="Notifiche non disponibili")
+        return
+
+    await websocket.accept()
+    canali = [utils.NOTIFICHE_UTENTE_CHANNEL.format(token_data.id)]
+    coda = CodaMessaggi()
+
+    #se l'invio fallisce la connessione è chiusa: fermiamo anche la lettura
+    async def invia(task_group):
+        try:
+            while True:
+                await websocket.send_text(await coda.prossimo())
+        except (WebSocketDisconnect, RuntimeError):
+            task_group.cancel_scope.cancel()
+
+    #il client non manda nulla, ma leggere serve ad accorgersi subito della disconnessione
+    async def ricevi(task_group):
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            task_group.cancel_scope.cancel()
+
+    try:
+        await hub.iscrivi(coda, canali)
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(invia, task_group)
+            task_group.start_soon(ricevi, task_group)
+    finally:
+        #shield: la pulizia deve avvenire anche se il task della connessione è stato cancellato
+        with anyio.CancelScope(shield=True):
+            await hub.disiscrivi(coda, canali)
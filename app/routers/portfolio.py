@@ -0,0 +1,69 @@
+import asyncio
+from decimal import Decimal
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from .. import fx, models, schemas, oauth2
+from ..database import get_read_db
+from ..portfolio import Posizione
+
+router = APIRouter(
+    tags = ['Portfolio']
+)
+
+#portafoglio del wallet con costo medio, pnl realizzato e non realizzato di ogni asset, nella valuta del wallet
+#costo e pnl realizzato sono già aggregati negli holdings ad ogni trade, quindi il costo è una query sulle righe
+#del wallet (una per asset, senza leggere lo storico) più i prezzi dalla cache, letti in parallelo
+#le posizioni chiuse restano finchè hanno un pnl realizzato
+@router.get("/portfolio", response_model=schemas.Portfolio)
+async def get_portfolio(db: AsyncSession = Depends(get_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_user)):
+
+    if not current_user.wallet_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Impossibile trovare il wallet associato al tuo account, contatta l'assistenza")
+
+    query = select(
+        models.Wallet.balance, models.Wallet.currency, models.Holding.asset, models.Holding.quantity,
+        models.Holding.reserved, models.Holding.cost_basis, models.Holding.realized_pnl
+    ).outerjoin(
+        models.Holding, (models.Holding.wallet_id == models.Wallet.id) & or_(
+            models.Holding.quantity != 0, models.Holding.reserved != 0, models.Holding.realized_pnl != 0)
+    ).where(models.Wallet.id == current_user.wallet_id).order_by(models.Holding.asset)
+    result = await db.execute(query)
+    righe = result.all()
+    if not righe:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Impossibile trovare il wallet associato al tuo account, contatta l'assistenza")
+
+    valuta, saldo = righe[0].currency, righe[0].balance
+    righe = [riga for riga in righe if riga.asset is not None]
+    prezzi = await asyncio.gather(*[fx.prezzo_in_valuta(riga.asset, valuta) for riga in righe])
+
+    posizioni = []
+    for riga, prezzo in zip(righe, prezzi):
+        posizione = Posizione(riga.quantity, riga.reserved, riga.cost_basis, riga.realized_pnl)
+        valore, non_realizzato = posizione.valuta(prezzo)
+        posizioni.append({
+            "asset": riga.asset,
+            "quantity": posizione.posseduta,
+            "available": posizione.quantity,
+            "reserved": posizione.reserved,
+            "average_cost": posizione.costo_medio,
+            "cost_basis": posizione.cost_basis,
+            "price": prezzo,
+            "market_value": valore,
+            "unrealized_pnl": non_realizzato,
+            "realized_pnl": posizione.realized_pnl,
+        })
+
+    prezzi_mancanti = any(prezzo is None for prezzo in prezzi)
+    return {
+        "wallet_id": current_user.wallet_id,
+        "currency": valuta,
+        "balance": saldo,
+        "positions": posizioni,
+        "market_value": None if prezzi_mancanti else sum((voce["market_value"] for voce in posizioni), Decimal(0)),
+        "cost_basis": sum((voce["cost_basis"] for voce in posizioni), Decimal(0)),
+        "unrealized_pnl": None if prezzi_mancanti else sum((voce["unrealized_pnl"] for voce in posizioni), Decimal(0)),
+        "realized_pnl": sum((voce["realized_pnl"] for voce in posizioni), Decimal(0)),
+    }
@@ -0,0 +1,122 @@
+import asyncio
+from typing import Optional
+import anyio
+import orjson
+from fastapi import APIRouter, HTTPException, Query, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
+from .. import utils
+from ..config import settings
+from ..streaming import Iscrizione, hub
+
+router = APIRouter(
+    tags = ['Prices']
+)
+
+#ogni quanti secondi mandiamo un keepalive sse se non ci sono aggiornamenti, per non far chiudere la connessione ai proxy
+SSE_KEEPALIVE = 15
+
+#converte "BTC,ETH" nella lista dei ticker richiesti, tutti quelli supportati se il parametro manca
+def leggi_tickers(tickers: Optional[str]) -> list[str]:
+    if not tickers:
+        return list(settings.SUPPORTED_TICKERS)
+    richiesti = [ticker.strip().upper() for ticker in tickers.split(",") if ticker.strip()]
+    non_supportati = [ticker for ticker in richiesti if ticker not in settings.SUPPORTED_TICKERS]
+    if non_supportati:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Ticker non supportati: {', '.join(non_supportati)}")
+    return richiesti
+
+#prima fotografia dei prezzi presa dalla cache in-process, cosi il client non aspetta il prossimo aggiornamento
+def prezzi_attuali(tickers: list[str]) -> dict[str, str]:
+    prezzi = {}
+    for ticker in tickers:
+        voce = utils.cache_prezzi.get(ticker)
+        if voce:
+            prezzi[ticker] = str(voce[0])
+    return prezzi
+
+#i messaggi arrivano indicizzati per canale (prezzo_di_BTC), il client riceve {ticker: prezzo}
+def per_ticker(messaggi: dict[str, str]) -> dict[str, str]:
+    return {canale.removeprefix("prezzo_di_"): prezzo for canale, prezzo in messaggi.items()}
+
+
+#websocket con i prezzi in tempo reale: ws://host/ws/prices?tickers=BTC,ETH
+@router.websocket("/ws/prices")
+async def ws_prices(websocket: WebSocket, tickers: Optional[str] = Query(None)):
+    try:
+        tickers = leggi_tickers(tickers)
+    except HTTPException as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+        return
+    if not hub.disponibile:
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR, reason="Streaming dei prezzi non disponibile")
+        return
+
+    await websocket.accept()
+    canali = [f"prezzo_di_{ticker}" for ticker in tickers]
+    iscrizione = Iscrizione()
+
+    #se l'invio fallisce la connessione è chiusa: fermiamo anche la lettura
+    async def invia(task_group):
+        try:
+            prezzi = prezzi_attuali(tickers)
+            if prezzi:
+                await websocket.send_bytes(orjson.dumps(prezzi))
+            while True:
+                messaggi = await iscrizione.prossimi()
+                await websocket.send_bytes(orjson.dumps(per_ticker(messaggi)))
+        except (WebSocketDisconnect, RuntimeError):
+            task_group.cancel_scope.cancel()
+
+    #il client non manda nulla, ma leggere serve ad accorgersi subito della disconnessione
+    async def ricevi(task_group):
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            task_group.cancel_scope.cancel()
+
+    try:
+        await hub.iscrivi(iscrizione, canali)
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(invia, task_group)
+            task_group.start_soon(ricevi, task_group)
+    finally:
+        #shield: la pulizia deve avvenire anche se il task della connessione è stato cancellato
+        with anyio.CancelScope(shield=True):
+            await hub.disiscrivi(iscrizione, canali)
+
+
+#alternativa server-sent events per i client che non possono usare websocket: GET /prices/stream?tickers=BTC,ETH
+@router.get("/prices/stream")
+async def sse_prices(request: Request, tickers: Optional[str] = None):
+    tickers = leggi_tickers(tickers)
+    if not hub.disponibile:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Streaming dei prezzi non disponibile")
+
+    canali = [f"prezzo_di_{ticker}" for ticker in tickers]
+    iscrizione = Iscrizione()
+
+    #l'iscrizione parte con il generatore: se il client si disconnette prima della risposta il generatore non parte
+    #e non c'è niente da pulire
+    async def eventi():
+        try:
+            await hub.iscrivi(iscrizione, canali)
+            prezzi = prezzi_attuali(tickers)
+            if prezzi:
+                yield b"data: " + orjson.dumps(prezzi) + b"\n\n"
+            while not await request.is_disconnected():
+                try:
+                    messaggi = await asyncio.wait_for(iscrizione.prossimi(), timeout=SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                yield b"data: " + orjson.dumps(per_ticker(messaggi)) + b"\n\n"
+        finally:
+            #alla disconnessione starlette cancella il generatore, lo shield garantisce l'unsubscribe
+            with anyio.CancelScope(shield=True):
+                await hub.disiscrivi(iscrizione, canali)
+
+    return StreamingResponse(eventi(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
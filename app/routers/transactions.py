@@ -1,140 +1,440 @@
+import asyncio
+import base64
+import random
+import time
+import uuid
+from contextlib import aclosing
+from datetime import datetime
 from decimal import Decimal
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy import case, func
-from .. import models, schemas, oauth2, utils
+from typing import Literal, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, status
+from sqlalchemy import text, tuple_, update
+from sqlalchemy.orm.exc import StaleDataError
+from .. import database, export, fx, idempotency, ledger, metrics, models, schemas, oauth2, utils
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from ..database import get_db
+from ..config import settings
+from ..database import get_db, get_read_db
 
 router = APIRouter(
     tags = ['Transactions']
 )
 
+#lettura del wallet per depositi e prelievi, in base a BALANCE_CONCURRENCY:
+#pessimistic lo blocca con FOR UPDATE fino al commit, optimistic lo legge senza lock e lascia il controllo
+#alla versione nell'UPDATE (vedi models.Wallet); populate_existing perchè dopo un conflitto servono saldo e versione nuovi
+async def leggi_wallet(db: AsyncSession, wallet_id: int) -> models.Wallet | None:
+    query = select(models.Wallet).where(models.Wallet.id == wallet_id).execution_options(populate_existing=True)
+    if settings.BALANCE_CONCURRENCY == "pessimistic":
+        query = query.with_for_update()
+    result = await db.execute(query)
+    return result.scalar_one_or_none()
+
+#tempo in cui depositi e prelievi tengono il wallet bloccato, dalla lettura con FOR UPDATE al commit
+def registra_lock(percorso: str, inizio: float):
+    if settings.BALANCE_CONCURRENCY == "pessimistic":
+        metrics.WALLET_LOCK_HOLD.labels(percorso).observe(time.perf_counter() - inizio)
+
+#esegue il movimento (che finisce con il commit) e se un'altra richiesta ha modificato il wallet dopo la nostra lettura
+#annulla e riprova, con un'attesa casuale crescente cosi le richieste in conflitto non si ripresentano tutte insieme
+#in modalità pessimistica il conflitto non può capitare e il movimento viene eseguito una volta sola
+async def con_riprova(db: AsyncSession, endpoint: str, movimento):
+    tentativo = 0
+    while True:
+        try:
+            return await movimento()
+        except StaleDataError:
+            await db.rollback()
+            if tentativo >= settings.OPTIMISTIC_MAX_RETRIES:
+                metrics.WALLET_VERSION_CONFLICTS.labels(endpoint=endpoint, outcome="exhausted").inc()
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                    detail="Il wallet è stato modificato da troppe richieste concorrenti, riprova",
+                                    headers={"Retry-After": "1"})
+            metrics.WALLET_VERSION_CONFLICTS.labels(endpoint=endpoint, outcome="retried").inc()
+            await asyncio.sleep(random.uniform(0, settings.OPTIMISTIC_BACKOFF * 2 ** tentativo))
+            tentativo += 1
+
 #endpoint per il deposito sul wallet dell'utente
 @router.post("/deposit", status_code=status.HTTP_202_ACCEPTED, response_model=schemas.TransactionResponse)
-async def deposit(deposito: schemas.WalletDeposit, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
-    
-    #recuperiamo il wallet dell'utente
-    query = select(models.Wallet).where(models.Wallet.owner_id == current_user.id).with_for_update()
-    result = await db.execute(query)
-    wallet = result.scalar_one_or_none()
-    if not wallet:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"Errore: wallet dell'utente: {current_user.email} non trovato")
-    #se abbiamo il wallet facciamo il deposito
-    #il controllo del deposito maggiore di zero viene già effettuato dal nostro schema Pydantic
-    wallet.balance += deposito.deposit
-
-    #creiamo la transazione
-    transazione = models.Transaction(
-        wallet_id = wallet.id,
-        type = "DEPOSIT",
-        asset = wallet.currency,
-        amount = deposito.deposit,
-        price_at_the_moment = "1",
-        total_payed = deposito.deposit,
-        status = "COMPLETED",
-    )
-    wallet.transactions.append(transazione)
-    await db.commit()
-    await db.refresh(transazione)
-    return transazione
+async def deposit(deposito: schemas.WalletDeposit, db: AsyncSession = Depends(get_db), current_user: schemas.Principal = Depends(oauth2.get_current_user),
+                  idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+
+    richiesta = idempotency.richiesta(current_user.id, idempotency_key, "deposit", deposito)
+
+    async def movimento():
+        #recuperiamo il wallet dell'utente
+        wallet = await leggi_wallet(db, current_user.wallet_id)
+        bloccato_da = time.perf_counter()
+        if not wallet:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"Errore: wallet dell'utente: {current_user.email} non trovato")
+        #se abbiamo il wallet facciamo il deposito
+        #il controllo del deposito maggiore di zero viene già effettuato dal nostro schema Pydantic
+        wallet.balance += deposito.deposit
+
+        #creiamo la transazione
+        transazione = models.Transaction(
+            wallet_id = wallet.id,
+            type = "DEPOSIT",
+            asset = wallet.currency,
+            amount = deposito.deposit,
+            price_at_the_moment = "1",
+            total_payed = deposito.deposit,
+            status = "COMPLETED",
+        )
+        db.add(transazione)
+        #flush per avere l'id della transazione da collegare alle righe del mastro (e per il controllo della versione)
+        await db.flush()
+        await ledger.registra(db, ledger.deposito(wallet.id, wallet.currency, deposito.deposit, transazione.id))
+        #created_at arriva già dal RETURNING dell'insert: la risposta si prepara prima del commit, che fa scadere l'oggetto
+        risposta = schemas.TransactionResponse.model_validate(transazione)
+        await idempotency.salva(db, richiesta, risposta)
+        await db.commit()
+        registra_lock("deposit", bloccato_da)
+        return risposta
+
+    return await idempotency.esegui(db, richiesta, lambda: con_riprova(db, "deposit", movimento))
 
 #endpoint per il prelievo di un utente
 @router.post("/withdrawal", status_code=status.HTTP_202_ACCEPTED, response_model=schemas.TransactionResponse)
-async def withdrawal(prelievo: schemas.WalletWithdrawal, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
-    #recuperiamo il wallet dell'utente
-    query = select(models.Wallet).where(models.Wallet.owner_id == current_user.id).with_for_update()
+async def withdrawal(prelievo: schemas.WalletWithdrawal, db: AsyncSession = Depends(get_db), current_user: schemas.Principal = Depends(oauth2.get_current_user),
+                     idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+
+    richiesta = idempotency.richiesta(current_user.id, idempotency_key, "withdrawal", prelievo)
+
+    async def movimento():
+        #recuperiamo il wallet dell'utente
+        wallet = await leggi_wallet(db, current_user.wallet_id)
+        bloccato_da = time.perf_counter()
+        if not wallet:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"Non è stato possibile recuperare il wallet di: {current_user.email}")
+        #facciamo il prelievo solo se ha abbastanza soldi sul conto
+        #il controllo che sia maggiore di zero lo fa gia il nostro schema pydantic
+        #in modalità ottimistica il saldo letto può essere già cambiato: se è cosi l'UPDATE fallisce e si riprova con quello nuovo
+        if wallet.balance >= prelievo.withdrawal:
+            wallet.balance -= prelievo.withdrawal
+        else:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                                detail="Stai cercando di prelevare un import maggiore di quello disponibile")
+        #creiamo la transazione
+        transaction = models.Transaction(
+            wallet_id = wallet.id,
+            type = "WITHDRAWAL",
+            asset = wallet.currency,
+            amount = prelievo.withdrawal,
+            price_at_the_moment = "1",
+            total_payed = prelievo.withdrawal,
+            status = "COMPLETED",
+            )
+        #aggiungiamo la transazione alla sessione
+        db.add(transaction)
+        await db.flush()
+        await ledger.registra(db, ledger.prelievo(wallet.id, wallet.currency, prelievo.withdrawal, transaction.id))
+        risposta = schemas.TransactionResponse.model_validate(transaction)
+        await idempotency.salva(db, richiesta, risposta)
+        await db.commit()
+        registra_lock("withdrawal", bloccato_da)
+        return risposta
+
+    return await idempotency.esegui(db, richiesta, lambda: con_riprova(db, "withdrawal", movimento))
+
+#trade in un'unica istruzione sql: ogni CTE legge le righe restituite dalla precedente,
+#quindi se la condizione sul saldo (BUY) o sulla quantità posseduta (SELL) non è soddisfatta non viene scritto nulla
+#e la query non restituisce righe; la condizione è nel WHERE dell'UPDATE, che la ricontrolla sulla riga bloccata,
+#quindi due trade concorrenti non possono spendere gli stessi fondi e non serve leggere il wallet prima con FOR UPDATE
+#il wallet viene sempre bloccato per primo, come nel worker, cosi BUY e SELL concorrenti non vanno in deadlock
+#il prezzo si legge prima di aprire la transazione e il lock dura solo istruzione e commit, in entrambe le modalità
+#di BALANCE_CONCURRENCY; la versione del wallet viene incrementata per invalidare le letture ottimistiche in corso
+#la stessa istruzione aggiorna costo e pnl realizzato dell'holding con il costo medio, come portfolio.Posizione.vendi:
+#nel SET i valori a destra sono quelli della riga prima dell'aggiornamento
+RIGHE_TRADE = """
+transazione AS (
+    INSERT INTO transactions (wallet_id, type, asset, amount, price_at_the_moment, total_payed, status)
+    SELECT wallet_id, CAST(:tipo AS varchar), CAST(:asset AS varchar), CAST(:quantita AS numeric), CAST(:prezzo AS numeric),
+           CAST(:totale AS numeric), 'COMPLETED'
+    FROM holding
+    RETURNING id, wallet_id, type, asset, amount, price_at_the_moment, total_payed, status, created_at
+),
+mastro AS (
+    INSERT INTO postings (entry_id, entry_type, account, wallet_id, asset, amount, transaction_id)
+    SELECT CAST(:entry_id AS varchar), CAST(:tipo AS varchar), v.account, v.wallet_id, v.asset, v.amount, transazione.id
+    FROM transazione, unnest(CAST(:conti AS varchar[]), CAST(:wallet_ids AS integer[]), CAST(:assets AS varchar[]), CAST(:importi AS numeric[]))
+         AS v(account, wallet_id, asset, amount)
+)
+SELECT * FROM transazione
+"""
+
+TRADE_BUY = text("""
+WITH wallet AS (
+    UPDATE wallets SET balance = balance - CAST(:totale AS numeric), version = version + 1
+    WHERE id = :wallet_id AND currency = :valuta AND balance >= CAST(:totale AS numeric)
+    RETURNING id
+),
+holding AS (
+    INSERT INTO holdings (wallet_id, asset, quantity, cost_basis)
+    SELECT id, CAST(:asset AS varchar), CAST(:quantita AS numeric), CAST(:totale AS numeric) FROM wallet
+    ON CONFLICT (wallet_id, asset) DO UPDATE SET quantity = holdings.quantity + excluded.quantity,
+        cost_basis = holdings.cost_basis + excluded.cost_basis, updated_at = now()
+    RETURNING wallet_id
+),""" + RIGHE_TRADE)
+
+#nel SELL la condizione è sull'holding: il wallet viene prima solo bloccato (FOR UPDATE, per l'ordine dei lock)
+#e l'accredito dipende dall'holding aggiornato, cosi se le crypto non bastano anche il saldo resta com'è
+TRADE_SELL = text("""
+WITH bloccato AS (
+    SELECT id FROM wallets WHERE id = :wallet_id AND currency = :valuta FOR UPDATE
+),
+holding AS (
+    UPDATE holdings SET quantity = holdings.quantity - CAST(:quantita AS numeric),
+        cost_basis = holdings.cost_basis - ROUND(holdings.cost_basis * CAST(:quantita AS numeric) / (holdings.quantity + holdings.reserved), 8),
+        realized_pnl = holdings.realized_pnl + CAST(:totale AS numeric)
+            - ROUND(holdings.cost_basis * CAST(:quantita AS numeric) / (holdings.quantity + holdings.reserved), 8),
+        updated_at = now()
+    FROM bloccato
+    WHERE holdings.wallet_id = bloccato.id AND holdings.asset = :asset AND holdings.quantity >= CAST(:quantita AS numeric)
+    RETURNING holdings.wallet_id
+),
+wallet AS (
+    UPDATE wallets SET balance = balance + CAST(:totale AS numeric), version = version + 1
+    WHERE id IN (SELECT wallet_id FROM holding)
+    RETURNING id
+),""" + RIGHE_TRADE)
+
+#spiega perchè il trade non è stato eseguito; si arriva qui solo dopo il rollback, quindi non rallenta i trade riusciti
+async def motivo_trade_rifiutato(db: AsyncSession, trade: schemas.TransactionCreate, current_user: schemas.Principal, valuta: str) -> HTTPException:
+    query = select(models.Wallet.balance, models.Wallet.currency, models.Holding.quantity).outerjoin(
+        models.Holding, (models.Holding.wallet_id == models.Wallet.id) & (models.Holding.asset == trade.asset)
+    ).where(models.Wallet.id == current_user.wallet_id)
     result = await db.execute(query)
-    wallet = result.scalar_one_or_none()
-    if not wallet:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"Non è stato possibile recuperare il wallet di: {current_user.email}")
-    #facciamo il prelievo solo se ha abbastanza soldi sul conto
-    #il controllo che sia maggiore di zero lo fa gia il nostro schema pydantic
-    if wallet.balance >= prelievo.withdrawal:
-        wallet.balance -= prelievo.withdrawal
-    else:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                            detail="Stai cercando di prelevare un import maggiore di quello disponibile")
-    #creiamo la transazione
-    transaction = models.Transaction(
-        wallet_id = wallet.id,
-        type = "WITHDRAWAL",
-        asset = wallet.currency,
-        amount = prelievo.withdrawal,
-        price_at_the_moment = "1",
-        total_payed = prelievo.withdrawal,
-        status = "COMPLETED",
-        )
-    #aggiungiamo la transazione al wallet
-    wallet.transactions.append(transaction)
-    await db.commit()
-    await db.refresh(transaction)
-    return transaction
+    riga = result.one_or_none()
+    if not riga:
+        return HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                             detail="Impossibile trovare il wallet associato al tuo account, contatta l'assistenza")
+    if riga.currency != valuta:
+        #la valuta nel principal in cache non è più quella del wallet
+        await oauth2.invalida_principal(current_user.id)
+        return HTTPException(status_code=status.HTTP_409_CONFLICT,
+                             detail="La valuta del wallet è cambiata, riprova")
+    if trade.type == "BUY":
+        return HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                             detail=f"Hai un saldo troppo basso: {riga.balance}")
+    return HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                         detail=f"non hai crypto sufficienti da vendere, hai aquistato: {riga.quantity or Decimal(0)}")
 
 #endpoint per le transazioni buy o sell
+#il prezzo di binance (in USDT) viene convertito nella valuta del wallet con il cambio in cache,
+#poi saldo, holdings, transazione e righe del mastro si aggiornano con una sola istruzione: con principal e prezzo in cache
+#il trade costa due round-trip verso il db (l'istruzione e il commit), tre con Idempotency-Key
 @router.post("/trade", status_code=status.HTTP_202_ACCEPTED, response_model=schemas.TransactionResponse)
-async def trade(trade: schemas.TransactionCreate, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
+async def trade(trade: schemas.TransactionCreate, db: AsyncSession = Depends(get_db), current_user: schemas.Principal = Depends(oauth2.get_current_user),
+                idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
 
-    #recupero il wallet utente
-    query = select(models.Wallet).where(models.Wallet.owner_id == current_user.id).with_for_update()
-    result = await db.execute(query)
-    wallet = result.scalar_one_or_none()
-    if not wallet:
+    if not current_user.wallet_id:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="Impossibile trovare il wallet associato al tuo account, contatta l'assistenza")
-    
-    #trovato il wallet prendiamo il prezzo, lui ci fornisce solo type, asset e amount(con controllo > 0 già fatto da Pydantic)
-    prezzo = await utils.get_real_price(trade.asset)
-    totale_da_pagare = trade.amount * prezzo
+    valuta = current_user.wallet_currency or settings.DEFAULT_CURRENCY
 
-    #controllo che abbia abbastanza saldo disponibile sul wallet se è un'acquisto
-    if trade.type == "BUY":
-        if totale_da_pagare > wallet.balance:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                                detail=f"Hai un saldo troppo basso: {wallet.balance}")
-        else:
-            wallet.balance -= totale_da_pagare
-    
-    #se è una vendita controlliamo se ci sono transazioni passate di aquisto e le sommiamo
-    #prendiamo transazioni collegate al wallet, dove l'asset è lo stesso che desidera vendere, e sottraiamo la somma di tutti i buy con tutti i sell
-    elif trade.type == "SELL":
-        # Query SQL ottimizzata che fa la somma matematica direttamente nel DB
-        query = select(
-            func.sum(
-                case(
-                    (models.Transaction.type == "BUY", models.Transaction.amount), # Se è BUY, aggiungi amount
-                    (models.Transaction.type == "SELL", -models.Transaction.amount), # Se è SELL, sottrai amount
-                    else_=0
-                )
-            )
-        ).where(
-            models.Transaction.wallet_id == wallet.id, 
-            models.Transaction.asset == trade.asset
-        )
-        result = await db.execute(query)
-        #le sommiamo tutte e ottiamo il totale in Decimal
-        totale = result.scalar() or Decimal(0)
-        #controlliamo se il totale degli euro è inferiore della somma che lui vuole vendere
-        if trade.amount > totale:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                                detail=f"non hai crypto sufficienti da vendere, hai aquistato: {totale}")
-        else: 
-            wallet.balance += totale_da_pagare
-        
-    #creiamo la transazione
-    transazione = models.Transaction(
-        wallet_id = wallet.id,
-        price_at_the_moment = prezzo,
-        total_payed = totale_da_pagare,
-        status = "COMPLETED",
+    #con Idempotency-Key una richiesta ripetuta riceve la risposta salvata prima ancora di leggere il prezzo
+    richiesta = idempotency.richiesta(current_user.id, idempotency_key, "trade", trade)
+
+    async def movimento():
+        #lui ci fornisce solo type, asset e amount(con controllo > 0 già fatto da Pydantic)
+        prezzo = await fx.prezzo_in_valuta(trade.asset, valuta)
+        if prezzo is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"Prezzo non disponibile per l'asset: {trade.asset} in {valuta}")
+        #arrotondato prima di toccare il saldo, cosi saldo e mastro registrano lo stesso importo
+        totale_da_pagare = ledger.arrotonda(trade.amount * prezzo)
+
+        righe_mastro = ledger.scambio(trade.type, current_user.wallet_id, valuta, trade.asset, trade.amount, totale_da_pagare)
+        parametri = {
+            "wallet_id": current_user.wallet_id,
+            "valuta": valuta,
+            "tipo": trade.type,
+            "asset": trade.asset,
+            "quantita": trade.amount,
+            "prezzo": prezzo,
+            "totale": totale_da_pagare,
+            "entry_id": righe_mastro[0]["entry_id"],
+            "conti": [riga["account"] for riga in righe_mastro],
+            "wallet_ids": [riga["wallet_id"] for riga in righe_mastro],
+            "assets": [riga["asset"] for riga in righe_mastro],
+            "importi": [riga["amount"] for riga in righe_mastro],
+        }
+        #il lock sulla riga del wallet parte con l'UPDATE dell'istruzione e finisce con il commit
+        bloccato_da = time.perf_counter()
+        result = await db.execute(TRADE_BUY if trade.type == "BUY" else TRADE_SELL, parametri)
+        transazione = result.mappings().one_or_none()
+        if transazione is None:
+            #con un SELL il saldo può essere già stato accreditato prima di scoprire che le crypto non bastano
+            await db.rollback()
+            raise await motivo_trade_rifiutato(db, trade, current_user, valuta)
+        risposta = schemas.TransactionResponse.model_validate(dict(transazione))
+        await idempotency.salva(db, richiesta, risposta)
+        await db.commit()
+        metrics.WALLET_LOCK_HOLD.labels("trade").observe(time.perf_counter() - bloccato_da)
+        #istruzione sql senza ORM: segnaliamo noi la scrittura per il read-your-writes della replica
+        database.segna_scrittura(current_user.id)
+        return risposta
+
+    return await idempotency.esegui(db, richiesta, movimento)
+
+
+#endpoint per le transazioni buy o sell in modalità asincrona
+#l'ordine viene solo salvato e messo in coda, il worker lo esegue a batch insieme agli altri
+#risponde subito con 202 e l'id dell'ordine, senza prendere lock sul wallet
+@router.post("/trade/async", status_code=status.HTTP_202_ACCEPTED, response_model=schemas.OrderQueued)
+async def trade_async(trade: schemas.TransactionCreate, db: AsyncSession = Depends(get_db), current_user: schemas.Principal = Depends(oauth2.get_current_user)):
+
+    if not utils.redis_client or not current_user.wallet_id:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Modalità asincrona non disponibile, usa POST /trade")
+
+    #il prezzo viene fissato al momento dell'invio nella valuta del wallet, come nel trade sincrono
+    valuta = current_user.wallet_currency or settings.DEFAULT_CURRENCY
+    prezzo = await fx.prezzo_in_valuta(trade.asset, valuta)
+    if prezzo is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Prezzo non disponibile per l'asset: {trade.asset} in {valuta}")
+
+    order_id = uuid.uuid4().hex
+    ordine = models.Order(
+        id = order_id,
+        owner_id = current_user.id,
+        wallet_id = current_user.wallet_id,
+        price = prezzo,
+        status = "QUEUED",
         **trade.model_dump()
     )
-    wallet.transactions.append(transazione)
+    db.add(ordine)
+    #il messaggio va preparato prima del commit, che fa scadere gli oggetti caricati dalla sessione
+    messaggio = {"order_id": order_id, "owner_id": current_user.id, "price": prezzo, **trade.model_dump()}
+    #salviamo l'ordine prima di metterlo in coda, cosi il worker lo trova sempre
     await db.commit()
-    await db.refresh(transazione)
-    return transazione
 
+    try:
+        await utils.manda_ordine_in_coda(messaggio)
+    except Exception as e:
+        print(f"Errore nell'invio in coda dell'ordine {order_id}: {e}")
+        await db.execute(update(models.Order).where(models.Order.id == order_id).values(status="REJECTED", reason="Coda ordini non disponibile"))
+        await db.commit()
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Impossibile mettere in coda l'ordine, riprova più tardi")
+
+    return {"order_id": order_id, "status": "QUEUED"}
+
+
+#il cursore è la coppia (created_at, id) dell'ultima transazione della pagina, codificata in base64
+#cosi il client lo tratta come una stringa opaca
+def codifica_cursore(created_at: datetime, id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{id}".encode()).decode()
+
+def decodifica_cursore(cursore: str) -> tuple[datetime, int]:
+    try:
+        created_at, id = base64.urlsafe_b64decode(cursore.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(id)
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Cursore non valido")
+
+#endpoint per lo storico delle transazioni dell'utente, paginato con keyset pagination su (created_at, id)
+#a differenza di OFFSET il costo di ogni pagina non cresce con la profondità dello storico
+@router.get("/transactions", response_model=schemas.TransactionPage)
+async def get_transactions(limit: int = Query(50, ge=1, le=500),
+                           cursor: Optional[str] = None,
+                           asset: Optional[str] = None,
+                           type: Optional[Literal["BUY", "SELL", "DEPOSIT", "WITHDRAWAL"]] = None,
+                           from_date: Optional[datetime] = Query(None, alias="from"),
+                           to_date: Optional[datetime] = Query(None, alias="to"),
+                           db: AsyncSession = Depends(get_read_db),
+                           current_user: schemas.Principal = Depends(oauth2.get_current_user)):
+
+    #ordiniamo dalla più recente alla più vecchia, l'id serve a rendere l'ordine stabile a parità di created_at
+    query = select(models.Transaction).where(
+        models.Transaction.wallet_id == current_user.wallet_id
+    ).order_by(
+        models.Transaction.created_at.desc(), models.Transaction.id.desc()
+    )
+
+    if asset:
+        query = query.where(models.Transaction.asset == asset)
+    if type:
+        query = query.where(models.Transaction.type == type)
+    if from_date:
+        query = query.where(models.Transaction.created_at >= from_date)
+    if to_date:
+        query = query.where(models.Transaction.created_at < to_date)
+    #ripartiamo subito dopo l'ultima riga della pagina precedente
+    if cursor:
+        query = query.where(tuple_(models.Transaction.created_at, models.Transaction.id) < decodifica_cursore(cursor))
+
+    #chiediamo una riga in più per sapere se esiste una pagina successiva senza fare un COUNT
+    result = await db.execute(query.limit(limit + 1))
+    transazioni = result.scalars().all()
+
+    next_cursor = None
+    if len(transazioni) > limit:
+        transazioni = transazioni[:limit]
+        ultima = transazioni[-1]
+        next_cursor = codifica_cursore(ultima.created_at, ultima.id)
+
+    return {"items": transazioni, "next_cursor": next_cursor}
+
+
+#estratto conto completo per compliance e dichiarazioni fiscali, dalla più vecchia alla più recente
+#le righe arrivano da un cursore lato server (yield_per) a blocchi di EXPORT_CHUNK_SIZE e vengono serializzate e inviate
+#man mano, senza passare dai modelli pydantic: la memoria non dipende dalla lunghezza dello storico e il client riceve
+#i primi byte subito, quindi anche milioni di righe non fanno scadere i timeout di inattività dei proxy
+#la sessione è aperta dentro la risposta e resta sulla replica quando possibile per tutta l'esportazione
+#le esportazioni contemporanee sono limitate da export.esportazioni: se sono tutte occupate si risponde subito 503
+@router.get("/transactions/export")
+async def export_transactions(format: Literal["csv", "parquet", "ndjson"] = "csv",
+                              from_date: Optional[datetime] = Query(None, alias="from"),
+                              to_date: Optional[datetime] = Query(None, alias="to"),
+                              current_user: schemas.Principal = Depends(oauth2.get_current_user)):
+    #solo le colonne esportate, in ordine (created_at, id) sull'indice ix_transactions_wallet_created_id
+    query = select(*(getattr(models.Transaction, colonna) for colonna in export.COLONNE[:-1])).where(
+        models.Transaction.wallet_id == current_user.wallet_id
+    ).order_by(
+        models.Transaction.created_at, models.Transaction.id
+    )
+    if from_date:
+        query = query.where(models.Transaction.created_at >= from_date)
+    if to_date:
+        query = query.where(models.Transaction.created_at < to_date)
+
+    #il semaforo si prende qui e non nel corpo, che parte solo dopo l'invio degli header: in una raffica le richieste in più
+    #ricevono 503 invece di un 200 che resta appeso; tra locked() e acquire() non c'è nessun await (acquire non si sospende
+    #se il semaforo è libero), quindi due richieste non possono passare il controllo per lo stesso posto
+    if export.esportazioni.locked():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Troppe esportazioni in corso, riprova tra poco",
+                            headers={"Retry-After": "5"})
+    await export.esportazioni.acquire()
+
+    #il posto si libera una volta sola: alla chiusura del corpo (fine, errore o client disconnesso) oppure, se il corpo
+    #non parte mai, alla fine della risposta (vedi export.RispostaEsportazione)
+    rilasciato = False
+    def rilascia():
+        nonlocal rilasciato
+        if not rilasciato:
+            rilasciato = True
+            export.esportazioni.release()
 
+    #la chiusura del corpo chiude anche il serializzatore, il cursore e la sessione
+    async def corpo():
+        try:
+            async with database.ReadSessionLocal() as db:
+                result = await db.stream(query.execution_options(yield_per=settings.EXPORT_CHUNK_SIZE))
+                async with aclosing(export.ESPORTATORI[format](result.partitions(), current_user.wallet_currency)) as parti:
+                    async for parte in parti:
+                        yield parte
+        finally:
+            rilascia()
 
+    return export.RispostaEsportazione(corpo(),
+                                       media_type=export.MEDIA_TYPE[format],
+                                       headers={"Content-Disposition": f'attachment; filename="transactions_{current_user.wallet_id}.{format}"',
+                                                "X-Accel-Buffering": "no"},
+                                       rilascia=rilascia)
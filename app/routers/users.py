@@ -1,8 +1,9 @@
 from fastapi import APIRouter, status, HTTPException, Depends
-from .. import schemas, models, utils, oauth2
+from .. import database, schemas, models, utils, oauth2
+from ..config import settings
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from ..database import get_db
+from ..database import get_db, get_read_db
 
 
 router = APIRouter(
@@ -13,6 +14,11 @@ router = APIRouter(
 @router.post("/user", status_code=status.HTTP_201_CREATED, response_model=schemas.UserResponse)
 async def create_user(nuovo_utente: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
 
+    nuovo_utente.currency = (nuovo_utente.currency or settings.DEFAULT_CURRENCY).upper()
+    if nuovo_utente.currency not in settings.SUPPORTED_CURRENCIES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Valuta non supportata: {nuovo_utente.currency}")
+
     #controlliamo innanzitutto che la mail non sia già presente nel db con una richiesta asincrona, in modo che mentre viene 
     #processata restituiamo il controllo all'event loop 
     query = select(models.User).where(models.User.email == nuovo_utente.email)
@@ -23,15 +29,15 @@ async def create_user(nuovo_utente: schemas.UserCreate, db: AsyncSession = Depen
                             detail=f"Esiste già un utente con questa mail: {nuovo_utente.email}")
     
     #hashiamo la password inserita dall'utente e la salviamo al posto di quella inserita
-    hashed_password = utils.hash(nuovo_utente.password)
+    hashed_password = await utils.hash_async(nuovo_utente.password)
     nuovo_utente.password = hashed_password
 
     #aggiungiamo il nuovo utente al database
-    new_user = models.User(**nuovo_utente.model_dump())
+    new_user = models.User(**nuovo_utente.model_dump(exclude={"currency"}))
 
     #creiamo anche un wallet per l'utente
     new_wallet = models.Wallet(
-                    currency = "EUR",
+                    currency = nuovo_utente.currency,
                     balance = 0,
                     )
     #aggiungiamo al utente il suo wallet, sqlalchemy capisce automaticamente che deve inserire l'id in owner_id
@@ -40,12 +46,14 @@ async def create_user(nuovo_utente: schemas.UserCreate, db: AsyncSession = Depen
     db.add(new_user)
     await db.commit()
     await db.refresh(new_user)
+    #le prime letture del nuovo utente vanno sul primario, la replica potrebbe non avere ancora il suo account
+    database.segna_scrittura(new_user.id)
 
     return new_user
 
 #endpoint per permettere all'utente di aver accesso alle sue informazioni dell'account (dopo login)
 @router.get("/user", response_model=schemas.UserResponse)
-async def get_user_info(db: AsyncSession = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
+async def get_user_info(db: AsyncSession = Depends(get_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_user)):
 
     #query per prendere le sue info
     query = select(models.User).where(models.User.id == current_user.id)
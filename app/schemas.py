@@ -11,6 +11,8 @@ class UserCreate(BaseModel):
     email: EmailStr
     password: str = Field(min_length=8) #usiamo field per validare la lunghezza min della password
     #se è troppo corta restituisce eccezione 422 automaticamente
+    #valuta del wallet creato alla registrazione, deve essere in SUPPORTED_CURRENCIES (DEFAULT_CURRENCY se manca)
+    currency: Optional[str] = None
 
 #modello per la restituzione dei dati dell'utente 
 class UserResponse(BaseModel):
@@ -19,7 +21,7 @@ class UserResponse(BaseModel):
     created_at: datetime
 
     #restituiamo anche il wallet creato e envenutali transazioni se esistono (codice annidato in WalletResponse)
-    wallets: List[WalletResponse] = []
+    wallets: List["WalletResponse"] = []
 
     class Config:
         from_attributes = True #per dire a pydantic di non aspettarsi un dizionario ma di leggere i dati dagli attributi dell'oggetto
@@ -39,6 +41,15 @@ class TokenData(BaseModel):
     id: Optional[int] = None
 
 
+#utente autenticato in versione leggera: solo i dati che servono agli endpoint, senza relazioni
+#è quello che restituisce get_current_user ed è quello che viene messo in cache
+class Principal(BaseModel):
+    id: int
+    email: str
+    wallet_id: Optional[int] = None
+    wallet_currency: Optional[str] = None
+
+
 #nessun modello per la creazione di wallet, perchè lo creiamo in automatico alla registrazione dell'utente
 
 #modello per la restituzione del wallet di un utente
@@ -49,8 +60,7 @@ class WalletResponse(BaseModel):
     balance: Decimal
     created_at: datetime
 
-    #restituiamo anche le transazioni associate
-    transactions: List[TransactionResponse] = []
+    #le transazioni non vengono più annidate nel wallet, lo storico si legge paginato da GET /transactions
 
     class Config:
         from_attributes = True 
@@ -64,10 +74,42 @@ class WalletWithdrawal(BaseModel):
 
 #modello per la creazione di una transazione
 class TransactionCreate(BaseModel):
-    type: str = Literal["BUY", "SELL"]
+    type: Literal["BUY", "SELL"]
     asset: str
     amount: Decimal = Field(gt=0)
 
+#modello per l'invio di un ordine limite: viene eseguito solo contro ordini di altri utenti a un prezzo uguale o migliore
+class LimitOrderCreate(BaseModel):
+    type: Literal["BUY", "SELL"]
+    asset: str
+    amount: Decimal = Field(gt=0, decimal_places=8)
+    price: Decimal = Field(gt=0, decimal_places=8)
+
+#risposta dell'invio di un ordine in modalità asincrona, l'ordine verrà eseguito dal worker
+class OrderQueued(BaseModel):
+    order_id: str
+    status: str
+
+#stato di un ordine asincrono: QUEUED in coda, EXECUTED eseguito (con la transazione creata), REJECTED rifiutato (con il motivo)
+#per gli ordini limite: OPEN nel book (filled indica quanto è già stato eseguito), FILLED eseguito del tutto, CANCELLED cancellato
+class OrderResponse(BaseModel):
+    id: str
+    wallet_id: int
+    kind: Literal["MARKET", "LIMIT"] = "MARKET"
+    type: str
+    asset: str
+    amount: Decimal
+    price: Decimal
+    filled: Decimal = Decimal(0)
+    status: Literal["QUEUED", "EXECUTED", "REJECTED", "OPEN", "FILLED", "CANCELLED"]
+    reason: Optional[str] = None
+    transaction_id: Optional[int] = None
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        from_attributes = True
+
 #modello per la restituzione di una transazione
 class TransactionResponse(BaseModel):
     id: int
@@ -82,3 +124,56 @@ class TransactionResponse(BaseModel):
 
     class Config:
         from_attributes = True
+
+#modello per una pagina dello storico delle transazioni
+#next_cursor è il cursore opaco da passare alla richiesta successiva, None se non ci sono altre pagine
+class TransactionPage(BaseModel):
+    items: List[TransactionResponse]
+    next_cursor: Optional[str] = None
+
+#posizione su un asset in GET /portfolio, importi nella valuta del wallet
+#quantity è la quantità posseduta (available più reserved dagli ordini limite SELL aperti), average_cost il costo medio di carico
+#price, market_value e unrealized_pnl sono None se il prezzo dell'asset non è disponibile
+class PortfolioPosition(BaseModel):
+    asset: str
+    quantity: Decimal
+    available: Decimal
+    reserved: Decimal
+    average_cost: Optional[Decimal] = None
+    cost_basis: Decimal
+    price: Optional[Decimal] = None
+    market_value: Optional[Decimal] = None
+    unrealized_pnl: Optional[Decimal] = None
+    realized_pnl: Decimal
+
+#portafoglio di un wallet: saldo, posizioni e totali (market_value e unrealized_pnl None se manca il prezzo di un asset)
+class Portfolio(BaseModel):
+    wallet_id: int
+    currency: str
+    balance: Decimal
+    positions: List[PortfolioPosition]
+    market_value: Optional[Decimal] = None
+    cost_basis: Decimal
+    unrealized_pnl: Optional[Decimal] = None
+    realized_pnl: Decimal
+
+#candela OHLCV di GET /candles/{asset}: start è l'inizio della finestra, volume la quantità scambiata e trades il numero di eseguiti
+#sull'exchange (le candele della valuta dei prezzi di binance si muovono anche senza trade, con i prezzi di mercato)
+class Candle(BaseModel):
+    start: datetime
+    open: Decimal
+    high: Decimal
+    low: Decimal
+    close: Decimal
+    volume: Decimal
+    trades: int
+
+    class Config:
+        from_attributes = True
+
+#saldi di un wallet nel libro mastro ad un istante: disponibili (WALLET) e bloccati dagli ordini limite aperti (RESERVED)
+class LedgerBalances(BaseModel):
+    wallet_id: int
+    at: Optional[datetime] = None
+    available: dict[str, Decimal]
+    reserved: dict[str, Decimal]
@@ -0,0 +1,128 @@
+import asyncio
+from typing import Iterable
+from . import utils
+
+#fan-out in-process dei canali pub/sub di redis verso i client websocket/sse
+#ogni processo uvicorn tiene una sola connessione pub/sub e un solo SUBSCRIBE per canale,
+#indipendentemente da quanti client sono connessi: i messaggi vengono poi distribuiti in memoria
+
+#iscrizione di un singolo client, con conflation: per ogni canale si tiene solo l'ultimo messaggio
+#se il client è lento non si accumula una coda, al prossimo invio riceve direttamente il valore più recente
+class Iscrizione:
+    __slots__ = ("ultimi", "evento")
+
+    def __init__(self):
+        self.ultimi: dict[str, str] = {}
+        self.evento = asyncio.Event()
+
+    def pubblica(self, canale: str, messaggio: str):
+        self.ultimi[canale] = messaggio
+        self.evento.set()
+
+    #aspetta almeno un messaggio e restituisce l'ultimo valore di ogni canale aggiornato dall'invio precedente
+    async def prossimi(self) -> dict[str, str]:
+        await self.evento.wait()
+        self.evento.clear()
+        messaggi, self.ultimi = self.ultimi, {}
+        return messaggi
+
+
+#iscrizione senza conflation, per i messaggi che vanno consegnati tutti (es. esiti degli ordini)
+#la coda è comunque limitata: se il client non legge, i messaggi più vecchi vengono scartati
+class CodaMessaggi:
+    __slots__ = ("coda",)
+
+    def __init__(self, max_size: int = 100):
+        self.coda: asyncio.Queue[str] = asyncio.Queue(maxsize=max_size)
+
+    def pubblica(self, canale: str, messaggio: str):
+        if self.coda.full():
+            self.coda.get_nowait()
+        self.coda.put_nowait(messaggio)
+
+    async def prossimo(self) -> str:
+        return await self.coda.get()
+
+
+class RedisFanout:
+    def __init__(self):
+        self._iscritti: dict[str, set] = {}
+        self._pubsub = None
+        self._lettore: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def disponibile(self) -> bool:
+        return utils.redis_client is not None
+
+    #il primo client di un canale fa partire il SUBSCRIBE su redis, gli altri si aggiungono solo in memoria
+    #l'iscrizione si registra solo dopo il SUBSCRIBE: se fallisce i canali restano nuovi e il client successivo riprova
+    async def iscrivi(self, iscrizione, canali: Iterable[str]):
+        canali = list(canali)
+        async with self._lock:
+            nuovi = [canale for canale in canali if canale not in self._iscritti]
+            if nuovi:
+                if self._pubsub is None:
+                    self._pubsub = utils.redis_client.pubsub()
+                await self._pubsub.subscribe(*nuovi)
+
+            for canale in canali:
+                self._iscritti.setdefault(canale, set()).add(iscrizione)
+
+            if self._lettore is None or self._lettore.done():
+                self._lettore = asyncio.create_task(self._leggi())
+
+    #l'ultimo client che lascia un canale fa partire l'UNSUBSCRIBE
+    async def disiscrivi(self, iscrizione, canali: Iterable[str]):
+        async with self._lock:
+            vuoti = []
+            for canale in canali:
+                iscritti = self._iscritti.get(canale)
+                if iscritti is None:
+                    continue
+                iscritti.discard(iscrizione)
+                if not iscritti:
+                    del self._iscritti[canale]
+                    vuoti.append(canale)
+
+            if vuoti and self._pubsub is not None:
+                try:
+                    await self._pubsub.unsubscribe(*vuoti)
+                except Exception as e:
+                    print(f"Errore Redis nell'unsubscribe di {vuoti}: {e}")
+
+    #unico task di lettura del processo: riceve i messaggi da redis e li consegna a tutte le iscrizioni locali
+    async def _leggi(self):
+        while True:
+            try:
+                messaggio = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Errore Redis nella lettura del pub/sub: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            if messaggio is None or messaggio["type"] != "message":
+                continue
+
+            canale = messaggio["channel"]
+            for iscrizione in tuple(self._iscritti.get(canale, ())):
+                iscrizione.pubblica(canale, messaggio["data"])
+
+    async def chiudi(self):
+        if self._lettore:
+            self._lettore.cancel()
+            try:
+                await self._lettore
+            except (asyncio.CancelledError, Exception):
+                pass
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+        self._iscritti.clear()
+        self._pubsub = None
+        self._lettore = None
+
+
+#istanza unica per processo, usata dai router di streaming
+hub = RedisFanout()
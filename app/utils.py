@@ -1,11 +1,24 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 import httpx
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
 import redis.asyncio as redis
 import json
+import time
+import uuid
+from . import metrics
+from .instrumentation import traccia
+from .cache import SingleFlight, TTLCache
+from .config import settings
 
 #instanza di CryptoContext che supporta l'algoritmo che voglio usare
-pwd_context = CryptContext(schemes="bcrypt", deprecated="auto")
+#il costo è configurabile: min e max uguali al default fanno risultare "da aggiornare" gli hash con un costo diverso
+pwd_context = CryptContext(schemes="bcrypt", deprecated="auto",
+                           bcrypt__default_rounds=settings.BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+                           bcrypt__max_rounds=settings.BCRYPT_ROUNDS)
 
 #funzione per hashare un password
 def hash(password_inserita: str):
@@ -15,43 +28,150 @@ def hash(password_inserita: str):
 def verify(password_inserita, password):
     return pwd_context.verify(password_inserita, password)
 
+#bcrypt è CPU-bound e blocca l'event loop per decine/centinaia di millisecondi
+#lo eseguiamo su un pool di thread dedicato e limitato (bcrypt rilascia il GIL mentre calcola l'hash)
+#oltre BCRYPT_MAX_QUEUE richieste in attesa rispondiamo subito 503 invece di accumulare latenza per tutti
+#richieste_password conta sia quelle in esecuzione (al massimo BCRYPT_WORKERS) che quelle in attesa
+pool_password = ThreadPoolExecutor(max_workers=settings.BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+richieste_password = 0
+
+async def esegui_in_pool_password(funzione, *args):
+    global richieste_password
+    if richieste_password >= settings.BCRYPT_WORKERS + settings.BCRYPT_MAX_QUEUE:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Troppe richieste di autenticazione, riprova tra poco",
+                            headers={"Retry-After": "1"})
+    richieste_password += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool_password, funzione, *args)
+    finally:
+        richieste_password -= 1
+
+#versioni asincrone di hash e verify da usare negli endpoint
+async def hash_async(password_inserita: str) -> str:
+    return await esegui_in_pool_password(pwd_context.hash, password_inserita)
+
+#restituisce (password corretta, nuovo hash) dove il nuovo hash è valorizzato solo se quello salvato
+#ha un costo diverso da quello configurato e va sostituito (rehash trasparente al login)
+async def verify_and_update_async(password_inserita: str, password: str) -> tuple[bool, str | None]:
+    return await esegui_in_pool_password(pwd_context.verify_and_update, password_inserita, password)
+
+
+#client redis che misura la latenza di ogni comando (le pipeline e il pub/sub non passano da qui)
+class RedisMisurato(redis.Redis):
+    async def execute_command(self, *args, **options):
+        inizio = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            metrics.EXTERNAL_CALL_DURATION.labels("redis", args[0]).observe(time.perf_counter() - inizio)
 
 #qui connetiamo redis, che useremo per implementare il pattern Cache Aside
 #se 100 utenti richiedono il prezzo, viene fatta solo una chiamata, gli altri leggono il prezzo dalla cache di redis
 try:
-    redis_client = redis.from_url("redis://localhost", decode_responses=True)
+    redis_client = RedisMisurato.from_url("redis://localhost", decode_responses=True)
 except Exception as e:
     print(f"Impossibili configurare redis: {e}")
     redis_client = None
 
+#client http condiviso da tutto il processo, creato nel lifespan di app/main.py
+#riusa le connessioni TCP+TLS verso binance invece di fare un nuovo handshake ad ogni richiesta
+http_client: httpx.AsyncClient | None = None
+
+def crea_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=settings.BINANCE_BASE_URL,
+        timeout=settings.HTTP_TIMEOUT,
+        limits=httpx.Limits(max_connections=settings.HTTP_MAX_CONNECTIONS,
+                            max_keepalive_connections=settings.HTTP_MAX_CONNECTIONS)
+    )
+
 #funzione per ottenere il prezzo di una crypto da un api di binance (asincrona)
 #indichiamo un tipo di ritorno: la funzione deve restituire o un decimal o niente
 async def get_binance_price(ticker: str) -> Decimal | None:
     simbolo = f"{ticker.upper()}USDT"
-    url = f"https://api.binance.com/api/v3/ticker/price?symbol={simbolo}"
+    url = f"/api/v3/ticker/price?symbol={simbolo}"
 
     #come client per effettuare la richiesta di prezzo usiamo httpx,la libreria standard per richieste HTTP asincrone
-    async with httpx.AsyncClient() as client:
-        try:
-            #mentre scarica i dati lasciamo il controllo all'Event Loop di Python tramite await
-            response = await client.get(url, timeout=5.0)
+    #se il client condiviso non esiste (es. script lanciati fuori dall'app) ne creiamo uno temporaneo
+    client = http_client or crea_http_client()
+    inizio = time.perf_counter()
+    try:
+        #mentre scarica i dati lasciamo il controllo all'Event Loop di Python tramite await
+        response = await client.get(url)
 
-            #se la richiesta va a buon fine salviamo il json in data e restituiamo il prezzo in Decimal
-            if response.status_code == 200:
-                data = response.json()
-                return Decimal(data["price"])
-            else:
-                return None
-
-        except Exception as e:
-            print(f"Errore nel recuper del prezzo per {ticker}: {e}")
+        #se la richiesta va a buon fine salviamo il json in data e restituiamo il prezzo in Decimal
+        if response.status_code == 200:
+            data = response.json()
+            return Decimal(data["price"])
+        else:
             return None
+
+    except Exception as e:
+        print(f"Errore nel recuper del prezzo per {ticker}: {e}")
+        return None
+    finally:
+        metrics.EXTERNAL_CALL_DURATION.labels("binance", "ticker_price").observe(time.perf_counter() - inizio)
+        if client is not http_client:
+            await client.aclose()
+
+#come get_binance_price ma recupera tutti i ticker con un'unica chiamata a /api/v3/ticker/price?symbols=[...]
+#restituisce un dizionario ticker -> prezzo, vuoto se la chiamata fallisce
+async def get_binance_prices(tickers: list[str]) -> dict[str, Decimal]:
+    simboli = {f"{ticker.upper()}USDT": ticker for ticker in tickers}
+    #binance vuole la lista in formato json senza spazi
+    parametro = json.dumps(list(simboli), separators=(",", ":"))
+
+    client = http_client or crea_http_client()
+    inizio = time.perf_counter()
+    try:
+        response = await client.get("/api/v3/ticker/price", params={"symbols": parametro})
+        if response.status_code != 200:
+            print(f"Errore nel recupero dei prezzi: status {response.status_code}")
+            return {}
+        return {simboli[riga["symbol"]]: Decimal(riga["price"]) for riga in response.json() if riga["symbol"] in simboli}
+
+    except Exception as e:
+        print(f"Errore nel recupero dei prezzi {tickers}: {e}")
+        return {}
+    finally:
+        metrics.EXTERNAL_CALL_DURATION.labels("binance", "ticker_prices").observe(time.perf_counter() - inizio)
+        if client is not http_client:
+            await client.aclose()
       
 
+#cache dei prezzi in memoria del processo, davanti a redis: evita un GET su redis ad ogni trade
+cache_prezzi = TTLCache(max_size=settings.PRICE_CACHE_MAX_SIZE,
+                        ttl=settings.PRICE_CACHE_TTL,
+                        stale_ttl=settings.PRICE_CACHE_STALE_TTL)
+#una sola chiamata in corso per ticker, le richieste concorrenti aspettano quella
+aggiornamenti_prezzi = SingleFlight()
+
 #ora useremo la funzione appena creata in una funzione che implementa il pattern Cache Aside
+#1)cerchiamo nella cache in-process, se il prezzo è fresco lo restituiamo subito
+#2)se è scaduto da poco lo restituiamo comunque e lo aggiorniamo in background (stale-while-revalidate)
+#3)se non c'è aspettiamo l'aggiornamento, condiviso con tutte le richieste concorrenti per lo stesso ticker
+@traccia("get_real_price")
 async def get_real_price(ticker: str) -> Decimal | None:
 
-    simbolo = f"{ticker.upper()}USDT"
+    voce = cache_prezzi.get(ticker)
+    if voce:
+        prezzo, fresco = voce
+        if fresco:
+            metrics.PRICE_CACHE_REQUESTS.labels(result="hit").inc()
+        else:
+            metrics.PRICE_CACHE_REQUESTS.labels(result="stale").inc()
+            aggiornamenti_prezzi.esegui(ticker, lambda: aggiorna_prezzo(ticker))
+        return prezzo
+
+    task, accorpata = aggiornamenti_prezzi.esegui(ticker, lambda: aggiorna_prezzo(ticker))
+    metrics.PRICE_CACHE_REQUESTS.labels(result="coalesced" if accorpata else "miss").inc()
+    #shield: se questa richiesta viene cancellata, l'aggiornamento continua per le altre in attesa
+    return await asyncio.shield(task)
+
+
+#funzione che recupera il prezzo da redis o da binance e lo salva in entrambe le cache
+async def aggiorna_prezzo(ticker: str) -> Decimal | None:
     #1)cerchiamo nella cache ram di redis
     #2)se non c'è nulla chiamiamo get_binance_price
     #3)e lo salviamo nella cache di redis per le prossime richieste
@@ -62,23 +182,27 @@ async def get_real_price(ticker: str) -> Decimal | None:
             prezzo_della_cache = await redis_client.get(ticker)
             #se c'è lo restituiamo
             if prezzo_della_cache:
-                return Decimal(prezzo_della_cache)
+                prezzo = Decimal(prezzo_della_cache)
+                cache_prezzi.set(ticker, prezzo)
+                return prezzo
         except Exception:
             pass #altrimenti ingoriamo e andiamo avanti
 
-    crypto_list = ["BTC", "ETH"]
     price = None
 
     #controlliamo che il simbolo inserito dall'utente sia nella lista
     #se c'è recuperiamo il prezzo da binance
-    if ticker in crypto_list:
+    if ticker in settings.SUPPORTED_TICKERS:
         price = await get_binance_price(ticker)
 
+    if price:
+        cache_prezzi.set(ticker, price)
+
     #se abbiamo il prezzo proviamo a salvarlo nella cache di redis
     if price and redis_client:
         try:
-            #salviamo il prezzo in cache con nome=simbolo, scadenza di 5 secondi, valore=prezzo ottenuto
-            await redis_client.setex(name=ticker, time=5, value=str(price))
+            #salviamo il prezzo in cache con nome=simbolo, scadenza di pochi secondi, valore=prezzo ottenuto
+            await redis_client.setex(name=ticker, time=settings.PRICE_REDIS_TTL, value=str(price))
             #pubblichiamo anche il prezzo su un canale 
             #cosi chi si connette al websocket lo puo ricevere subito
             canale = f"prezzo_di_{ticker}"
@@ -90,14 +214,100 @@ async def get_real_price(ticker: str) -> Decimal | None:
     return price
 
     
+#task in background avviato nel lifespan: aggiorna i prezzi di tutti i ticker supportati ad intervalli fissi
+#cosi i trade trovano sempre il prezzo nella cache in-process e non aspettano mai binance
+#con più processi uvicorn solo quello che ottiene il lock su redis chiama binance, gli altri leggono i prezzi da redis con un MGET
+POLLER_LOCK_KEY = "poller_prezzi"
+
+async def aggiorna_prezzi_periodicamente():
+    tickers = settings.SUPPORTED_TICKERS
+    intervallo = settings.PRICE_POLL_INTERVAL
+
+    while True:
+        try:
+            prezzi = {}
+            leader = True
+            if redis_client:
+                try:
+                    #il lock scade prima del prossimo giro, quindi ad ogni intervallo c'è al massimo una chiamata a binance
+                    leader = bool(await redis_client.set(POLLER_LOCK_KEY, "1", nx=True, px=int(intervallo * 900)))
+                    if not leader:
+                        valori = await redis_client.mget(tickers)
+                        prezzi = {ticker: Decimal(valore) for ticker, valore in zip(tickers, valori) if valore}
+                except Exception as e:
+                    print(f"Errore Redis nel poller dei prezzi: {e}")
+                    leader = True
+
+            if leader:
+                prezzi = await get_binance_prices(tickers)
+                if prezzi and redis_client:
+                    try:
+                        #un solo round-trip per salvare e pubblicare tutti i prezzi
+                        async with redis_client.pipeline(transaction=False) as pipe:
+                            for ticker, prezzo in prezzi.items():
+                                pipe.setex(name=ticker, time=settings.PRICE_REDIS_TTL, value=str(prezzo))
+                                pipe.publish(f"prezzo_di_{ticker}", str(prezzo))
+                            await pipe.execute()
+                    except Exception as e:
+                        print(f"Errore Redis: {e}")
+
+            for ticker, prezzo in prezzi.items():
+                cache_prezzi.set(ticker, prezzo)
+
+        except Exception as e:
+            print(f"Errore nel poller dei prezzi: {e}")
+
+        await asyncio.sleep(intervallo)
+
+
 #ora creiamo una cosa redis per accumulare piu richieste e fare un unico commi
-ORDER_QUEUE_KEY = "coda_ordini"
+#la coda è uno stream redis letto da un consumer group: ogni ordine resta "pending" finché il worker
+#non lo conferma con XACK dopo il commit sul db, quindi un crash del worker non perde ordini
+ORDER_STREAM_KEY = "ordini"
+ORDER_GROUP = "esecutori"
+#ordini che hanno fallito troppe volte, da controllare a mano
+ORDER_DEAD_LETTER_KEY = "ordini_dead_letter"
 
-async def manda_ordine_in_coda(order_data: dict):
+#restituisce l'id dell'ordine, che fa anche da chiave di idempotenza
+async def manda_ordine_in_coda(order_data: dict) -> str | None:
     if redis_client:
-        #convertiamo il dizionario in una stringa json per redis
-        order_json = json.dumps(order_data)
-        #LPUSH aggiunge l'elemento in testa alla lista
-        await redis_client.lpush(ORDER_QUEUE_KEY, order_json)
+        order_data.setdefault("order_id", uuid.uuid4().hex)
+        #convertiamo il dizionario in una stringa json per redis (default=str per i Decimal)
+        order_json = json.dumps(order_data, default=str)
+        #XADD aggiunge l'ordine in fondo allo stream
+        await redis_client.xadd(ORDER_STREAM_KEY, {"ordine": order_json})
+        return order_data["order_id"]
+    return None
+
+#stream degli eventi del motore di matching, uno per asset: ogni stream ha un solo lettore (il worker leader di quell'asset)
+#perchè il matching deve applicare gli eventi uno alla volta nell'ordine di arrivo
+LIMIT_ORDER_STREAM_KEY = "ordini_limite:{}"
+
+#evento NEW (nuovo ordine limite) o CANCEL (cancellazione) per il book di un asset
+async def manda_evento_matching(asset: str, evento: dict):
+    await redis_client.xadd(LIMIT_ORDER_STREAM_KEY.format(asset), {"evento": json.dumps(evento, default=str)})
+
+#dati di mercato del book di ogni asset, pubblicati dal worker leader dopo ogni batch regolato:
+#la fotografia dei primi BOOK_DEPTH livelli in una chiave, le differenze numerate e gli eseguiti su due canali pub/sub
+#i messaggi sono già serializzati in json dal worker e vengono inoltrati ai client così come sono
+BOOK_KEY = "book:{}"
+BOOK_CHANNEL = "book_{}"
+TRADES_CHANNEL = "trades_{}"
+
+#canale pub/sub personale di ogni utente, su cui il worker pubblica l'esito dei suoi ordini
+#il websocket /ws/orders lo inoltra al client, che non deve più fare polling
+NOTIFICHE_UTENTE_CHANNEL = "notifiche_utente_{}"
+
+#pubblica l'esito di più ordini con un solo round-trip, ogni esito sul canale del suo proprietario
+async def pubblica_esiti_ordini(esiti: list[dict]):
+    if not redis_client or not esiti:
+        return
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for esito in esiti:
+                pipe.publish(NOTIFICHE_UTENTE_CHANNEL.format(esito["owner_id"]), json.dumps(esito, default=str))
+            await pipe.execute()
+    except Exception as e:
+        print(f"Errore Redis nella pubblicazione degli esiti: {e}")
 
-#da qui creiamo il worker
\ No newline at end of file
+#da qui creiamo il worker
@@ -0,0 +1,82 @@
+import argparse
+import json
+import random
+import sys
+import time
+from app.matching import OrderBook
+
+#benchmark del motore di matching su un solo core, senza db e senza redis
+#genera un flusso di eventi come quelli dello stream (nuovi ordini limite attorno a un prezzo medio e cancellazioni)
+#e misura quanti eventi al secondo il book riesce ad applicare, più il tempo di snapshot e di ricaricamento
+#si lancia con: python -m benchmarks.bench_matching --events 1000000 --min-eps 100000
+#restituisce exit code 1 se il throughput è sotto --min-eps
+
+
+def genera_eventi(numero: int, cancellazioni: float, livelli: int, seed: int) -> list[dict]:
+    casuale = random.Random(seed)
+    eventi = []
+    aperti = []
+    for i in range(numero):
+        if aperti and casuale.random() < cancellazioni:
+            indice = casuale.randrange(len(aperti))
+            aperti[indice], aperti[-1] = aperti[-1], aperti[indice]
+            eventi.append({"tipo": "CANCEL", "order_id": aperti.pop()})
+            continue
+        order_id = f"o{i}"
+        aperti.append(order_id)
+        eventi.append({
+            "tipo": "NEW",
+            "order_id": order_id,
+            "owner_id": casuale.randint(1, 1000),
+            "wallet_id": casuale.randint(1, 1000),
+            "type": casuale.choice(("BUY", "SELL")),
+            "price": str(60000 + casuale.randint(-livelli, livelli)),
+            "amount": f"0.{casuale.randint(1, 9999):04d}",
+        })
+    return eventi
+
+
+def main(args) -> int:
+    eventi = genera_eventi(args.events, args.cancel_ratio, args.levels, args.seed)
+    book = OrderBook("BTC")
+
+    eseguiti = 0
+    inizio = time.perf_counter()
+    for evento in eventi:
+        nuovi, _ = book.applica(evento)
+        eseguiti += len(nuovi)
+    durata = time.perf_counter() - inizio
+
+    inizio = time.perf_counter()
+    snapshot = book.snapshot()
+    durata_snapshot = time.perf_counter() - inizio
+    inizio = time.perf_counter()
+    ricaricato = OrderBook.da_snapshot(json.loads(json.dumps(snapshot)))
+    durata_ricarica = time.perf_counter() - inizio
+
+    eventi_al_secondo = len(eventi) / durata
+    risultato = {
+        "events": len(eventi),
+        "fills": eseguiti,
+        "seconds": round(durata, 3),
+        "events_per_second": round(eventi_al_secondo),
+        "open_orders": len(book.ordini),
+        "snapshot_ms": round(durata_snapshot * 1000, 3),
+        "restore_ms": round(durata_ricarica * 1000, 3),
+        "restore_matches": ricaricato.profondita(args.levels) == book.profondita(args.levels),
+    }
+    print(json.dumps(risultato, indent=2))
+
+    if eventi_al_secondo < args.min_eps or not risultato["restore_matches"]:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput del motore di matching")
+    parser.add_argument("--events", type=int, default=1_000_000)
+    parser.add_argument("--cancel-ratio", type=float, default=0.3, help="frazione di eventi che sono cancellazioni")
+    parser.add_argument("--levels", type=int, default=50, help="livelli di prezzo per lato attorno al prezzo medio")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--min-eps", type=float, default=100_000, help="eventi al secondo minimi")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,48 @@
+import statistics
+import time
+import uuid
+import httpx
+
+#funzioni condivise dai benchmark: creazione utenti, misura delle latenze e percentili
+
+
+#riassunto di una lista di latenze in millisecondi
+def percentili(latenze: list[float]) -> dict:
+    if not latenze:
+        return {"count": 0}
+    ordinate = sorted(latenze)
+
+    def p(percentile: float) -> float:
+        indice = min(len(ordinate) - 1, int(round(percentile / 100 * (len(ordinate) - 1))))
+        return round(ordinate[indice], 3)
+
+    return {
+        "count": len(ordinate),
+        "mean": round(statistics.fmean(ordinate), 3),
+        "p50": p(50),
+        "p95": p(95),
+        "p99": p(99),
+        "max": round(ordinate[-1], 3),
+    }
+
+
+#esegue una richiesta e restituisce (risposta, latenza in ms)
+async def misura(client: httpx.AsyncClient, metodo: str, url: str, **kwargs) -> tuple[httpx.Response, float]:
+    inizio = time.perf_counter()
+    risposta = await client.request(metodo, url, **kwargs)
+    return risposta, (time.perf_counter() - inizio) * 1000
+
+
+#registra un nuovo utente, fa il login e restituisce (email, password, headers con il token)
+async def crea_utente(client: httpx.AsyncClient, prefisso: str = "bench", deposito: str | None = None) -> tuple[str, str, dict]:
+    email = f"{prefisso}_{uuid.uuid4().hex[:10]}@example.com"
+    password = "password_benchmark"
+    risposta = await client.post("/user", json={"email": email, "password": password})
+    risposta.raise_for_status()
+    risposta = await client.post("/login", data={"username": email, "password": password})
+    risposta.raise_for_status()
+    headers = {"Authorization": f"Bearer {risposta.json()['access_token']}"}
+    if deposito:
+        risposta = await client.post("/deposit", json={"deposit": deposito}, headers=headers)
+        risposta.raise_for_status()
+    return email, password, headers
@@ -0,0 +1,71 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from app import metrics
+from app.instrumentation import RouteMetricsMiddleware
+
+#benchmark del costo della strumentazione sul percorso caldo, senza db e senza redis
+#misura quanti microsecondi aggiungono a ogni richiesta il middleware delle latenze per rotta
+#e la misura di un comando redis (quella fatta da utils.RedisMisurato), e li confronta con una richiesta tipica
+#il budget documentato nel README è il 2% del tempo di richiesta: con --request-ms si indica il p50 misurato
+#(es. con benchmarks.suite) e la soglia con --budget; restituisce exit code 1 se il costo la supera
+#si lancia con: python -m benchmarks.instrumentation_overhead --request-ms 2 --budget 0.02
+
+
+class RottaFinta:
+    path = "/trade"
+
+#app ASGI minima: risponde subito, cosi il tempo misurato è solo quello della strumentazione
+async def app_vuota(scope, receive, send):
+    scope["route"] = RottaFinta
+    await send({"type": "http.response.start", "status": 202, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+async def ricevi():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+async def invia(messaggio):
+    pass
+
+async def microsecondi_per_richiesta(app, richieste: int) -> float:
+    inizio = time.perf_counter()
+    for _ in range(richieste):
+        await app({"type": "http", "method": "POST", "path": "/trade", "headers": []}, ricevi, invia)
+    return (time.perf_counter() - inizio) / richieste * 1_000_000
+
+def microsecondi_per_comando_redis(comandi: int) -> float:
+    inizio = time.perf_counter()
+    for _ in range(comandi):
+        partenza = time.perf_counter()
+        metrics.EXTERNAL_CALL_DURATION.labels("redis", "GET").observe(time.perf_counter() - partenza)
+    return (time.perf_counter() - inizio) / comandi * 1_000_000
+
+
+async def main(args) -> int:
+    senza = await microsecondi_per_richiesta(app_vuota, args.requests)
+    con = await microsecondi_per_richiesta(RouteMetricsMiddleware(app_vuota), args.requests)
+    redis = microsecondi_per_comando_redis(args.requests)
+
+    #una richiesta del percorso caldo fa al massimo qualche comando redis (rate limiting, cache, idempotenza)
+    costo = (con - senza) + redis * args.redis_commands
+    quota = costo / (args.request_ms * 1000)
+    print(json.dumps({
+        "middleware_us": round(con - senza, 2),
+        "redis_command_us": round(redis, 2),
+        "per_request_us": round(costo, 2),
+        "request_ms": args.request_ms,
+        "share": round(quota, 5),
+        "budget": args.budget,
+    }, indent=2))
+    return 1 if quota > args.budget else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Costo della strumentazione per richiesta")
+    parser.add_argument("--requests", type=int, default=200_000)
+    parser.add_argument("--redis-commands", type=int, default=3, help="comandi redis misurati per richiesta")
+    parser.add_argument("--request-ms", type=float, default=2.0, help="durata tipica di una richiesta (p50)")
+    parser.add_argument("--budget", type=float, default=0.02, help="quota massima del tempo di richiesta")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,67 @@
+import argparse
+import asyncio
+import json
+import time
+import httpx
+from benchmarks.common import crea_utente, misura, percentili
+
+#benchmark: latenza dei trade mentre arriva una raffica di login
+#prima misura i trade da soli, poi gli stessi trade con N client che fanno login in loop
+#con bcrypt sull'event loop il p99 dei trade esplode durante la raffica, con il pool dedicato deve restare vicino alla baseline
+#si lancia con l'app già avviata: python -m benchmarks.login_storm --url http://localhost:8000
+
+
+async def loop_trade(client: httpx.AsyncClient, headers: dict, fine: float, latenze: list[float], errori: list[int]):
+    tipo = "BUY"
+    while time.perf_counter() < fine:
+        risposta, ms = await misura(client, "POST", "/trade", json={"type": tipo, "asset": "BTC", "amount": "0.0001"}, headers=headers)
+        if risposta.status_code < 400:
+            latenze.append(ms)
+            tipo = "SELL" if tipo == "BUY" else "BUY"
+        else:
+            errori.append(risposta.status_code)
+
+
+async def loop_login(client: httpx.AsyncClient, email: str, password: str, fine: float, latenze: list[float], rifiutati: list[int]):
+    while time.perf_counter() < fine:
+        risposta, ms = await misura(client, "POST", "/login", data={"username": email, "password": password})
+        if risposta.status_code == 200:
+            latenze.append(ms)
+        else:
+            rifiutati.append(risposta.status_code)
+
+
+async def fase(client, trader_headers, login_utente, durata: float, login_concorrenti: int) -> dict:
+    fine = time.perf_counter() + durata
+    latenze_trade, errori_trade, latenze_login, rifiutati = [], [], [], []
+    tasks = [loop_trade(client, headers, fine, latenze_trade, errori_trade) for headers in trader_headers]
+    tasks += [loop_login(client, *login_utente, fine, latenze_login, rifiutati) for _ in range(login_concorrenti)]
+    await asyncio.gather(*tasks)
+    return {
+        "trade_ms": percentili(latenze_trade),
+        "trade_errors": len(errori_trade),
+        "login_ms": percentili(latenze_login),
+        "login_rejected": len(rifiutati),
+    }
+
+
+async def main(args):
+    limiti = httpx.Limits(max_connections=args.traders + args.logins + 10)
+    async with httpx.AsyncClient(base_url=args.url, timeout=60, limits=limiti) as client:
+        trader_headers = [(await crea_utente(client, "trader", deposito="100000"))[2] for _ in range(args.traders)]
+        email, password, _ = await crea_utente(client, "login")
+
+        risultato = {
+            "baseline": await fase(client, trader_headers, (email, password), args.duration, 0),
+            "login_storm": await fase(client, trader_headers, (email, password), args.duration, args.logins),
+        }
+    print(json.dumps(risultato, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latenza dei trade durante una raffica di login")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--traders", type=int, default=10, help="client che fanno trade in loop")
+    parser.add_argument("--logins", type=int, default=50, help="client che fanno login in loop durante la raffica")
+    parser.add_argument("--duration", type=float, default=15, help="secondi per ogni fase")
+    asyncio.run(main(parser.parse_args()))
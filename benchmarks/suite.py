@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+import httpx
+from benchmarks.common import crea_utente, misura, percentili
+
+#suite di benchmark dell'exchange: avvia app, worker e stub di binance su postgres e redis locali,
+#esegue una serie di scenari misti e salva throughput e latenze (p50/p95/p99) in un file json
+#il db deve essere già migrato (alembic upgrade head) e dedicato ai benchmark: ogni run crea utenti e transazioni nuovi
+#si lancia dalla root del progetto con:
+#  python -m benchmarks.suite run --out risultati.json
+#  python -m benchmarks.suite run --no-boot --url http://localhost:8000 --out risultati.json   (app già avviata, senza rate limiting)
+#  python -m benchmarks.suite compare base.json risultati.json --threshold 0.15
+#compare restituisce exit code 1 se uno scenario peggiora oltre la soglia, cosi si può usare in CI
+
+#processi avviati dalla suite, con le variabili d'ambiente che puntano l'app sullo stub e spengono il rate limiting
+class Ambiente:
+    def __init__(self, args):
+        self.args = args
+        self.processi: list[subprocess.Popen] = []
+        self.env = {
+            **os.environ,
+            "BINANCE_BASE_URL": f"http://127.0.0.1:{args.stub_port}",
+            "RATE_LIMIT_ENABLED": "false",
+        }
+
+    def avvia(self, *comando: str):
+        self.processi.append(subprocess.Popen([sys.executable, *comando], env=self.env))
+
+    async def __aenter__(self):
+        self.avvia("-m", "scripts.stub_binance", "--port", str(self.args.stub_port))
+        self.avvia("-m", "uvicorn", "app.main:app", "--port", str(self.args.port),
+                   "--workers", str(self.args.api_workers), "--log-level", "warning")
+        for _ in range(self.args.workers):
+            self.avvia("worker.py")
+        await aspetta_pronto(self.args.url)
+        return self
+
+    async def __aexit__(self, *eccezione):
+        for processo in self.processi:
+            processo.terminate()
+        for processo in self.processi:
+            try:
+                processo.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                processo.kill()
+
+
+async def aspetta_pronto(url: str, timeout: float = 30):
+    fine = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=url) as client:
+        while time.monotonic() < fine:
+            try:
+                if (await client.get("/metrics")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"L'app non risponde su {url} dopo {timeout}s")
+
+
+#esegue in parallelo N loop che ripetono una richiesta fino alla fine della durata e raccoglie latenze ed esiti
+async def carico(durata: float, richieste: list) -> dict:
+    fine = time.perf_counter() + durata
+    latenze, esiti = [], {}
+
+    async def loop(richiesta):
+        numero = 0
+        while time.perf_counter() < fine:
+            risposta, ms = await richiesta(numero)
+            numero += 1
+            esiti[risposta.status_code] = esiti.get(risposta.status_code, 0) + 1
+            if risposta.status_code < 400:
+                latenze.append(ms)
+
+    inizio = time.perf_counter()
+    await asyncio.gather(*[loop(richiesta) for richiesta in richieste])
+    secondi = time.perf_counter() - inizio
+    return {
+        "throughput_rps": round(len(latenze) / secondi, 1),
+        "latency_ms": percentili(latenze),
+        "status": {str(codice): numero for codice, numero in sorted(esiti.items())},
+    }
+
+
+def alterna_trade(client: httpx.AsyncClient, headers: dict, quantita: str = "0.0001"):
+    async def richiesta(numero: int):
+        tipo = "BUY" if numero % 2 == 0 else "SELL"
+        return await misura(client, "POST", "/trade", json={"type": tipo, "asset": "BTC", "amount": quantita}, headers=headers)
+    return richiesta
+
+#storico costruito con trade veri, cosi db, holdings e mastro restano coerenti
+async def crea_storico(client: httpx.AsyncClient, headers: dict, numero: int):
+    semaforo = asyncio.Semaphore(20)
+
+    async def compra():
+        async with semaforo:
+            (await client.post("/trade", json={"type": "BUY", "asset": "BTC", "amount": "0.00001"}, headers=headers)).raise_for_status()
+
+    await asyncio.gather(*[compra() for _ in range(numero)])
+
+
+async def login_storm(client, args) -> dict:
+    email, password, _ = await crea_utente(client, "suite_login")
+    richiesta = lambda numero: misura(client, "POST", "/login", data={"username": email, "password": password})
+    return await carico(args.duration, [richiesta] * args.clients)
+
+#tutti i client sullo stesso wallet: misura quanto si serializzano i trade sulla riga del wallet
+async def trade_hot(client, args) -> dict:
+    _, _, headers = await crea_utente(client, "suite_hot", deposito="10000000")
+    return await carico(args.duration, [alterna_trade(client, headers) for _ in range(args.clients)])
+
+#un wallet per client: nessuna contesa, è il riferimento per trade_hot
+async def trade_cold(client, args) -> dict:
+    utenti = [await crea_utente(client, "suite_cold", deposito="1000000") for _ in range(args.clients)]
+    return await carico(args.duration, [alterna_trade(client, headers) for _, _, headers in utenti])
+
+#SELL da wallet con uno storico lungo: con gli holdings materializzati la latenza non deve dipendere dallo storico
+async def sell_deep_history(client, args) -> dict:
+    utenti = [await crea_utente(client, "suite_deep", deposito="10000000") for _ in range(max(1, args.clients // 10))]
+    for _, _, headers in utenti:
+        await crea_storico(client, headers, args.history)
+
+    def vendi(headers):
+        return lambda numero: misura(client, "POST", "/trade", json={"type": "SELL", "asset": "BTC", "amount": "0.00000001"}, headers=headers)
+    return await carico(args.duration, [vendi(headers) for _, _, headers in utenti for _ in range(10)])
+
+#GET /user e prima pagina di GET /transactions per utenti con uno storico lungo
+async def user_large_history(client, args) -> dict:
+    _, _, headers = await crea_utente(client, "suite_storico", deposito="10000000")
+    await crea_storico(client, headers, args.history)
+
+    def leggi(numero: int):
+        url = "/user" if numero % 2 == 0 else "/transactions?limit=50"
+        return misura(client, "GET", url, headers=headers)
+    return await carico(args.duration, [leggi] * args.clients)
+
+#trade asincrono fino all'esito: invio in coda, esecuzione del worker e lettura dello stato con GET /orders/{id}
+async def trade_async(client, args) -> dict:
+    utenti = [await crea_utente(client, "suite_async", deposito="1000000") for _ in range(args.clients)]
+
+    def ordine(headers):
+        async def richiesta(numero: int):
+            inizio = time.perf_counter()
+            tipo = "BUY" if numero % 2 == 0 else "SELL"
+            risposta = await client.post("/trade/async", json={"type": tipo, "asset": "BTC", "amount": "0.0001"}, headers=headers)
+            if risposta.status_code >= 400:
+                return risposta, 0
+            order_id = risposta.json()["order_id"]
+            while time.perf_counter() - inizio < 30:
+                risposta = await client.get(f"/orders/{order_id}", headers=headers)
+                if risposta.status_code >= 400 or risposta.json()["status"] != "QUEUED":
+                    break
+                await asyncio.sleep(0.01)
+            return risposta, (time.perf_counter() - inizio) * 1000
+        return richiesta
+    return await carico(args.duration, [ordine(headers) for _, _, headers in utenti])
+
+
+SCENARI = {
+    "login_storm": login_storm,
+    "trade_hot": trade_hot,
+    "trade_cold": trade_cold,
+    "sell_deep_history": sell_deep_history,
+    "user_large_history": user_large_history,
+    "trade_async": trade_async,
+}
+
+
+def commit_corrente() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def esegui_scenari(args) -> dict:
+    limiti = httpx.Limits(max_connections=args.clients * 2 + 10)
+    risultati = {}
+    async with httpx.AsyncClient(base_url=args.url, timeout=60, limits=limiti) as client:
+        for nome in args.scenarios:
+            print(f"Scenario {nome}...", file=sys.stderr)
+            risultati[nome] = await SCENARI[nome](client, args)
+    return risultati
+
+async def run(args) -> int:
+    if args.no_boot:
+        await aspetta_pronto(args.url)
+        scenari = await esegui_scenari(args)
+    else:
+        async with Ambiente(args):
+            scenari = await esegui_scenari(args)
+
+    risultato = {
+        "commit": commit_corrente(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "params": {"clients": args.clients, "duration": args.duration, "history": args.history,
+                   "api_workers": args.api_workers, "workers": args.workers},
+        "scenarios": scenari,
+    }
+    testo = json.dumps(risultato, indent=2)
+    if args.out:
+        with open(args.out, "w") as file:
+            file.write(testo)
+    print(testo)
+    return 0
+
+
+#confronta due run: una latenza più alta o un throughput più basso oltre la soglia relativa è una regressione
+def compare(args) -> int:
+    with open(args.base) as file:
+        base = json.load(file)["scenarios"]
+    with open(args.new) as file:
+        nuovo = json.load(file)["scenarios"]
+
+    regressioni = 0
+    for nome in sorted(base.keys() & nuovo.keys()):
+        prima, dopo = base[nome], nuovo[nome]
+        valori = [("throughput_rps", prima["throughput_rps"], dopo["throughput_rps"], -1)]
+        valori += [(p, prima["latency_ms"].get(p), dopo["latency_ms"].get(p), 1) for p in ("p50", "p95", "p99")]
+        for metrica, vecchio, attuale, verso in valori:
+            if not vecchio or attuale is None:
+                continue
+            variazione = (attuale - vecchio) / vecchio
+            peggiorato = variazione * verso > args.threshold
+            regressioni += peggiorato
+            esito = "REGRESSIONE" if peggiorato else "ok"
+            print(f"{nome:20} {metrica:15} {vecchio:>10} -> {attuale:>10} ({variazione:+.1%}) {esito}")
+    for nome in sorted(base.keys() ^ nuovo.keys()):
+        print(f"{nome:20} presente solo in uno dei due run")
+
+    if regressioni:
+        print(f"{regressioni} metriche peggiorate oltre il {args.threshold:.0%}")
+        return 1
+    print("Nessuna regressione")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Suite di benchmark degli endpoint dell'exchange")
+    comandi = parser.add_subparsers(dest="comando", required=True)
+
+    esecuzione = comandi.add_parser("run", help="avvia app, worker e stub ed esegue gli scenari")
+    esecuzione.add_argument("--out", help="file json in cui salvare i risultati")
+    esecuzione.add_argument("--scenarios", nargs="+", choices=list(SCENARI), default=list(SCENARI))
+    esecuzione.add_argument("--clients", type=int, default=20, help="client concorrenti per scenario")
+    esecuzione.add_argument("--duration", type=float, default=10, help="secondi di carico per scenario")
+    esecuzione.add_argument("--history", type=int, default=2000, help="transazioni nello storico degli scenari con storico lungo")
+    esecuzione.add_argument("--no-boot", action="store_true", help="usa un'app già avviata su --url invece di avviarla")
+    esecuzione.add_argument("--port", type=int, default=8100)
+    esecuzione.add_argument("--stub-port", type=int, default=9100)
+    esecuzione.add_argument("--api-workers", type=int, default=1, help="processi uvicorn")
+    esecuzione.add_argument("--workers", type=int, default=1, help="processi worker.py")
+    esecuzione.add_argument("--url", help="url dell'app, di default http://127.0.0.1:--port")
+
+    confronto = comandi.add_parser("compare", help="confronta due file di risultati")
+    confronto.add_argument("base")
+    confronto.add_argument("new")
+    confronto.add_argument("--threshold", type=float, default=0.15, help="peggioramento relativo tollerato")
+
+    args = parser.parse_args()
+    if args.comando == "compare":
+        sys.exit(compare(args))
+    args.url = args.url or f"http://127.0.0.1:{args.port}"
+    sys.exit(asyncio.run(run(args)))
@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import json
+import time
+from decimal import Decimal
+import httpx
+from app import fx, metrics, utils
+from app.config import settings
+from app.main import app
+from benchmarks.common import crea_utente, misura, percentili
+
+#benchmark: N client concorrenti che muovono lo stesso wallet (un market maker o un bot)
+#esegue la stessa raffica di depositi, prelievi e trade una volta per modalità di BALANCE_CONCURRENCY:
+#- pessimistic: SELECT ... FOR UPDATE sul wallet, le richieste sul wallet si mettono in fila
+#- optimistic: lettura senza lock e UPDATE condizionato sulla versione, con al massimo OPTIMISTIC_MAX_RETRIES tentativi
+#gira in-process con ASGITransport per poter cambiare modalità tra le due fasi, serve solo il postgres dell'app
+#il prezzo di binance è sostituito da un prezzo fisso, con --price-delay si simula la latenza della chiamata
+#si lancia dalla root del progetto con: python -m benchmarks.wallet_contention --clients 50
+
+
+def conflitti() -> dict:
+    valori = {}
+    for metrica in metrics.WALLET_VERSION_CONFLICTS.collect():
+        for campione in metrica.samples:
+            if campione.name.endswith("_total"):
+                chiave = f"{campione.labels['endpoint']}_{campione.labels['outcome']}"
+                valori[chiave] = valori.get(chiave, 0) + int(campione.value)
+    return valori
+
+
+async def loop_client(client: httpx.AsyncClient, headers: dict, indice: int, richieste: int, con_trade: bool,
+                      latenze: list[float], esiti: dict):
+    operazioni = [("POST", "/deposit", {"deposit": "10"}), ("POST", "/withdrawal", {"withdrawal": "10"})]
+    if con_trade:
+        operazioni += [("POST", "/trade", {"type": "BUY", "asset": "BTC", "amount": "0.0001"}),
+                       ("POST", "/trade", {"type": "SELL", "asset": "BTC", "amount": "0.0001"})]
+    for numero in range(richieste):
+        metodo, url, corpo = operazioni[(indice + numero) % len(operazioni)]
+        risposta, ms = await misura(client, metodo, url, json=corpo, headers=headers)
+        esiti[risposta.status_code] = esiti.get(risposta.status_code, 0) + 1
+        if risposta.status_code < 400:
+            latenze.append(ms)
+
+
+async def fase(modalita: str, args) -> dict:
+    settings.BALANCE_CONCURRENCY = modalita
+    limiti = httpx.Limits(max_connections=args.clients + 10)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test", timeout=60, limits=limiti) as client:
+        #un wallet nuovo per fase, con abbastanza saldo perché i prelievi e i BUY non vengano mai rifiutati
+        _, _, headers = await crea_utente(client, f"contention_{modalita}", deposito="1000000")
+        if args.trades:
+            (await client.post("/trade", json={"type": "BUY", "asset": "BTC", "amount": "1"}, headers=headers)).raise_for_status()
+
+        prima = conflitti()
+        latenze, esiti = [], {}
+        inizio = time.perf_counter()
+        await asyncio.gather(*[
+            loop_client(client, headers, indice, args.requests, args.trades, latenze, esiti)
+            for indice in range(args.clients)
+        ])
+        durata = time.perf_counter() - inizio
+        dopo = conflitti()
+
+    return {
+        "requests": sum(esiti.values()),
+        "seconds": round(durata, 3),
+        "ok_per_second": round(len(latenze) / durata, 1),
+        "latency_ms": percentili(latenze),
+        "status": {str(codice): numero for codice, numero in sorted(esiti.items())},
+        "version_conflicts": {chiave: valore - prima.get(chiave, 0) for chiave, valore in dopo.items() if valore != prima.get(chiave, 0)},
+    }
+
+
+async def main(args):
+    prezzo = Decimal(args.price)
+
+    async def prezzo_fisso(ticker: str) -> Decimal:
+        if args.price_delay:
+            await asyncio.sleep(args.price_delay)
+        return prezzo
+
+    async def cambio_fisso(valuta: str) -> Decimal:
+        return Decimal(1)
+
+    utils.get_real_price = prezzo_fisso
+    fx.get_cambio = cambio_fisso
+
+    risultato = {}
+    for modalita in ("pessimistic", "optimistic"):
+        risultato[modalita] = await fase(modalita, args)
+    print(json.dumps(risultato, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Contesa su un solo wallet: lock pessimistico contro versione ottimistica")
+    parser.add_argument("--clients", type=int, default=50, help="client concorrenti sullo stesso wallet")
+    parser.add_argument("--requests", type=int, default=40, help="richieste per client in ogni fase")
+    parser.add_argument("--trades", action="store_true", help="alterna anche BUY e SELL ai depositi e prelievi")
+    parser.add_argument("--price", default="50000", help="prezzo fisso usato al posto di binance")
+    parser.add_argument("--price-delay", type=float, default=0, help="secondi di attesa simulati per ogni lettura del prezzo")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,50 @@
+import argparse
+import asyncio
+import sys
+from app import candles, database
+
+#backfill delle candele dalle transazioni eseguite prima dell'aggregatore del worker
+#si lancia dalla root del progetto con: python -m scripts.backfill_candles --chunk 10000
+#la migrazione che crea le candele mette il cursore 'backfill' da 0 all'ultimo id esistente e quello del worker dopo,
+#quindi i due non contano mai la stessa transazione e il backfill si può lanciare con il sistema in funzione
+#le transazioni si leggono a blocchi di --chunk in ordine di id: ogni blocco viene aggregato in memoria, scritto con lo stesso
+#upsert del worker e il cursore avanza nella stessa transazione del db, quindi la memoria resta quella di un blocco
+#e se lo script si interrompe si rilancia e riparte dall'ultimo blocco scritto
+#solo i volumi dei trade: i tick dei prezzi passati non sono salvati da nessuna parte
+
+
+async def main(args) -> int:
+    blocchi, transazioni = 0, 0
+    try:
+        async with database.engine.connect() as conn:
+            posizione, fine = await candles.leggi_cursore(conn, candles.CURSORE_BACKFILL)
+            await conn.rollback()
+        if fine is None or posizione >= fine:
+            print("Backfill delle candele già completato")
+            return 0
+
+        while posizione < fine:
+            async with database.engine.begin() as conn:
+                righe = await candles.leggi_transazioni(conn, posizione, args.chunk, fino_a=fine)
+                aggregatore = candles.Aggregatore(posizione)
+                aggregatore.aggiungi_transazioni(righe)
+                #nessuna transazione completata fino alla fine: il cursore arriva in fondo
+                nuova = aggregatore.posizione if righe else fine
+                if not await candles.scrivi_candele(conn, aggregatore.da_scrivere(), candles.CURSORE_BACKFILL, posizione, nuova):
+                    print("Il cursore del backfill è stato spostato da un altro processo")
+                    return 1
+            posizione = nuova
+            blocchi += 1
+            transazioni += len(righe)
+            print(f"Blocco {blocchi}: {transazioni} transazioni aggregate, fino all'id {posizione} di {fine}")
+    finally:
+        await database.engine.dispose()
+
+    print(f"Backfill completato: {transazioni} transazioni in {blocchi} blocchi")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill delle candele OHLCV dallo storico delle transazioni")
+    parser.add_argument("--chunk", type=int, default=10_000, help="transazioni lette e scritte per blocco")
+    sys.exit(asyncio.run(main(parser.parse_args())))
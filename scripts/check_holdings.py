@@ -0,0 +1,74 @@
+import asyncio
+import sys
+from sqlalchemy import and_, case, func, select, union_all
+from app import database, models
+
+#comando per verificare che la tabella holdings sia coerente con lo storico delle transazioni
+#si lancia dalla root del progetto con: python -m scripts.check_holdings
+#restituisce exit code 1 se trova almeno una differenza, cosi si può usare anche in un job schedulato
+
+async def controlla_holdings() -> int:
+    #ricalcoliamo le quantità dallo storico, come faceva la vecchia query del SELL
+    #le quantità degli ordini limite SELL ancora aperti sono riservate: sono già state tolte dagli holdings ma non c'è ancora la transazione
+    movimenti = union_all(
+        select(
+            models.Transaction.wallet_id,
+            models.Transaction.asset,
+            case(
+                (models.Transaction.type == "BUY", models.Transaction.amount),
+                else_=-models.Transaction.amount
+            ).label("quantity")
+        ).where(
+            models.Transaction.type.in_(["BUY", "SELL"])
+        ),
+        select(
+            models.Order.wallet_id,
+            models.Order.asset,
+            (models.Order.filled - models.Order.amount).label("quantity")
+        ).where(
+            models.Order.kind == "LIMIT", models.Order.type == "SELL", models.Order.status == "OPEN"
+        )
+    ).subquery()
+
+    storico = select(
+        movimenti.c.wallet_id,
+        movimenti.c.asset,
+        func.sum(movimenti.c.quantity).label("quantity")
+    ).group_by(
+        movimenti.c.wallet_id, movimenti.c.asset
+    ).subquery()
+
+    #full outer join: troviamo sia le righe diverse sia quelle presenti solo da una parte
+    query = select(
+        func.coalesce(models.Holding.wallet_id, storico.c.wallet_id).label("wallet_id"),
+        func.coalesce(models.Holding.asset, storico.c.asset).label("asset"),
+        func.coalesce(models.Holding.quantity, 0).label("holdings"),
+        func.coalesce(storico.c.quantity, 0).label("transazioni"),
+    ).select_from(
+        models.Holding.__table__.join(
+            storico,
+            and_(models.Holding.wallet_id == storico.c.wallet_id, models.Holding.asset == storico.c.asset),
+            full=True
+        )
+    ).where(
+        func.coalesce(models.Holding.quantity, 0) != func.coalesce(storico.c.quantity, 0)
+    )
+
+    async with database.SessionLocal() as db:
+        result = await db.execute(query)
+        differenze = result.all()
+    await database.engine.dispose()
+
+    for riga in differenze:
+        print(f"Wallet {riga.wallet_id} asset {riga.asset}: holdings={riga.holdings} transazioni={riga.transazioni}")
+
+    if differenze:
+        print(f"Trovate {len(differenze)} differenze tra holdings e transazioni")
+        return 1
+
+    print("Holdings coerenti con lo storico delle transazioni")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(controlla_holdings()))
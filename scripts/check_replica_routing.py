@@ -0,0 +1,96 @@
+import asyncio
+import sys
+import time
+import uuid
+import httpx
+from sqlalchemy import event, text
+from app import database
+from app.config import settings
+from app.main import app
+
+#controllo dell'instradamento delle letture tra primario e replica
+#richiede DATABASE_REPLICA_HOSTNAME (e se serve DATABASE_REPLICA_PORT): due postgres locali in replica oppure,
+#come stand-in, lo stesso server indicato due volte (un server che non è in recovery ha ritardo 0)
+#si lancia dalla root del progetto con: python -m scripts.check_replica_routing
+#per ogni scenario controlla su quale engine sono arrivate le query dell'endpoint e restituisce exit code 1 se sbaglia
+
+async def controlla_instradamento() -> int:
+    if database.replica_engine is None:
+        print("Replica non configurata: imposta DATABASE_REPLICA_HOSTNAME")
+        return 2
+
+    #ogni query viene attribuita all'engine che l'ha eseguita
+    destinazioni = []
+    def su_primario(*args):
+        destinazioni.append("primary")
+    def su_replica(*args):
+        destinazioni.append("replica")
+    event.listen(database.engine.sync_engine, "before_cursor_execute", su_primario)
+    event.listen(database.replica_engine.sync_engine, "before_cursor_execute", su_replica)
+
+    #il lifespan non gira con ASGITransport: avviamo noi il controllo del ritardo e aspettiamo la prima misura
+    controllo = asyncio.create_task(database.controlla_ritardo_replica())
+    await asyncio.sleep(0.5)
+    print(f"Ritardo misurato della replica: {database.ritardo_replica}")
+
+    email = f"replica_check_{uuid.uuid4().hex[:8]}@example.com"
+    password = "password_di_controllo"
+    errori = 0
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            risposta = await client.post("/user", json={"email": email, "password": password})
+            risposta.raise_for_status()
+            risposta = await client.post("/login", data={"username": email, "password": password})
+            risposta.raise_for_status()
+            headers = {"Authorization": f"Bearer {risposta.json()['access_token']}"}
+            (await client.post("/deposit", json={"deposit": "100"}, headers=headers)).raise_for_status()
+            user_id = (await client.get("/user", headers=headers)).json()["id"]
+
+            async def scenario(nome: str, atteso: str, prepara):
+                nonlocal errori
+                prepara()
+                destinazioni.clear()
+                risposta = await client.get("/transactions", headers=headers)
+                risposta.raise_for_status()
+                ottenuto = "replica" if "replica" in destinazioni else "primary"
+                esito = "OK" if ottenuto == atteso else "ERRORE"
+                if ottenuto != atteso:
+                    errori += 1
+                print(f"{esito:6} {nome}: atteso {atteso}, letto da {ottenuto}")
+
+            def niente():
+                pass
+            def scrittura_scaduta():
+                database.scritture_recenti.pop(user_id, None)
+            def replica_in_ritardo():
+                controllo.cancel()
+                database.ritardo_replica = settings.REPLICA_MAX_LAG + 1
+            def replica_non_raggiungibile():
+                database.ritardo_replica = None
+            def misura_vecchia():
+                database.ritardo_replica = 0.0
+                database.ultima_misura_replica = time.monotonic() - 10 * settings.REPLICA_LAG_CHECK_INTERVAL
+
+            await scenario("subito dopo il proprio deposito (read-your-writes)", "primary", niente)
+            await scenario("finestra read-your-writes scaduta", "replica", scrittura_scaduta)
+            await scenario("replica oltre REPLICA_MAX_LAG", "primary", replica_in_ritardo)
+            await scenario("replica non raggiungibile", "primary", replica_non_raggiungibile)
+            await scenario("misura del ritardo troppo vecchia", "primary", misura_vecchia)
+    finally:
+        controllo.cancel()
+        event.remove(database.engine.sync_engine, "before_cursor_execute", su_primario)
+        event.remove(database.replica_engine.sync_engine, "before_cursor_execute", su_replica)
+        async with database.engine.begin() as conn:
+            await conn.execute(text("DELETE FROM users WHERE email = :email"), {"email": email})
+        await database.engine.dispose()
+        await database.replica_engine.dispose()
+
+    if errori:
+        print(f"{errori} scenari instradati in modo errato")
+        return 1
+    print("Instradamento delle letture corretto")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(controlla_instradamento()))
@@ -0,0 +1,33 @@
+import argparse
+import asyncio
+import sys
+from datetime import datetime, timedelta, timezone
+from app import database, ledger
+
+#manutenzione periodica del libro mastro, da schedulare (es. ogni ora con cron):
+#1) crea in anticipo le partizioni mensili di postings, cosi le righe non finiscono mai nella partizione di default
+#2) salva uno snapshot dei saldi di ogni conto che si è mosso, cosi saldi_al legge solo le righe dopo lo snapshot
+#lo snapshot è fatto ad un istante un po' nel passato (--margin-minutes): created_at è l'inizio della transazione che ha scritto la riga,
+#quindi una transazione ancora aperta potrebbe aggiungere righe con created_at precedente ad adesso
+#si lancia dalla root del progetto con: python -m scripts.ledger_snapshot
+
+async def manutenzione(mesi: int, margine: int) -> int:
+    adesso = datetime.now(timezone.utc)
+    as_of = adesso - timedelta(minutes=margine)
+    async with database.engine.begin() as conn:
+        partizioni = await ledger.crea_partizioni(conn, adesso.date(), mesi)
+    async with database.engine.begin() as conn:
+        conti = await ledger.crea_snapshot(conn, as_of)
+    await database.engine.dispose()
+
+    print(f"Partizioni presenti: {', '.join(partizioni)}")
+    print(f"Snapshot al {as_of.isoformat()}: {conti} conti aggiornati")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Partizioni e snapshot dei saldi del libro mastro")
+    parser.add_argument("--months", type=int, default=3, help="mesi di partizioni da avere pronti, compreso quello corrente")
+    parser.add_argument("--margin-minutes", type=int, default=10, help="quanto nel passato fare lo snapshot")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(manutenzione(args.months, args.margin_minutes)))
@@ -0,0 +1,41 @@
+import argparse
+import asyncio
+import sys
+from sqlalchemy import text
+from app import database
+from app.config import settings
+
+#cancella dal db le chiavi di idempotenza più vecchie di IDEMPOTENCY_DB_RETENTION_DAYS, da schedulare (es. una volta al giorno con cron)
+#una richiesta ripetuta dopo la cancellazione viene eseguita di nuovo, quindi il periodo deve superare quello dei retry dei client
+#cancella a blocchi cosi non tiene lock su troppe righe in una sola transazione
+#si lancia dalla root del progetto con: python -m scripts.purge_idempotency_keys
+
+CANCELLA_BLOCCO = text("""
+    DELETE FROM idempotency_keys
+    WHERE (user_id, key) IN (
+        SELECT user_id, key FROM idempotency_keys
+        WHERE created_at < now() - make_interval(days => :giorni)
+        LIMIT :blocco
+    )
+""")
+
+async def pulisci(giorni: int, blocco: int) -> int:
+    totale = 0
+    while True:
+        async with database.engine.begin() as conn:
+            cancellate = (await conn.execute(CANCELLA_BLOCCO, {"giorni": giorni, "blocco": blocco})).rowcount
+        totale += cancellate
+        if cancellate < blocco:
+            break
+    await database.engine.dispose()
+
+    print(f"Chiavi di idempotenza più vecchie di {giorni} giorni cancellate: {totale}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pulizia delle chiavi di idempotenza scadute")
+    parser.add_argument("--days", type=int, default=settings.IDEMPOTENCY_DB_RETENTION_DAYS, help="giorni di conservazione")
+    parser.add_argument("--batch", type=int, default=5000, help="righe cancellate per transazione")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(pulisci(args.days, args.batch)))
@@ -0,0 +1,124 @@
+import asyncio
+import sys
+from sqlalchemy import text
+from app import database
+
+#riconciliazione del libro mastro con le tabelle dei saldi
+#si lancia dalla root del progetto con: python -m scripts.reconcile_ledger
+#controlla che:
+#1) ogni scrittura sommi a zero per ogni asset
+#2) il conto WALLET di ogni wallet sia uguale a wallets.balance (valuta) e a holdings.quantity (crypto)
+#3) il conto RESERVED sia coerente con gli ordini limite aperti: per i SELL la quantità non eseguita,
+#   per i BUY il controvalore non eseguito al prezzo limite, a meno degli arrotondamenti delle esecuzioni parziali
+#4) l'ultimo snapshot più le righe successive dia lo stesso saldo della somma di tutte le righe
+#5) il conto RESERVED di ogni crypto sia uguale a holdings.reserved
+#restituisce exit code 1 se trova almeno una differenza, cosi si può usare anche in un job schedulato
+#va lanciato senza traffico di scrittura (o su una copia), altrimenti le letture non sono tutte allo stesso istante
+
+SCRITTURE_SBILANCIATE = """
+    SELECT entry_id, asset, SUM(amount) AS differenza
+    FROM postings
+    GROUP BY entry_id, asset
+    HAVING SUM(amount) != 0
+"""
+
+SALDI_WALLET = """
+    WITH mastro AS (
+        SELECT wallet_id, asset, SUM(amount) AS saldo FROM postings WHERE account = 'WALLET' GROUP BY wallet_id, asset
+    ),
+    tabelle AS (
+        SELECT id AS wallet_id, currency AS asset, balance AS saldo FROM wallets
+        UNION ALL
+        SELECT wallet_id, asset, quantity FROM holdings
+    )
+    SELECT COALESCE(m.wallet_id, t.wallet_id) AS wallet_id, COALESCE(m.asset, t.asset) AS asset,
+           COALESCE(t.saldo, 0) AS tabelle, COALESCE(m.saldo, 0) AS mastro
+    FROM mastro m FULL JOIN tabelle t ON t.wallet_id = m.wallet_id AND t.asset = m.asset
+    WHERE COALESCE(t.saldo, 0) != COALESCE(m.saldo, 0)
+"""
+
+SALDI_RISERVATI = """
+    WITH mastro AS (
+        SELECT wallet_id, asset, SUM(amount) AS saldo FROM postings WHERE account = 'RESERVED' GROUP BY wallet_id, asset
+    ),
+    aperti AS (
+        SELECT o.wallet_id, CASE WHEN o.type = 'BUY' THEN w.currency ELSE o.asset END AS asset,
+               SUM(CASE WHEN o.type = 'BUY' THEN ROUND((o.amount - o.filled) * o.price, 8) ELSE o.amount - o.filled END) AS saldo,
+               SUM(CASE WHEN o.type = 'BUY' THEN 0.000001 ELSE 0 END) AS tolleranza
+        FROM orders o JOIN wallets w ON w.id = o.wallet_id
+        WHERE o.kind = 'LIMIT' AND o.status = 'OPEN'
+        GROUP BY 1, 2
+    )
+    SELECT COALESCE(m.wallet_id, a.wallet_id) AS wallet_id, COALESCE(m.asset, a.asset) AS asset,
+           COALESCE(a.saldo, 0) AS tabelle, COALESCE(m.saldo, 0) AS mastro
+    FROM mastro m FULL JOIN aperti a ON a.wallet_id = m.wallet_id AND a.asset = m.asset
+    WHERE ABS(COALESCE(a.saldo, 0) - COALESCE(m.saldo, 0)) > COALESCE(a.tolleranza, 0)
+"""
+
+HOLDINGS_RISERVATI = """
+    WITH mastro AS (
+        SELECT p.wallet_id, p.asset, SUM(p.amount) AS saldo
+        FROM postings p LEFT JOIN wallets w ON w.id = p.wallet_id
+        WHERE p.account = 'RESERVED' AND p.asset IS DISTINCT FROM w.currency
+        GROUP BY p.wallet_id, p.asset
+    )
+    SELECT COALESCE(m.wallet_id, h.wallet_id) AS wallet_id, COALESCE(m.asset, h.asset) AS asset,
+           COALESCE(h.reserved, 0) AS tabelle, COALESCE(m.saldo, 0) AS mastro
+    FROM mastro m FULL JOIN holdings h ON h.wallet_id = m.wallet_id AND h.asset = m.asset
+    WHERE COALESCE(h.reserved, 0) != COALESCE(m.saldo, 0)
+"""
+
+SALDI_SNAPSHOT = """
+    WITH ultimi AS (
+        SELECT DISTINCT ON (account, wallet_id, asset) account, wallet_id, asset, as_of, balance
+        FROM ledger_snapshots
+        ORDER BY account, wallet_id, asset, as_of DESC
+    ),
+    dopo AS (
+        SELECT u.account, u.wallet_id, u.asset, u.balance + COALESCE(SUM(p.amount), 0) AS saldo
+        FROM ultimi u LEFT JOIN postings p
+             ON p.account = u.account AND p.wallet_id = u.wallet_id AND p.asset = u.asset AND p.created_at > u.as_of
+        GROUP BY u.account, u.wallet_id, u.asset, u.balance
+    ),
+    totali AS (
+        SELECT account, wallet_id, asset, SUM(amount) AS saldo FROM postings GROUP BY account, wallet_id, asset
+    )
+    SELECT d.account, d.wallet_id, d.asset, d.saldo AS snapshot, COALESCE(t.saldo, 0) AS mastro
+    FROM dopo d LEFT JOIN totali t USING (account, wallet_id, asset)
+    WHERE d.saldo != COALESCE(t.saldo, 0)
+"""
+
+
+async def riconcilia() -> int:
+    async with database.engine.connect() as conn:
+        #un solo snapshot del db per tutti i controlli
+        await conn.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+        sbilanciate = (await conn.execute(text(SCRITTURE_SBILANCIATE))).all()
+        wallet = (await conn.execute(text(SALDI_WALLET))).all()
+        riservati = (await conn.execute(text(SALDI_RISERVATI))).all()
+        holdings_riservati = (await conn.execute(text(HOLDINGS_RISERVATI))).all()
+        snapshot = (await conn.execute(text(SALDI_SNAPSHOT))).all()
+    await database.engine.dispose()
+
+    for riga in sbilanciate:
+        print(f"Scrittura {riga.entry_id} non bilanciata su {riga.asset}: {riga.differenza}")
+    for riga in wallet:
+        print(f"Wallet {riga.wallet_id} {riga.asset}: saldo={riga.tabelle} mastro={riga.mastro}")
+    for riga in riservati:
+        print(f"Wallet {riga.wallet_id} {riga.asset} riservato: ordini aperti={riga.tabelle} mastro={riga.mastro}")
+    for riga in holdings_riservati:
+        print(f"Wallet {riga.wallet_id} {riga.asset} riservato: holdings={riga.tabelle} mastro={riga.mastro}")
+    for riga in snapshot:
+        print(f"Conto {riga.account} {riga.wallet_id} {riga.asset}: snapshot+righe={riga.snapshot} mastro={riga.mastro}")
+
+    differenze = len(sbilanciate) + len(wallet) + len(riservati) + len(holdings_riservati) + len(snapshot)
+    if differenze:
+        print(f"Trovate {differenze} differenze tra libro mastro e saldi")
+        return 1
+
+    print("Libro mastro coerente con saldi, ordini aperti e snapshot")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(riconcilia()))
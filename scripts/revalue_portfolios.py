@@ -0,0 +1,173 @@
+import argparse
+import asyncio
+import sys
+from datetime import datetime, timezone
+import pandas as pd
+from sqlalchemy import text
+from app import database, fx, ledger, utils
+from app.portfolio import Posizione
+
+#valutazione periodica dei portafogli e ricostruzione degli aggregati degli holdings
+#si lancia dalla root del progetto con:
+#  python -m scripts.revalue_portfolios              (da schedulare, es. ogni ora con cron)
+#  python -m scripts.revalue_portfolios --rebuild    (una volta dopo la migrazione che aggiunge gli aggregati)
+#la valutazione legge tutte le posizioni, prende i prezzi di tutti gli asset con una sola chiamata a binance e i cambi con fx,
+#poi calcola valore e pnl di ogni posizione e i totali per wallet in modo vettoriale con pandas e salva una riga per wallet
+#in portfolio_valuations; i valori sono per il reporting e si calcolano in float64 (15 cifre significative),
+#mentre gli aggregati negli holdings, aggiornati ad ogni trade, restano numeric esatti
+#i wallet con un asset senza prezzo non vengono valutati in quel giro
+#--rebuild ricalcola reserved, cost_basis e realized_pnl di ogni holding rileggendo tutto lo storico delle transazioni
+#con le regole di portfolio.Posizione: va lanciato senza traffico di scrittura, come scripts.reconcile_ledger
+
+POSIZIONI = """
+    SELECT h.wallet_id, w.currency, h.asset, h.quantity + h.reserved AS posseduta, h.cost_basis, h.realized_pnl
+    FROM holdings h JOIN wallets w ON w.id = h.wallet_id
+"""
+
+#lo storico dei soli trade in streaming (depositi e prelievi hanno come asset la valuta del wallet e non sono posizioni),
+#ordinato per posizione e poi nell'ordine in cui i trade sono stati eseguiti
+STORICO = """
+    SELECT wallet_id, asset, type, amount, total_payed
+    FROM transactions
+    WHERE status = 'COMPLETED' AND type IN ('BUY', 'SELL')
+    ORDER BY wallet_id, asset, created_at, id
+"""
+
+RISERVATI = """
+    SELECT wallet_id, asset, SUM(amount - filled) AS quantita
+    FROM orders
+    WHERE kind = 'LIMIT' AND type = 'SELL' AND status = 'OPEN'
+    GROUP BY wallet_id, asset
+"""
+
+AGGIORNA_AGGREGATI = """
+    UPDATE holdings SET reserved = v.reserved, cost_basis = v.cost_basis, realized_pnl = v.realized_pnl
+    FROM unnest(CAST(:wallet_ids AS integer[]), CAST(:assets AS varchar[]), CAST(:riservate AS numeric[]),
+                CAST(:costi AS numeric[]), CAST(:realizzati AS numeric[])) AS v(wallet_id, asset, reserved, cost_basis, realized_pnl)
+    WHERE holdings.wallet_id = v.wallet_id AND holdings.asset = v.asset
+"""
+
+
+async def valuta_portafogli() -> int:
+    as_of = datetime.now(timezone.utc)
+    async with database.engine.connect() as conn:
+        righe = (await conn.execute(text(POSIZIONI))).all()
+    posizioni = pd.DataFrame.from_records(righe, columns=["wallet_id", "currency", "asset", "posseduta", "cost_basis", "realized_pnl"])
+    if posizioni.empty:
+        print("Nessuna posizione da valutare")
+        return 0
+    for colonna in ("posseduta", "cost_basis", "realized_pnl"):
+        posizioni[colonna] = posizioni[colonna].astype(float)
+
+    prezzi = await utils.get_binance_prices(sorted(posizioni["asset"].unique()))
+    cambi = {valuta: await fx.get_cambio(valuta) for valuta in posizioni["currency"].unique()}
+
+    #prezzo nella valuta del wallet, NaN se manca il prezzo dell'asset o il cambio della valuta
+    prezzo = posizioni["asset"].map({asset: float(valore) for asset, valore in prezzi.items()})
+    cambio = posizioni["currency"].map({valuta: float(valore) for valuta, valore in cambi.items() if valore is not None})
+    posizioni["market_value"] = (posizioni["posseduta"] * prezzo * cambio).round(8)
+    #le posizioni chiuse valgono zero anche senza prezzo
+    posizioni.loc[posizioni["posseduta"] == 0, "market_value"] = 0.0
+
+    totali = posizioni.groupby(["wallet_id", "currency"], as_index=False).agg(
+        market_value=("market_value", lambda valori: valori.sum(min_count=len(valori))),
+        cost_basis=("cost_basis", "sum"),
+        realized_pnl=("realized_pnl", "sum"),
+    )
+    totali["unrealized_pnl"] = totali["market_value"] - totali["cost_basis"]
+    senza_prezzo = totali["market_value"].isna()
+    totali = totali[~senza_prezzo]
+
+    if not totali.empty:
+        async with database.engine.begin() as conn:
+            await conn.execute(text("""
+                INSERT INTO portfolio_valuations (wallet_id, as_of, currency, market_value, cost_basis, unrealized_pnl, realized_pnl)
+                SELECT v.wallet_id, :as_of, v.currency, v.market_value, v.cost_basis, v.unrealized_pnl, v.realized_pnl
+                FROM unnest(CAST(:wallet_ids AS integer[]), CAST(:valute AS varchar[]), CAST(:valori AS numeric[]),
+                            CAST(:costi AS numeric[]), CAST(:non_realizzati AS numeric[]), CAST(:realizzati AS numeric[]))
+                     AS v(wallet_id, currency, market_value, cost_basis, unrealized_pnl, realized_pnl)
+            """), {
+                "as_of": as_of,
+                "wallet_ids": totali["wallet_id"].tolist(),
+                "valute": totali["currency"].tolist(),
+                "valori": [ledger.arrotonda(valore) for valore in totali["market_value"]],
+                "costi": [ledger.arrotonda(valore) for valore in totali["cost_basis"]],
+                "non_realizzati": [ledger.arrotonda(valore) for valore in totali["unrealized_pnl"]],
+                "realizzati": [ledger.arrotonda(valore) for valore in totali["realized_pnl"]],
+            })
+
+    mancanti = sorted(set(posizioni["asset"]) - prezzi.keys()) + sorted(valuta for valuta, cambio in cambi.items() if cambio is None)
+    if mancanti:
+        print(f"Prezzi o cambi non disponibili: {', '.join(mancanti)}")
+    print(f"Valutazione al {as_of.isoformat()}: {len(totali)} wallet valutati, {int(senza_prezzo.sum())} senza prezzo")
+    return 0
+
+
+async def ricostruisci_aggregati(batch: int) -> int:
+    aggiornate = 0
+    da_scrivere: list[tuple[int, str, Posizione]] = []
+
+    #lo storico si legge in streaming su una connessione e gli aggregati si scrivono su un'altra, in un'unica transazione
+    async with database.engine.connect() as lettura, database.engine.begin() as scrittura:
+        riservati = {(riga.wallet_id, riga.asset): riga.quantita for riga in (await scrittura.execute(text(RISERVATI))).all()}
+
+        async def scrivi():
+            nonlocal aggiornate
+            await scrittura.execute(text(AGGIORNA_AGGREGATI), {
+                "wallet_ids": [wallet_id for wallet_id, _, _ in da_scrivere],
+                "assets": [asset for _, asset, _ in da_scrivere],
+                "riservate": [posizione.reserved for _, _, posizione in da_scrivere],
+                "costi": [posizione.cost_basis for _, _, posizione in da_scrivere],
+                "realizzati": [posizione.realized_pnl for _, _, posizione in da_scrivere],
+            })
+            aggiornate += len(da_scrivere)
+            da_scrivere.clear()
+
+        #la quantità riservata dagli ordini aperti si sposta da quantity a reserved senza toccare il costo
+        def chiudi(wallet_id: int, asset: str, posizione: Posizione):
+            posizione.riserva(riservati.pop((wallet_id, asset), 0))
+            da_scrivere.append((wallet_id, asset, posizione))
+
+        #una posizione alla volta: lo storico è ordinato per (wallet, asset), quindi in memoria c'è solo il batch da scrivere
+        corrente, posizione = None, None
+        storico = await lettura.stream(text(STORICO))
+        async for transazioni in storico.partitions(batch):
+            for transazione in transazioni:
+                chiave = (transazione.wallet_id, transazione.asset)
+                if chiave != corrente:
+                    if corrente is not None:
+                        chiudi(*corrente, posizione)
+                    corrente, posizione = chiave, Posizione()
+                if transazione.type == "BUY":
+                    posizione.compra(transazione.amount, transazione.total_payed)
+                else:
+                    posizione.vendi(transazione.amount, transazione.total_payed)
+            if len(da_scrivere) >= batch:
+                await scrivi()
+        if corrente is not None:
+            chiudi(*corrente, posizione)
+        #ordini aperti su holdings senza transazioni (es. quantità arrivate con l'apertura del mastro)
+        for (wallet_id, asset) in list(riservati):
+            chiudi(wallet_id, asset, Posizione())
+        if da_scrivere:
+            await scrivi()
+    await database.engine.dispose()
+
+    print(f"Aggregati ricostruiti per {aggiornate} holdings")
+    return 0
+
+
+async def main(args) -> int:
+    if args.rebuild:
+        return await ricostruisci_aggregati(args.batch)
+    try:
+        return await valuta_portafogli()
+    finally:
+        await database.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Valutazione dei portafogli e ricostruzione degli aggregati degli holdings")
+    parser.add_argument("--rebuild", action="store_true", help="ricalcola costo, pnl realizzato e quantità riservata dallo storico")
+    parser.add_argument("--batch", type=int, default=5000, help="holdings scritti per istruzione con --rebuild")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,50 @@
+import argparse
+import json
+import random
+from decimal import Decimal
+from typing import Optional
+import uvicorn
+from fastapi import FastAPI, HTTPException
+
+#server locale che imita l'endpoint /api/v3/ticker/price di binance
+#serve per sviluppo, benchmark e prove del poller senza dipendere dalla rete e dai rate limit di binance
+#si lancia con: python -m scripts.stub_binance --port 9000
+#e si punta l'app su di lui con la variabile d'ambiente BINANCE_BASE_URL=http://localhost:9000
+
+app = FastAPI()
+
+#prezzi di partenza, ad ogni richiesta fanno una piccola passeggiata casuale
+prezzi = {"BTCUSDT": Decimal("60000"), "ETHUSDT": Decimal("3000"), "EURUSDT": Decimal("1.08")}
+#contatore delle chiamate ricevute, utile per verificare quante richieste arrivano davvero a "binance"
+chiamate = {"totale": 0}
+
+
+def prezzo_corrente(simbolo: str) -> dict:
+    if simbolo not in prezzi:
+        raise HTTPException(status_code=400, detail={"code": -1121, "msg": "Invalid symbol."})
+    variazione = Decimal(str(random.uniform(-0.0005, 0.0005)))
+    prezzi[simbolo] = (prezzi[simbolo] * (1 + variazione)).quantize(Decimal("0.00000001"))
+    return {"symbol": simbolo, "price": str(prezzi[simbolo])}
+
+
+@app.get("/api/v3/ticker/price")
+async def ticker_price(symbol: Optional[str] = None, symbols: Optional[str] = None):
+    chiamate["totale"] += 1
+    if symbol:
+        return prezzo_corrente(symbol)
+    if symbols:
+        return [prezzo_corrente(simbolo) for simbolo in json.loads(symbols)]
+    return [prezzo_corrente(simbolo) for simbolo in prezzi]
+
+
+@app.get("/stub/stats")
+async def stats():
+    return chiamate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub locale dell'api prezzi di Binance")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
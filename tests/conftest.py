@@ -0,0 +1,8 @@
+#opzioni per i test che usano il database locale (vedi test_query_plans.py)
+#ATTENZIONE: --seed inserisce dati sintetici, va usato solo su un database locale di sviluppo
+
+
+def pytest_addoption(parser):
+    parser.addoption("--seed", action="store_true", help="popola il database locale con dati sintetici prima del controllo dei piani")
+    parser.addoption("--utenti", type=int, default=5000, help="utenti sintetici creati da --seed")
+    parser.addoption("--transazioni", type=int, default=40, help="transazioni sintetiche per wallet create da --seed")
@@ -0,0 +1,165 @@
+import json
+from app import matching
+from app.matching import OrderBook, OrdineLimite, a_unita, importo_unita
+
+#test del motore di matching in memoria: non fa I/O, quindi non servono né db né redis
+#si lanciano dalla root del progetto con: python -m pytest tests/test_matching.py
+
+
+def ordine(id: str, lato: str, prezzo: str, quantita: str) -> OrdineLimite:
+    return OrdineLimite(id, 1, 1, lato, a_unita(prezzo), a_unita(quantita))
+
+def nuovo(id: str, lato: str, prezzo: str, quantita: str) -> dict:
+    return {"tipo": "NEW", "order_id": id, "owner_id": 1, "wallet_id": 1, "type": lato, "price": prezzo, "amount": quantita}
+
+def riassunto(eseguiti) -> list[tuple]:
+    return [(e.maker.id, e.taker.id, e.prezzo, e.quantita) for e in eseguiti]
+
+
+def test_ordini_che_non_si_incrociano_restano_nel_book():
+    book = OrderBook("BTC")
+    assert book.aggiungi(ordine("b1", "BUY", "99", "1")) == []
+    assert book.aggiungi(ordine("s1", "SELL", "100", "2")) == []
+    assert book.miglior_bid() == a_unita("99")
+    assert book.miglior_ask() == a_unita("100")
+    assert book.profondita() == {"bids": [[a_unita("99"), a_unita("1")]], "asks": [[a_unita("100"), a_unita("2")]]}
+
+
+def test_esecuzione_parziale_al_prezzo_del_maker():
+    book = OrderBook("BTC")
+    book.aggiungi(ordine("s1", "SELL", "100", "10"))
+
+    #il BUY incrocia a 100 anche se il suo limite è 101 e viene eseguito tutto: non entra nel book
+    eseguiti = book.aggiungi(ordine("b1", "BUY", "101", "4"))
+    assert riassunto(eseguiti) == [("s1", "b1", a_unita("100"), a_unita("4"))]
+    assert "b1" not in book.ordini
+    assert book.ordini["s1"].quantita == a_unita("6")
+    assert book.profondita()["asks"] == [[a_unita("100"), a_unita("6")]]
+
+    #il secondo BUY svuota il livello e il suo residuo resta nel book come miglior bid
+    eseguiti = book.aggiungi(ordine("b2", "BUY", "100", "10"))
+    assert riassunto(eseguiti) == [("s1", "b2", a_unita("100"), a_unita("6"))]
+    assert "s1" not in book.ordini
+    assert book.miglior_ask() is None
+    assert book.miglior_bid() == a_unita("100")
+    assert book.ordini["b2"].quantita == a_unita("4")
+
+
+def test_priorita_prezzo_poi_arrivo():
+    book = OrderBook("BTC")
+    book.aggiungi(ordine("s1", "SELL", "101", "1"))
+    book.aggiungi(ordine("s2", "SELL", "100", "1"))
+    book.aggiungi(ordine("s3", "SELL", "100", "1"))
+    book.aggiungi(ordine("s4", "SELL", "100", "1"))
+
+    #prima il livello a 100 in ordine di arrivo, poi quello a 101
+    eseguiti = book.aggiungi(ordine("b1", "BUY", "101", "3.5"))
+    assert riassunto(eseguiti) == [
+        ("s2", "b1", a_unita("100"), a_unita("1")),
+        ("s3", "b1", a_unita("100"), a_unita("1")),
+        ("s4", "b1", a_unita("100"), a_unita("1")),
+        ("s1", "b1", a_unita("101"), a_unita("0.5")),
+    ]
+    assert book.ordini["s1"].quantita == a_unita("0.5")
+
+
+def test_fifo_dopo_una_cancellazione_nel_livello():
+    book = OrderBook("BTC")
+    for id in ("s1", "s2", "s3"):
+        book.aggiungi(ordine(id, "SELL", "100", "1"))
+    book.cancella("s1")
+
+    #l'ordine cancellato resta in coda con quantità 0 e viene saltato
+    eseguiti = book.aggiungi(ordine("b1", "BUY", "100", "1.5"))
+    assert riassunto(eseguiti) == [("s2", "b1", a_unita("100"), a_unita("1")), ("s3", "b1", a_unita("100"), a_unita("0.5"))]
+    assert book.profondita()["asks"] == [[a_unita("100"), a_unita("0.5")]]
+
+
+def test_cancellazione_di_un_ordine_eseguito_in_parte():
+    book = OrderBook("BTC")
+    book.aggiungi(ordine("s1", "SELL", "100", "10"))
+    book.aggiungi(ordine("b1", "BUY", "100", "4"))
+
+    cancellato, residuo = book.cancella("s1")
+    assert cancellato.id == "s1"
+    assert residuo == a_unita("6")
+    #per un SELL la riserva è la quantità dell'asset: torna solo quella non eseguita
+    assert cancellato.riservato == a_unita("6")
+    assert cancellato.iniziale == a_unita("10")
+    assert book.profondita() == {"bids": [], "asks": []}
+    assert book.cancella("s1") is None
+
+
+def test_rimborso_del_compratore_a_prezzo_migliore_del_limite():
+    book = OrderBook("BTC")
+    book.aggiungi(ordine("s1", "SELL", "90", "1"))
+
+    #il compratore ha riservato 2 * 100 e compra 1 a 90: si sblocca la riserva di 1 al suo limite (100),
+    #al venditore vanno 90 e la differenza torna disponibile al compratore
+    (eseguito,) = book.aggiungi(ordine("b1", "BUY", "100", "2"))
+    assert eseguito.prezzo == a_unita("90")
+    assert eseguito.sbloccato == importo_unita(a_unita("1"), a_unita("100"))
+    assert eseguito.importo == importo_unita(a_unita("1"), a_unita("90"))
+    assert eseguito.sbloccato - eseguito.importo == a_unita("10")
+
+    #alla cancellazione resta riservato esattamente il residuo al prezzo limite
+    cancellato, residuo = book.cancella("b1")
+    assert residuo == a_unita("1")
+    assert cancellato.riservato == a_unita("100")
+
+
+def test_ultimo_eseguito_consuma_tutta_la_riserva():
+    book = OrderBook("BTC")
+    #quantità e prezzi scelti perché ogni eseguito arrotondi: la somma degli sbloccati deve essere la riserva iniziale
+    book.aggiungi(ordine("s1", "SELL", "0.33333333", "0.00000001"))
+    book.aggiungi(ordine("s2", "SELL", "0.33333333", "0.00000002"))
+    compratore = ordine("b1", "BUY", "0.33333333", "0.00000003")
+    riservato = compratore.riservato
+    eseguiti = book.aggiungi(compratore)
+    assert len(eseguiti) == 2
+    assert sum(e.sbloccato for e in eseguiti) == riservato
+    assert compratore.riservato == 0
+    assert all(e.importo <= e.sbloccato for e in eseguiti)
+
+
+def test_snapshot_e_replay_ricostruiscono_lo_stesso_book():
+    eventi = [
+        nuovo("s1", "SELL", "101", "2"),
+        nuovo("s2", "SELL", "100", "1"),
+        nuovo("s3", "SELL", "100", "3"),
+        nuovo("b1", "BUY", "99", "1"),
+        nuovo("b2", "BUY", "100", "2"),
+        {"tipo": "CANCEL", "order_id": "b1"},
+        {"tipo": "CANCEL", "order_id": "mai_arrivato"},
+    ]
+    successivi = [nuovo("b3", "BUY", "101", "3"), {"tipo": "CANCEL", "order_id": "s1"}, nuovo("s4", "SELL", "98", "1")]
+
+    book = OrderBook("BTC")
+    for evento in eventi:
+        book.applica(evento)
+    ricaricato = OrderBook.da_snapshot(json.loads(json.dumps(book.snapshot())))
+    assert ricaricato.snapshot() == book.snapshot()
+    assert ricaricato.profondita() == book.profondita()
+
+    #riapplicando gli stessi eventi i due book producono gli stessi eseguiti e restano uguali
+    for evento in successivi:
+        originale, copia = book.applica(evento), ricaricato.applica(evento)
+        assert riassunto(originale[0]) == riassunto(copia[0])
+        assert (originale[1] is None) == (copia[1] is None)
+    assert ricaricato.snapshot() == book.snapshot()
+
+
+def test_nuovo_ordine_dopo_la_sua_cancellazione_viene_ignorato():
+    book = OrderBook("BTC")
+    assert book.applica({"tipo": "CANCEL", "order_id": "b1"}) == ([], None)
+    assert book.applica(nuovo("b1", "BUY", "100", "1")) == ([], None)
+    assert "b1" not in book.ordini
+    assert book.annullati == {}
+
+
+def test_cancellazioni_di_ordini_sconosciuti_dimenticate_dopo_la_finestra(monkeypatch):
+    monkeypatch.setattr(matching, "ANNULLATI_PER_EVENTI", 3)
+    book = OrderBook("BTC")
+    for i in range(5):
+        book.cancella(f"c{i}")
+    assert list(book.annullati) == ["c2", "c3", "c4"]
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import uuid
+from decimal import Decimal
+import pytest
+from pydantic import ValidationError
+
+#controllo di regressione dei piani di esecuzione delle query dei router
+#esegue i flussi principali dell'api (registrazione, login, deposito, BUY, SELL, profilo, storico) contro il db locale,
+#intercetta ogni query emessa dai router e la ripassa ad EXPLAIN: se una tabella calda viene letta con un Seq Scan fallisce
+#si lancia dalla root del progetto con: python -m pytest tests/test_query_plans.py --seed
+#senza un Postgres configurato nel .env (o non raggiungibile) i test sul db vengono saltati
+
+#tabelle che non devono mai essere lette con una scansione sequenziale
+TABELLE_CALDE = {"users", "wallets", "transactions", "holdings"}
+
+#il piano non dipende dal prezzo, quindi non serve chiamare Binance
+PREZZO_FISSO = Decimal("100")
+
+
+async def prezzo_fisso(ticker: str) -> Decimal | None:
+    return PREZZO_FISSO
+
+
+async def cambio_fisso(valuta: str) -> Decimal | None:
+    return Decimal(1)
+
+
+#visita ricorsiva del piano in formato json e restituisce le tabelle calde lette con Seq Scan
+def trova_seq_scan(nodo: dict) -> list[str]:
+    trovate = []
+    if nodo.get("Node Type") == "Seq Scan" and nodo.get("Relation Name") in TABELLE_CALDE:
+        trovate.append(nodo["Relation Name"])
+    for figlio in nodo.get("Plans", []):
+        trovate.extend(trova_seq_scan(figlio))
+    return trovate
+
+
+#ogni fixture gira nel suo event loop: le connessioni di asyncpg sono legate al loop, quindi il pool si chiude prima di uscire
+def esegui(database, coroutine):
+    async def con_chiusura():
+        try:
+            return await coroutine
+        finally:
+            await database.engine.dispose()
+    return asyncio.run(con_chiusura())
+
+
+@pytest.fixture(scope="session")
+def database():
+    try:
+        from app import database
+    except ValidationError:
+        pytest.skip("Postgres locale non configurato (variabili DATABASE_* nel .env)")
+    from sqlalchemy import exc, text
+
+    async def prova():
+        async with database.engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+    try:
+        esegui(database, prova())
+    except (OSError, exc.DBAPIError) as e:
+        pytest.skip(f"Postgres locale non raggiungibile: {e}")
+    return database
+
+
+@pytest.fixture(scope="session")
+def seed(request, database):
+    if not request.config.getoption("--seed"):
+        return
+    from sqlalchemy import text
+
+    #dati sintetici generati direttamente in sql con generate_series, molto più veloce degli insert dall'ORM
+    async def popola_database(utenti: int, transazioni_per_wallet: int):
+        async with database.engine.begin() as conn:
+            await conn.execute(text("""
+                INSERT INTO users (email, password)
+                SELECT 'seed_' || g || '@example.com', 'x' FROM generate_series(1, :utenti) g
+                ON CONFLICT (email) DO NOTHING
+            """), {"utenti": utenti})
+            await conn.execute(text("""
+                INSERT INTO wallets (owner_id, currency, balance)
+                SELECT u.id, 'EUR', 1000 FROM users u
+                WHERE u.email LIKE 'seed\\_%' AND NOT EXISTS (SELECT 1 FROM wallets w WHERE w.owner_id = u.id)
+            """))
+            await conn.execute(text("""
+                INSERT INTO transactions (wallet_id, type, asset, amount, price_at_the_moment, total_payed, status, created_at)
+                SELECT w.id,
+                       CASE WHEN g % 3 = 0 THEN 'SELL' ELSE 'BUY' END,
+                       CASE WHEN g % 2 = 0 THEN 'BTC' ELSE 'ETH' END,
+                       0.001, 100, 0.1, 'COMPLETED', now() - g * interval '1 minute'
+                FROM wallets w
+                JOIN users u ON u.id = w.owner_id AND u.email LIKE 'seed\\_%'
+                CROSS JOIN generate_series(1, :per_wallet) g
+            """), {"per_wallet": transazioni_per_wallet})
+            await conn.execute(text("""
+                INSERT INTO holdings (wallet_id, asset, quantity)
+                SELECT wallet_id, asset, SUM(CASE WHEN type = 'BUY' THEN amount ELSE -amount END)
+                FROM transactions WHERE type IN ('BUY', 'SELL')
+                GROUP BY wallet_id, asset
+                ON CONFLICT (wallet_id, asset) DO UPDATE SET quantity = excluded.quantity
+            """))
+        #aggiorniamo le statistiche, altrimenti il planner ragiona come se le tabelle fossero vuote
+        async with database.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(text("ANALYZE"))
+
+    esegui(database, popola_database(request.config.getoption("--utenti"), request.config.getoption("--transazioni")))
+
+
+#query select/update/delete emesse dai router durante i flussi principali, con il loro piano json
+@pytest.fixture(scope="session")
+def piani(database, seed):
+    import httpx
+    from sqlalchemy import event, text
+    from app import fx, utils
+    from app.main import app
+
+    query_catturate = []
+    def cattura(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            query_catturate.append((statement, parameters))
+
+    async def esegui_flussi():
+        email = f"plan_check_{uuid.uuid4().hex[:8]}@example.com"
+        password = "password_di_controllo"
+
+        event.listen(database.engine.sync_engine, "before_cursor_execute", cattura)
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+                risposta = await client.post("/user", json={"email": email, "password": password})
+                risposta.raise_for_status()
+                risposta = await client.post("/login", data={"username": email, "password": password})
+                risposta.raise_for_status()
+                headers = {"Authorization": f"Bearer {risposta.json()['access_token']}"}
+
+                for metodo, url, corpo in [
+                    ("POST", "/deposit", {"deposit": "1000"}),
+                    ("POST", "/withdrawal", {"withdrawal": "10"}),
+                    ("POST", "/trade", {"type": "BUY", "asset": "BTC", "amount": "1"}),
+                    ("POST", "/trade", {"type": "SELL", "asset": "BTC", "amount": "0.5"}),
+                    ("GET", "/user", None),
+                    ("GET", "/transactions?limit=2", None),
+                    ("GET", "/transactions?asset=BTC&type=BUY", None),
+                ]:
+                    risposta = await client.request(metodo, url, json=corpo, headers=headers)
+                    risposta.raise_for_status()
+
+                #seconda pagina dello storico, per controllare anche la condizione keyset sul cursore
+                cursore = (await client.get("/transactions?limit=1", headers=headers)).json()["next_cursor"]
+                risposta = await client.get("/transactions", params={"limit": 1, "cursor": cursore}, headers=headers)
+                risposta.raise_for_status()
+        finally:
+            event.remove(database.engine.sync_engine, "before_cursor_execute", cattura)
+            #puliamo l'utente di controllo, wallet e transazioni vengono cancellati in cascata
+            async with database.engine.begin() as conn:
+                await conn.execute(text("DELETE FROM users WHERE email = :email"), {"email": email})
+
+        risultati = {}
+        async with database.engine.connect() as conn:
+            for statement, parameters in query_catturate:
+                if statement in risultati:
+                    continue
+                piano = (await conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}", parameters)).scalar()
+                risultati[statement] = json.loads(piano) if isinstance(piano, str) else piano
+            await conn.rollback()
+        return risultati
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(utils, "get_real_price", prezzo_fisso)
+        patch.setattr(fx, "get_cambio", cambio_fisso)
+        return esegui(database, esegui_flussi())
+
+
+def test_trova_seq_scan_visita_tutto_il_piano():
+    piano = {"Node Type": "Nested Loop", "Plans": [
+        {"Node Type": "Index Scan", "Relation Name": "wallets"},
+        {"Node Type": "Hash", "Plans": [{"Node Type": "Seq Scan", "Relation Name": "transactions"}]},
+        {"Node Type": "Seq Scan", "Relation Name": "order_books"},
+    ]}
+    assert trova_seq_scan(piano) == ["transactions"]
+
+
+def test_flussi_principali_emettono_query(piani):
+    assert piani
+
+
+def test_nessun_seq_scan_sulle_tabelle_calde(piani):
+    regressioni = {statement: tabelle for statement, piano in piani.items() if (tabelle := trova_seq_scan(piano[0]["Plan"]))}
+    assert not regressioni, "\n\n".join(f"SEQ SCAN su {', '.join(tabelle)}:\n{statement}" for statement, tabelle in regressioni.items())
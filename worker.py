@@ -1,66 +1,714 @@
 import asyncio
 import json
+import os
+import socket
+import time
+import uuid
+from collections import defaultdict
+from decimal import Decimal
+import orjson
+from prometheus_client import start_http_server
+from redis.exceptions import ResponseError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from app import database, models, utils
+from sqlalchemy import insert, select, text, tuple_, update
+from app import candles, database, ledger, metrics, models, streaming, utils
+from app.config import settings
+from app.matching import OrderBook, OrdineLimite, a_unita, da_unita
+from app.portfolio import Posizione
 
 #usiamo il batching e write-behind
-#il worker è un loop infinito che controlla se ci sono richieste nella coda redis
-#se ci sono le processa
-#scrive nel db
+#il worker è un loop infinito che legge gli ordini dallo stream redis con un consumer group
+#li processa a blocchi con poche query set-based, scrive nel db e solo dopo il commit conferma gli ordini con XACK
+#più processi worker possono girare in parallelo: ogni ordine viene consegnato ad uno solo di loro
+#e lo stato dell'ordine nella tabella orders impedisce di applicarlo due volte
 
 #CONFIGURAZIONE BATCH:
 BATCH_SIZE = 100 #100 ORDINI ALLA VOLTA
-POLLING_INTERVAL = 0.1 #ogni tot secondi controlla se ci sono ordini
+BLOCK_MS = 1000 #quanto resta in attesa bloccante XREADGROUP se lo stream è vuoto (niente polling a vuoto)
+MAX_TENTATIVI = 5 #dopo questi fallimenti l'ordine finisce nella dead-letter list
+RECLAIM_IDLE_MS = 60_000 #ordini pending da più di un minuto vengono presi in carico (il worker che li aveva è morto)
+RECLAIM_OGNI = 30 #ogni quanti secondi controlliamo gli ordini pending abbandonati
+CODA_OGNI = 5 #ogni quanti secondi aggiorniamo la metrica degli ordini in coda
+
+#CONFIGURAZIONE MATCHING (ordini limite):
+MATCHING_BATCH = 1000 #eventi letti dallo stream di un asset ad ogni giro, regolati nel db con una sola transazione
+SNAPSHOT_OGNI = 10_000 #ogni quanti eventi salviamo lo snapshot del book nel db
+MATCHING_LOCK_MS = 10_000 #durata del lock del leader di un asset, rinnovato ad ogni giro
+MATCHING_LOCK_KEY = "matching:{}"
+
+#CONFIGURAZIONE CANDELE (il resto è in Settings, CANDLE_*):
+CANDLE_LOCK_MS = 10_000 #durata del lock dell'aggregatore delle candele, rinnovato ad ogni scrittura
+
+#nome univoco del consumer all'interno del gruppo
+CONSUMER_NAME = f"{socket.gethostname()}-{os.getpid()}"
+
+
+#crea il consumer group (e lo stream) se non esistono ancora
+async def crea_gruppo():
+    try:
+        await utils.redis_client.xgroup_create(utils.ORDER_STREAM_KEY, utils.ORDER_GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+#legge un batch di ordini con una sola chiamata
+#prima recupera gli ordini rimasti pending a consumer morti (XAUTOCLAIM), poi legge quelli nuovi (XREADGROUP bloccante)
+async def leggi_batch(recupera_pending: bool) -> list[tuple[str, dict]]:
+    messaggi = []
+    if recupera_pending:
+        risposta = await utils.redis_client.xautoclaim(utils.ORDER_STREAM_KEY, utils.ORDER_GROUP, CONSUMER_NAME,
+                                                      min_idle_time=RECLAIM_IDLE_MS, start_id="0-0", count=BATCH_SIZE)
+        messaggi = risposta[1]
+
+    if not messaggi:
+        risposta = await utils.redis_client.xreadgroup(utils.ORDER_GROUP, CONSUMER_NAME, {utils.ORDER_STREAM_KEY: ">"},
+                                                      count=BATCH_SIZE, block=BLOCK_MS)
+        messaggi = risposta[0][1] if risposta else []
+
+    #i messaggi cancellati dallo stream mentre erano pending arrivano senza campi
+    return [(id, json.loads(campi["ordine"])) for id, campi in messaggi if campi]
 
 async def process_orders_batch():
+    ultimo_reclaim = 0
+    gruppo_creato = False
     while True:
         if not utils.redis_client:
             await asyncio.sleep(5)
             continue
-        
-        ordini_da_processare = []
-        for i in range(BATCH_SIZE):
-            #rpop prende l'ultimo elemento della coda
-            ordine = await utils.redis_client.rpop(utils.ORDER_QUEUE_KEY)
-            if ordine:
-                ordini_da_processare.append(json.loads(ordine))
-            else:
-                break
+
+        try:
+            if not gruppo_creato:
+                await crea_gruppo()
+                gruppo_creato = True
+            adesso = asyncio.get_running_loop().time()
+            recupera_pending = adesso - ultimo_reclaim > RECLAIM_OGNI
+            if recupera_pending:
+                ultimo_reclaim = adesso
+            ordini_da_processare = await leggi_batch(recupera_pending)
+        except Exception as e:
+            print(f"Errore Redis nella lettura degli ordini: {e}")
+            await asyncio.sleep(1)
+            continue
 
         if not ordini_da_processare:
-            await asyncio.sleep(POLLING_INTERVAL)
             continue
-        
-        #apriamo una sessione dedicata per processario gli ordini
-        async with database.SessionLocal() as db:
-            print(f"Sto processando un batch di {len(ordini_da_processare)} ordini")
 
-            for ordini in ordini_da_processare:
-                try:
-                    await esegui_singolo_ordine(db, ordini)
-                except Exception as e:
-                    print(f"Errore processando ordine {ordini}: {e}")
+        try:
+            await esegui_batch(ordini_da_processare)
+        except Exception as e:
+            #gli ordini non confermati restano pending e verranno ripresi con XAUTOCLAIM
+            print(f"Errore nell'esecuzione del batch: {e}")
+            await asyncio.sleep(1)
 
-            await db.commit()
+#esegue un batch di ordini e poi li conferma su redis
+#se il batch fallisce rieseguiamo gli ordini uno alla volta, cosi un ordine "avvelenato" non blocca gli altri
+async def esegui_batch(messaggi: list[tuple[str, dict]]):
+    confermati = []
+    falliti = []
+    try:
+        confermati = await esegui_ordini(messaggi)
+    except Exception as e:
+        print(f"Errore nel batch di {len(messaggi)} ordini, li riprovo uno alla volta: {e}")
+        for messaggio in messaggi:
+            try:
+                confermati += await esegui_ordini([messaggio])
+            except Exception as e:
+                print(f"Errore processando ordine {messaggio[1]}: {e}")
+                falliti.append((messaggio[0], messaggio[1], str(e)))
+
+    await conferma_ordini(confermati, falliti)
+
+#esecuzione set-based di un batch di ordini in un'unica transazione del db:
+#1) un SELECT ... FOR UPDATE sugli ordini ancora QUEUED (SKIP LOCKED: quelli presi da un altro worker si saltano)
+#2) un SELECT ... FOR UPDATE su tutti i wallet coinvolti, ordinati per id per non andare mai in deadlock
+#3) gli ordini vengono applicati in memoria nell'ordine di arrivo
+#4) un solo insert (executemany) per le transazioni e uno per le righe del mastro, un solo UPDATE per i saldi,
+#   un solo upsert per gli holdings e un solo UPDATE per lo stato degli ordini
+#restituisce gli id dei messaggi redis che si possono confermare
+async def esegui_ordini(messaggi: list[tuple[str, dict]]) -> list[str]:
+    id_ordini = [ordine["order_id"] for _, ordine in messaggi]
+
+    metrics.WORKER_BATCH_SIZE.labels("orders").observe(len(messaggi))
+    async with database.SessionLocal() as db:
+        print(f"Sto processando un batch di {len(messaggi)} ordini")
+
+        query = select(
+            models.Order.id, models.Order.owner_id, models.Order.wallet_id, models.Order.type, models.Order.asset,
+            models.Order.amount, models.Order.price, models.Order.status
+        ).where(models.Order.id.in_(id_ordini)).with_for_update(skip_locked=True)
+        result = await db.execute(query)
+        bloccati = {ordine.id: ordine for ordine in result.all()}
+
+        #gli ordini che non abbiamo bloccato o esistono (li sta eseguendo un altro worker, restano pending)
+        #o non esistono più (utente cancellato), e in quel caso si possono confermare
+        mancanti = [id for id in id_ordini if id not in bloccati]
+        esistenti = set()
+        if mancanti:
+            result = await db.execute(select(models.Order.id).where(models.Order.id.in_(mancanti)))
+            esistenti = set(result.scalars().all())
+
+        #l'idempotenza è garantita dallo stato: un ordine riconsegnato che non è più QUEUED non viene rieseguito
+        da_eseguire = [bloccati[id] for id in id_ordini if id in bloccati and bloccati[id].status == "QUEUED"]
+
+        esiti = []
+        #applica_ordini blocca i wallet del batch, che restano bloccati fino alla fine del commit
+        bloccati_da = time.perf_counter()
+        if da_eseguire:
+            esiti = await applica_ordini(db, da_eseguire)
+        inizio_commit = time.perf_counter()
+        await db.commit()
+        fine_commit = time.perf_counter()
+        metrics.WORKER_COMMIT_DURATION.labels("orders").observe(fine_commit - inizio_commit)
+        if da_eseguire:
+            metrics.WALLET_LOCK_HOLD.labels("worker_orders").observe(fine_commit - bloccati_da)
 
-#funziona per processare un singolo ordine
-async def esegui_singolo_ordine(db: AsyncSession, data: dict):
+    #dopo il commit avvisiamo i proprietari degli ordini sul loro canale personale
+    await utils.pubblica_esiti_ordini(esiti)
+    return [id_messaggio for id_messaggio, ordine in messaggi if ordine["order_id"] not in esistenti]
 
-    #dati che passeremo nell'endpoint trade del router transactions
-    user_id = data["owner_id"]
-    asset = data["asset"]
-    amount = data["amount"]
-    price = data["price"]
+#scrive in un solo upsert i valori assoluti delle posizioni calcolate in memoria, con i wallet ancora bloccati
+async def scrivi_posizioni(db: AsyncSession, posizioni: list[tuple[int, str, Posizione]]):
+    await db.execute(text("""
+        INSERT INTO holdings (wallet_id, asset, quantity, reserved, cost_basis, realized_pnl)
+        SELECT * FROM unnest(CAST(:wallet_ids AS integer[]), CAST(:assets AS varchar[]), CAST(:quantita AS numeric[]),
+                             CAST(:riservate AS numeric[]), CAST(:costi AS numeric[]), CAST(:realizzati AS numeric[]))
+        ON CONFLICT (wallet_id, asset) DO UPDATE SET quantity = excluded.quantity, reserved = excluded.reserved,
+            cost_basis = excluded.cost_basis, realized_pnl = excluded.realized_pnl, updated_at = now()
+    """), {
+        "wallet_ids": [wallet_id for wallet_id, _, _ in posizioni],
+        "assets": [asset for _, asset, _ in posizioni],
+        "quantita": [posizione.quantity for _, _, posizione in posizioni],
+        "riservate": [posizione.reserved for _, _, posizione in posizioni],
+        "costi": [posizione.cost_basis for _, _, posizione in posizioni],
+        "realizzati": [posizione.realized_pnl for _, _, posizione in posizioni],
+    })
 
-    #qui facciamo le stesse cose che facevamo nel router transactions
-    #query per ottenere il wallet
-    query = select(models.Wallet).where(models.Wallet.owner_id == user_id)
+#restituisce l'esito di ogni ordine, da notificare al proprietario
+async def applica_ordini(db: AsyncSession, ordini: list) -> list[dict]:
+    #blocchiamo tutti i wallet coinvolti in un colpo solo, sempre in ordine di id
+    #le modifiche agli holdings di un wallet avvengono solo con il suo lock, quindi non serve bloccare anche quelli
+    id_wallet = sorted({ordine.wallet_id for ordine in ordini})
+    query = select(models.Wallet.id, models.Wallet.balance, models.Wallet.currency).where(models.Wallet.id.in_(id_wallet)).order_by(models.Wallet.id).with_for_update()
     result = await db.execute(query)
-    wallet = result.scalar_one_or_none()
+    wallet_letti = result.all()
+    saldi = {wallet.id: wallet.balance for wallet in wallet_letti}
+    valute = {wallet.id: wallet.currency for wallet in wallet_letti}
+
+    coppie = {(ordine.wallet_id, ordine.asset) for ordine in ordini}
+    query = select(models.Holding.wallet_id, models.Holding.asset, models.Holding.quantity, models.Holding.reserved,
+                   models.Holding.cost_basis, models.Holding.realized_pnl).where(
+        tuple_(models.Holding.wallet_id, models.Holding.asset).in_(coppie)
+    )
+    result = await db.execute(query)
+    posizioni = defaultdict(Posizione)
+    for holding in result.all():
+        posizioni[(holding.wallet_id, holding.asset)] = Posizione(holding.quantity, holding.reserved, holding.cost_basis, holding.realized_pnl)
+
+    #applichiamo gli ordini in memoria con le stesse regole del trade sincrono
+    eseguiti = []
+    rifiutati = []
+    for ordine in ordini:
+        chiave = (ordine.wallet_id, ordine.asset)
+        totale_da_pagare = ledger.arrotonda(ordine.amount * ordine.price)
+        if ordine.wallet_id not in saldi:
+            rifiutati.append((ordine, "Wallet non trovato"))
+        elif ordine.type == "BUY":
+            if totale_da_pagare > saldi[ordine.wallet_id]:
+                rifiutati.append((ordine, f"Saldo troppo basso: {saldi[ordine.wallet_id]}"))
+                continue
+            saldi[ordine.wallet_id] -= totale_da_pagare
+            posizioni[chiave].compra(ordine.amount, totale_da_pagare)
+            eseguiti.append(ordine)
+        elif ordine.type == "SELL":
+            if ordine.amount > posizioni[chiave].quantity:
+                rifiutati.append((ordine, f"Crypto insufficienti da vendere, possedute: {posizioni[chiave].quantity}"))
+                continue
+            saldi[ordine.wallet_id] += totale_da_pagare
+            posizioni[chiave].vendi(ordine.amount, totale_da_pagare)
+            eseguiti.append(ordine)
+        else:
+            rifiutati.append((ordine, f"Tipo di ordine non valido: {ordine.type}"))
+
+    id_transazioni = []
+    if eseguiti:
+        #un solo insert multi-riga per tutte le transazioni, con gli id restituiti nello stesso ordine
+        righe = [{
+            "wallet_id": ordine.wallet_id,
+            "type": ordine.type,
+            "asset": ordine.asset,
+            "amount": ordine.amount,
+            "price_at_the_moment": ordine.price,
+            "total_payed": ledger.arrotonda(ordine.amount * ordine.price),
+            "status": "COMPLETED",
+        } for ordine in eseguiti]
+        result = await db.execute(insert(models.Transaction).returning(models.Transaction.id, sort_by_parameter_order=True), righe)
+        id_transazioni = result.scalars().all()
+
+        #righe del mastro di tutti gli ordini eseguiti con un solo insert
+        await ledger.registra(db, [
+            riga
+            for ordine, riga_transazione, id_transazione in zip(eseguiti, righe, id_transazioni)
+            for riga in ledger.scambio(ordine.type, ordine.wallet_id, valute[ordine.wallet_id], ordine.asset, ordine.amount,
+                                       riga_transazione["total_payed"], id_transazione, ordine.id)
+        ])
+
+        #un solo UPDATE per tutti i saldi
+        wallet_toccati = sorted({ordine.wallet_id for ordine in eseguiti})
+        await db.execute(text("""
+            UPDATE wallets SET balance = v.balance, version = wallets.version + 1
+            FROM unnest(CAST(:ids AS integer[]), CAST(:saldi AS numeric[])) AS v(id, balance)
+            WHERE wallets.id = v.id
+        """), {"ids": wallet_toccati, "saldi": [saldi[id] for id in wallet_toccati]})
+
+        #un solo upsert per tutte le quantità possedute, con costo e pnl realizzato
+        coppie_toccate = sorted({(ordine.wallet_id, ordine.asset) for ordine in eseguiti})
+        await scrivi_posizioni(db, [(wallet_id, asset, posizioni[(wallet_id, asset)]) for wallet_id, asset in coppie_toccate])
+
+    esiti = [{"order_id": ordine.id, "owner_id": ordine.owner_id, "status": "EXECUTED", "reason": None, "transaction_id": id_transazione}
+             for ordine, id_transazione in zip(eseguiti, id_transazioni)]
+    esiti += [{"order_id": ordine.id, "owner_id": ordine.owner_id, "status": "REJECTED", "reason": motivo, "transaction_id": None}
+              for ordine, motivo in rifiutati]
+
+    #un solo UPDATE per lo stato di tutti gli ordini del batch
+    await db.execute(text("""
+        UPDATE orders SET status = v.status, reason = v.reason, transaction_id = v.transaction_id, updated_at = now()
+        FROM unnest(CAST(:ids AS varchar[]), CAST(:stati AS varchar[]), CAST(:motivi AS varchar[]), CAST(:transazioni AS integer[]))
+             AS v(id, status, reason, transaction_id)
+        WHERE orders.id = v.id
+    """), {
+        "ids": [esito["order_id"] for esito in esiti],
+        "stati": [esito["status"] for esito in esiti],
+        "motivi": [esito["reason"] for esito in esiti],
+        "transazioni": [esito["transaction_id"] for esito in esiti],
+    })
+    return esiti
+
+#conferma su redis gli ordini processati, tutto in un round-trip
+async def conferma_ordini(confermati: list[str], falliti: list[tuple[str, dict, str]]):
+    morti = []
+    async with utils.redis_client.pipeline(transaction=True) as pipe:
+        #gli ordini falliti vengono rimessi in coda con un tentativo in più, oltre MAX_TENTATIVI vanno nella dead-letter list
+        for id_messaggio, ordine, errore in falliti:
+            ordine["tentativi"] = ordine.get("tentativi", 0) + 1
+            if ordine["tentativi"] >= MAX_TENTATIVI:
+                pipe.lpush(utils.ORDER_DEAD_LETTER_KEY, json.dumps({"ordine": ordine, "errore": errore}, default=str))
+                morti.append(ordine["order_id"])
+            else:
+                pipe.xadd(utils.ORDER_STREAM_KEY, {"ordine": json.dumps(ordine, default=str)})
+
+        ids = confermati + [id_messaggio for id_messaggio, _, _ in falliti]
+        if ids:
+            pipe.xack(utils.ORDER_STREAM_KEY, utils.ORDER_GROUP, *ids)
+            #gli ordini confermati non servono più nello stream
+            pipe.xdel(utils.ORDER_STREAM_KEY, *ids)
+        await pipe.execute()
+
+    #gli ordini finiti nella dead-letter list non verranno più eseguiti: lo segnaliamo anche al client
+    if morti:
+        async with database.SessionLocal() as db:
+            result = await db.execute(
+                update(models.Order)
+                .where(models.Order.id.in_(morti), models.Order.status == "QUEUED")
+                .values(status="REJECTED", reason="Errore nell'esecuzione dell'ordine")
+                .returning(models.Order.id, models.Order.owner_id)
+            )
+            esiti = [{"order_id": ordine.id, "owner_id": ordine.owner_id, "status": "REJECTED",
+                      "reason": "Errore nell'esecuzione dell'ordine", "transaction_id": None} for ordine in result.all()]
+            await db.commit()
+        await utils.pubblica_esiti_ordini(esiti)
+
+
+#MOTORE DI MATCHING DEGLI ORDINI LIMITE
+#per ogni asset un solo processo worker (quello che tiene il lock su redis) legge lo stream degli eventi
+#e li applica al book in memoria uno alla volta; gli eseguiti di ogni batch vengono regolati nel db con poche query set-based
+#se il worker muore un altro prende il lock e ricostruisce il book dall'ultimo snapshot più il replay degli eventi successivi
+
+#il lock scade da solo se il leader muore, finché è vivo lo rinnova ad ogni giro
+async def tieni_lock(chiave: str, durata_ms: int) -> bool:
+    if await utils.redis_client.set(chiave, CONSUMER_NAME, nx=True, px=durata_ms):
+        return True
+    if await utils.redis_client.get(chiave) == CONSUMER_NAME:
+        await utils.redis_client.pexpire(chiave, durata_ms)
+        return True
+    return False
+
+#ricostruisce il book di un asset: snapshot salvato nel db più il replay degli eventi già regolati dopo lo snapshot
+#gli eventi riapplicati non vengono regolati di nuovo, i loro effetti sono già nel db
+#restituisce il book, l'id dell'ultimo evento regolato e il seq dell'ultimo snapshot
+async def carica_book(asset: str) -> tuple[OrderBook, str, int]:
+    async with database.SessionLocal() as db:
+        #la riga di stato serve anche come fencing token tra due leader (vedi regola_matching)
+        await db.execute(pg_insert(models.OrderBookState).values(asset=asset).on_conflict_do_nothing())
+        await db.commit()
+        result = await db.execute(select(models.OrderBookState).where(models.OrderBookState.asset == asset))
+        stato = result.scalar_one()
+        snapshot, snapshot_id, ultimo_id = stato.snapshot, stato.snapshot_event_id, stato.last_event_id
+
+    book = OrderBook.da_snapshot(snapshot) if snapshot else OrderBook(asset)
+    seq_snapshot = book.seq
+    stream = utils.LIMIT_ORDER_STREAM_KEY.format(asset)
+    inizio = snapshot_id or "0-0"
+    while ultimo_id != "0-0" and inizio != ultimo_id:
+        eventi = await utils.redis_client.xrange(stream, min=f"({inizio}", max=ultimo_id, count=MATCHING_BATCH)
+        if not eventi:
+            break
+        for _, campi in eventi:
+            book.applica(json.loads(campi["evento"]))
+        inizio = eventi[-1][0]
+
+    print(f"Book {asset} caricato: {len(book.ordini)} ordini aperti, ultimo evento {ultimo_id}")
+    return book, ultimo_id, seq_snapshot
+
+#regola nel db gli effetti di un batch di eventi, tutto in un'unica transazione:
+#1) UPDATE della riga di stato solo se last_event_id è quello atteso, cosi un ex leader non può regolare due volte gli stessi eventi
+#2) un insert multi-riga delle transazioni (BUY per il compratore e SELL per il venditore di ogni eseguito)
+#3) le righe del mastro di eseguiti e cancellazioni, da cui si ricavano i delta: un solo UPDATE per i saldi
+#   e un solo upsert per gli holdings, rispetto ai fondi già riservati dall'api
+#4) un solo UPDATE per quantità eseguita e stato degli ordini toccati
+#orfani sono le cancellazioni di ordini che non erano nel book (vedi sotto)
+#restituisce gli esiti da notificare ai proprietari
+async def regola_matching(asset: str, eseguiti: list, cancellati: list, orfani: list[str], precedente_id: str, ultimo_id: str, seq: int,
+                          snapshot: dict | None) -> list[dict]:
+    eseguito = defaultdict(int)
+    ordini = {}
+    righe = []
+    for esecuzione in eseguiti:
+        if esecuzione.taker.lato == "BUY":
+            compratore, venditore = esecuzione.taker, esecuzione.maker
+        else:
+            compratore, venditore = esecuzione.maker, esecuzione.taker
+        fill_id = uuid.uuid4().hex
+        for ordine in (compratore, venditore):
+            eseguito[ordine.id] += esecuzione.quantita
+            ordini[ordine.id] = ordine
+            righe.append({
+                "wallet_id": ordine.wallet_id,
+                "type": ordine.lato,
+                "asset": asset,
+                "amount": da_unita(esecuzione.quantita),
+                "price_at_the_moment": da_unita(esecuzione.prezzo),
+                "total_payed": da_unita(esecuzione.importo),
+                "status": "COMPLETED",
+                "fill_id": fill_id,
+            })
+
+    residui = {}
+    for ordine, residuo in cancellati:
+        residui[ordine.id] = residuo
+        ordini[ordine.id] = ordine
+
+    async with database.SessionLocal() as db:
+        valori = {"last_event_id": ultimo_id, "seq": seq}
+        if snapshot:
+            valori.update(snapshot=snapshot, snapshot_event_id=ultimo_id)
+        result = await db.execute(
+            update(models.OrderBookState)
+            .where(models.OrderBookState.asset == asset, models.OrderBookState.last_event_id == precedente_id)
+            .values(**valori)
+        )
+        if result.rowcount != 1:
+            await db.rollback()
+            raise RuntimeError(f"Stato del book {asset} modificato da un altro worker")
+
+        #un ordine ancora OPEN nel db che non era nel book non ci è mai entrato: l'api, non sapendo se il NEW era arrivato
+        #a redis, ha chiesto la cancellazione (e un NEW arrivato dopo viene ignorato, vedi OrderBook.cancella)
+        #si chiude qui come una cancellazione normale restituendo tutta la riserva; quelli toccati nel batch sono già regolati
+        orfani = [order_id for order_id in orfani if order_id not in ordini]
+        if orfani:
+            result = await db.execute(select(
+                models.Order.id, models.Order.owner_id, models.Order.wallet_id, models.Order.type, models.Order.price, models.Order.amount
+            ).where(models.Order.id.in_(orfani), models.Order.asset == asset, models.Order.kind == "LIMIT",
+                    models.Order.status == "OPEN", models.Order.filled == 0))
+            for riga in result.all():
+                ordine = OrdineLimite(riga.id, riga.owner_id, riga.wallet_id, riga.type, a_unita(riga.price), a_unita(riga.amount))
+                cancellati = cancellati + [(ordine, ordine.quantita)]
+                residui[ordine.id] = ordine.quantita
+                ordini[ordine.id] = ordine
+
+        #blocchiamo i wallet in ordine di id come fa applica_ordini, cosi i due worker non vanno in deadlock
+        #e leggiamo la valuta di ognuno per le righe del mastro; il lock va preso prima di inserire le transazioni:
+        #la foreign key di ogni riga prende FOR KEY SHARE sul suo wallet, nell'ordine degli eseguiti e non in ordine di id
+        valute = {}
+        posizioni = defaultdict(Posizione)
+        id_wallet = sorted({ordine.wallet_id for ordine in ordini.values()})
+        bloccati_da = time.perf_counter()
+        if id_wallet:
+            result = await db.execute(select(models.Wallet.id, models.Wallet.currency).where(models.Wallet.id.in_(id_wallet)).order_by(models.Wallet.id).with_for_update())
+            valute = {wallet.id: wallet.currency for wallet in result.all()}
+            #le posizioni sull'asset, che con i wallet bloccati non possono cambiare
+            result = await db.execute(select(
+                models.Holding.wallet_id, models.Holding.quantity, models.Holding.reserved, models.Holding.cost_basis, models.Holding.realized_pnl
+            ).where(models.Holding.asset == asset, models.Holding.wallet_id.in_(id_wallet)))
+            for holding in result.all():
+                posizioni[holding.wallet_id] = Posizione(holding.quantity, holding.reserved, holding.cost_basis, holding.realized_pnl)
+
+        if righe:
+            await db.execute(insert(models.Transaction), righe)
+
+        #ogni eseguito sposta la riserva del compratore al venditore (e la differenza col prezzo limite al compratore)
+        #e la quantità riservata del venditore al compratore; se le valute dei due wallet sono diverse fa da ponte il mercato
+        #le cancellazioni restituiscono al proprietario la riserva rimasta
+        #gli holdings cambiano con gli stessi importi del mastro: il compratore riceve la quantità e ne paga il costo,
+        #il venditore vende quantità già riservata e una cancellazione SELL restituisce quella rimasta
+        mastro = []
+        for esecuzione in eseguiti:
+            if esecuzione.taker.lato == "BUY":
+                compratore, venditore = esecuzione.taker, esecuzione.maker
+            else:
+                compratore, venditore = esecuzione.maker, esecuzione.taker
+            valuta_compratore = valute.get(compratore.wallet_id, ledger.VALUTA_PREDEFINITA)
+            valuta_venditore = valute.get(venditore.wallet_id, ledger.VALUTA_PREDEFINITA)
+            importo = da_unita(esecuzione.importo)
+            gambe = [
+                (ledger.RESERVED, compratore.wallet_id, valuta_compratore, -da_unita(esecuzione.sbloccato)),
+                (ledger.WALLET, compratore.wallet_id, valuta_compratore, da_unita(esecuzione.sbloccato - esecuzione.importo)),
+                (ledger.WALLET, venditore.wallet_id, valuta_venditore, importo),
+                (ledger.RESERVED, venditore.wallet_id, asset, -da_unita(esecuzione.quantita)),
+                (ledger.WALLET, compratore.wallet_id, asset, da_unita(esecuzione.quantita)),
+            ]
+            if valuta_compratore != valuta_venditore:
+                gambe += [(ledger.MARKET, ledger.SISTEMA, valuta_compratore, importo), (ledger.MARKET, ledger.SISTEMA, valuta_venditore, -importo)]
+            mastro += ledger.scrittura("FILL", gambe, order_id=esecuzione.taker.id)
+            posizioni[compratore.wallet_id].compra(da_unita(esecuzione.quantita), importo)
+            posizioni[venditore.wallet_id].vendi(da_unita(esecuzione.quantita), importo, riservata=True)
+        for ordine, _ in cancellati:
+            valuta = valute.get(ordine.wallet_id, ledger.VALUTA_PREDEFINITA) if ordine.lato == "BUY" else asset
+            mastro += ledger.riserva(ordine.wallet_id, valuta, -da_unita(ordine.riservato), ordine.id)
+            if ordine.lato == "SELL":
+                posizioni[ordine.wallet_id].riserva(da_unita(ordine.riservato), segno=-1)
+        await ledger.registra(db, mastro)
+
+        #i delta dei saldi sono le righe WALLET del mastro, cosi i due coincidono sempre
+        saldi = defaultdict(Decimal)
+        for riga in mastro:
+            if riga["account"] == ledger.WALLET and riga["asset"] != asset:
+                saldi[riga["wallet_id"]] += riga["amount"]
+
+        wallet_toccati = sorted(wallet_id for wallet_id, delta in saldi.items() if delta)
+        if wallet_toccati:
+            await db.execute(text("""
+                UPDATE wallets SET balance = wallets.balance + v.delta, version = wallets.version + 1
+                FROM unnest(CAST(:ids AS integer[]), CAST(:delta AS numeric[])) AS v(id, delta)
+                WHERE wallets.id = v.id
+            """), {"ids": wallet_toccati, "delta": [saldi[id] for id in wallet_toccati]})
+
+        #un solo upsert per le posizioni toccate (le cancellazioni BUY non toccano gli holdings)
+        holdings_toccati = sorted({riga["wallet_id"] for riga in mastro if riga["asset"] == asset})
+        if holdings_toccati:
+            await scrivi_posizioni(db, [(wallet_id, asset, posizioni[wallet_id]) for wallet_id in holdings_toccati])
+
+        esiti = []
+        for ordine in ordini.values():
+            if ordine.id in residui:
+                stato = "CANCELLED"
+                totale_eseguito = ordine.iniziale - residui[ordine.id]
+            else:
+                stato = "OPEN" if ordine.quantita else "FILLED"
+                totale_eseguito = ordine.iniziale - ordine.quantita
+            esiti.append({"order_id": ordine.id, "owner_id": ordine.owner_id, "status": stato, "reason": None,
+                          "transaction_id": None, "filled": da_unita(totale_eseguito)})
+
+        if esiti:
+            await db.execute(text("""
+                UPDATE orders SET filled = orders.filled + v.delta, status = v.status, updated_at = now()
+                FROM unnest(CAST(:ids AS varchar[]), CAST(:delta AS numeric[]), CAST(:stati AS varchar[])) AS v(id, delta, status)
+                WHERE orders.id = v.id
+            """), {
+                "ids": [esito["order_id"] for esito in esiti],
+                "delta": [da_unita(eseguito[esito["order_id"]]) for esito in esiti],
+                "stati": [esito["status"] for esito in esiti],
+            })
+        inizio_commit = time.perf_counter()
+        await db.commit()
+        fine_commit = time.perf_counter()
+        metrics.WORKER_COMMIT_DURATION.labels("matching").observe(fine_commit - inizio_commit)
+        if id_wallet:
+            metrics.WALLET_LOCK_HOLD.labels("worker_matching").observe(fine_commit - bloccati_da)
+    return esiti
+
+def formatta_livelli(livelli: list[list[int]]) -> list[list[str]]:
+    return [[str(da_unita(prezzo)), str(da_unita(quantita))] for prezzo, quantita in livelli]
+
+#pubblica i dati di mercato dopo un batch: fotografia, differenze dei livelli toccati e nastro degli eseguiti
+#ogni messaggio viene serializzato una volta sola qui, le api lo inoltrano identico a tutti i client iscritti
+#la fotografia viene scritta prima della publish nella stessa transazione redis,
+#cosi chi riceve una differenza trova sempre nella chiave una fotografia almeno altrettanto recente
+async def pubblica_book(asset: str, book: OrderBook, precedente_seq: int, eseguiti: list):
+    diff = book.estrai_diff()
+    profondita = book.profondita(settings.BOOK_DEPTH)
+    fotografia = orjson.dumps({
+        "type": "snapshot", "asset": asset, "seq": book.seq,
+        "bids": formatta_livelli(profondita["bids"]), "asks": formatta_livelli(profondita["asks"]),
+    })
+    try:
+        async with utils.redis_client.pipeline(transaction=True) as pipe:
+            pipe.set(utils.BOOK_KEY.format(asset), fotografia)
+            if diff["bids"] or diff["asks"]:
+                #intestazione "precedente_seq seq " davanti al json: le api controllano la sequenza senza deserializzare
+                messaggio = orjson.dumps({
+                    "type": "diff", "asset": asset, "seq": book.seq, "prev_seq": precedente_seq,
+                    "bids": formatta_livelli(diff["bids"]), "asks": formatta_livelli(diff["asks"]),
+                })
+                pipe.publish(utils.BOOK_CHANNEL.format(asset), f"{precedente_seq} {book.seq} ".encode() + messaggio)
+            if eseguiti:
+                adesso = int(time.time() * 1000)
+                pipe.publish(utils.TRADES_CHANNEL.format(asset), orjson.dumps({
+                    "type": "trades", "asset": asset, "seq": book.seq,
+                    "trades": [{"price": str(da_unita(esecuzione.prezzo)), "amount": str(da_unita(esecuzione.quantita)),
+                                "side": esecuzione.taker.lato, "ts": adesso} for esecuzione in eseguiti],
+                }))
+            await pipe.execute()
+    except Exception as e:
+        print(f"Errore Redis nella pubblicazione del book {asset}: {e}")
+
+async def process_limit_orders(asset: str):
+    stream = utils.LIMIT_ORDER_STREAM_KEY.format(asset)
+    book = None
+    while True:
+        if not utils.redis_client:
+            await asyncio.sleep(5)
+            continue
+
+        try:
+            if not await tieni_lock(MATCHING_LOCK_KEY.format(asset), MATCHING_LOCK_MS):
+                #un altro worker è il leader di questo asset: se lo eravamo noi il book in memoria non è più valido
+                book = None
+                await asyncio.sleep(MATCHING_LOCK_MS / 2000)
+                continue
+            if book is None:
+                book, ultimo_id, seq_snapshot = await carica_book(asset)
+                #dopo un ricaricamento pubblichiamo solo la fotografia: i livelli toccati dal replay non sono differenze nuove
+                #e i client con una sequenza diversa si risincronizzano alla prossima differenza
+                book.estrai_diff()
+                await pubblica_book(asset, book, book.seq, [])
+                seq_pubblicato = book.seq
+            risposta = await utils.redis_client.xread({stream: ultimo_id}, count=MATCHING_BATCH, block=BLOCK_MS)
+        except Exception as e:
+            print(f"Errore nella lettura degli eventi di matching di {asset}: {e}")
+            book = None
+            await asyncio.sleep(1)
+            continue
+
+        if not risposta:
+            continue
+
+        eventi = risposta[0][1]
+        metrics.WORKER_BATCH_SIZE.labels("matching").observe(len(eventi))
+        eseguiti = []
+        cancellati = []
+        orfani = []
+        for _, campi in eventi:
+            evento = json.loads(campi["evento"])
+            nuovi, cancellato = book.applica(evento)
+            eseguiti += nuovi
+            if cancellato:
+                cancellati.append(cancellato)
+            elif evento["tipo"] == "CANCEL":
+                orfani.append(evento["order_id"])
+
+        nuovo_id = eventi[-1][0]
+        precedente_seq = seq_pubblicato
+        snapshot = book.snapshot() if book.seq - seq_snapshot >= SNAPSHOT_OGNI else None
+        try:
+            esiti = await regola_matching(asset, eseguiti, cancellati, orfani, ultimo_id, nuovo_id, book.seq, snapshot)
+        except Exception as e:
+            #il book in memoria è andato avanti ma il db no: lo ricostruiamo da snapshot e replay e rileggiamo gli eventi
+            print(f"Errore nella regolazione del matching di {asset}: {e}")
+            book = None
+            await asyncio.sleep(1)
+            continue
+
+        ultimo_id = nuovo_id
+        if snapshot:
+            seq_snapshot = book.seq
+            try:
+                #gli eventi precedenti lo snapshot non servono più per il replay
+                await utils.redis_client.xtrim(stream, minid=nuovo_id)
+            except Exception as e:
+                print(f"Errore Redis nel trim dello stream {stream}: {e}")
+        await utils.pubblica_esiti_ordini(esiti)
+        await pubblica_book(asset, book, precedente_seq, eseguiti)
+        seq_pubblicato = book.seq
+
+
+#CANDELE OHLCV (app/candles.py)
+#un solo worker, quello che tiene il lock, riceve i tick dei prezzi dal pub/sub e legge le transazioni nuove in ordine di id;
+#ogni CANDLE_FLUSH_INTERVAL secondi (subito se le transazioni arretrate superano un batch) scrive le candele modificate
+#e sposta il cursore in un'unica transazione del db. Dopo un errore o se perde il lock butta la memoria e riparte dal cursore:
+#si perdono al massimo i tick dall'ultima scrittura, mai le transazioni
+async def aggrega_candele():
+    canali = [f"prezzo_di_{ticker}" for ticker in settings.SUPPORTED_TICKERS]
+    aggregatore = None
+    while True:
+        arretrate = False
+        try:
+            if not utils.redis_client or not await tieni_lock(candles.CANDLE_LOCK_KEY, CANDLE_LOCK_MS):
+                if aggregatore is not None:
+                    await streaming.hub.disiscrivi(aggregatore, canali)
+                    aggregatore = None
+            else:
+                if aggregatore is None:
+                    async with database.engine.connect() as conn:
+                        posizione, _ = await candles.leggi_cursore(conn, candles.CURSORE_LIVE)
+                    aggregatore = candles.Aggregatore(posizione)
+                    await streaming.hub.iscrivi(aggregatore, canali)
+
+                precedente = aggregatore.posizione
+                async with database.engine.begin() as conn:
+                    transazioni = await candles.leggi_transazioni(conn, precedente, settings.CANDLE_TX_BATCH, ritardo=settings.CANDLE_TX_DELAY)
+                    aggregatore.aggiungi_transazioni(transazioni)
+                    righe = aggregatore.da_scrivere()
+                    inizio_commit = time.perf_counter()
+                    if (righe or aggregatore.posizione != precedente) and \
+                            not await candles.scrivi_candele(conn, righe, candles.CURSORE_LIVE, precedente, aggregatore.posizione):
+                        raise RuntimeError("Cursore delle candele spostato da un altro worker")
+                metrics.WORKER_COMMIT_DURATION.labels("candles").observe(time.perf_counter() - inizio_commit)
+                metrics.WORKER_BATCH_SIZE.labels("candles").observe(len(righe))
+                #le finestre chiuse restano in memoria finchè possono ancora arrivare transazioni in ritardo
+                aggregatore.scritte(righe, margine=settings.CANDLE_TX_DELAY * 2)
+                arretrate = len(transazioni) == settings.CANDLE_TX_BATCH
+        except Exception as e:
+            print(f"Errore nell'aggregazione delle candele: {e}")
+            if aggregatore is not None:
+                await streaming.hub.disiscrivi(aggregatore, canali)
+                aggregatore = None
+        if not arretrate:
+            await asyncio.sleep(settings.CANDLE_FLUSH_INTERVAL)
+
+
+#ordini sullo stream non ancora letti dal gruppo (lag, redis >= 7) e letti ma non ancora confermati (pending)
+async def misura_coda():
+    while True:
+        if utils.redis_client:
+            try:
+                for gruppo in await utils.redis_client.xinfo_groups(utils.ORDER_STREAM_KEY):
+                    if gruppo["name"] == utils.ORDER_GROUP:
+                        metrics.WORKER_QUEUE_DEPTH.labels("waiting").set(gruppo.get("lag") or 0)
+                        metrics.WORKER_QUEUE_DEPTH.labels("pending").set(gruppo["pending"])
+            except Exception as e:
+                #lo stream non esiste finchè non arriva il primo ordine
+                if "no such key" not in str(e):
+                    print(f"Errore Redis nella lettura della coda ordini: {e}")
+        await asyncio.sleep(CODA_OGNI)
+
+async def main():
+    await asyncio.gather(
+        process_orders_batch(),
+        misura_coda(),
+        *([aggrega_candele()] if settings.CANDLE_ENABLED else []),
+        *(process_limit_orders(asset) for asset in settings.SUPPORTED_TICKERS)
+    )
+
 
-    if not wallet:
-        print(f"Wallet non trovato per {user_id}")
-        return
-    
-#riprendi da qui
+if __name__ == "__main__":
+    #il worker usa il suo profilo di pool, più piccolo di quello delle api
+    database.usa_profilo("worker")
+    #il worker non ha un server http: le sue metriche sono su una porta dedicata
+    if settings.WORKER_METRICS_PORT:
+        try:
+            start_http_server(settings.WORKER_METRICS_PORT)
+        except OSError as e:
+            #con più worker sulla stessa macchina solo il primo ottiene la porta
+            print(f"Metriche del worker non esposte sulla porta {settings.WORKER_METRICS_PORT}: {e}")
+    asyncio.run(main())